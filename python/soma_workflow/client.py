@@ -25,6 +25,8 @@ import types
 import subprocess
 import sys
 import posixpath
+import threading
+import Queue
 
 if sys.version_info[:2] >= (2, 6):
   import json
@@ -155,7 +157,9 @@ class WorkflowController(object):
                                     username=login,
                                     hostname=sub_machine)
       else:
-        self._transfer = PortableRemoteTransfer(self._engine_proxy)
+        self._transfer = PortableRemoteTransfer(
+                  self._engine_proxy,
+                  bundle_threshold=self.config.get_transfer_bundle_threshold())
       self._transfer_stdouterr = PortableRemoteTransfer(self._engine_proxy)
 
     # LIGHT MODE
@@ -352,6 +356,19 @@ class WorkflowController(object):
     return self._engine_proxy.workflow_status(workflow_id)
 
 
+  def workflows_status(self, workflow_ids):
+    '''
+    Gets back the status of several workflows in a single call.
+
+    * workflow_ids *sequence of workflow identifiers*
+
+    * returns: *dictionary: workflow identifier -> string*
+        Status of the workflows (see workflow_status). The workflow 
+        identifiers which are not valid are not in the dictionary.
+    '''
+    return self._engine_proxy.workflows_status(workflow_ids)
+
+
   def workflow_elements_status(self, workflow_id):
     '''
     Gets back the status of all the workflow elements at once, minimizing the
@@ -373,6 +390,40 @@ class WorkflowController(object):
     Raises *UnknownObjectError* if the workflow_id is not valid
     '''
     wf_status = self._engine_proxy.workflow_elements_status(workflow_id)
+    return self._elements_status_with_progression(wf_status)
+
+
+  def workflow_elements_status_changes(self, workflow_id, since_version=None):
+    '''
+    Gets back the status of the workflow elements which changed since a 
+    given version of the workflow. Each status change of a job or a file
+    transfer of the workflow increments its version. Monitoring a workflow 
+    with this method avoids transfering the status of all its elements 
+    each time.
+
+    * workflow_id *workflow identifier*
+
+    * since_version *int or None*
+        Version returned by a previous call. If None, the status of all the 
+        elements is returned.
+
+    * returns: tuple:
+        * version of the workflow,
+        * status of the elements which changed since since_version, as 
+          returned by workflow_elements_status. The workflow status and 
+          queue are always returned and the file transfers in progress are
+          always part of the transfers.
+
+    Raises *UnknownObjectError* if the workflow_id is not valid
+    '''
+    (version, 
+     wf_status) = self._engine_proxy.workflow_elements_status_changes(
+                                                                workflow_id,
+                                                                since_version)
+    return (version, self._elements_status_with_progression(wf_status))
+
+
+  def _elements_status_with_progression(self, wf_status):
     # special processing for transfer status:
     new_transfer_status = []
     for engine_path, client_path, client_paths, status, transfer_type in wf_status[1]:
@@ -595,6 +646,22 @@ class WorkflowController(object):
     '''
     self._engine_proxy.wait_job(job_ids, timeout)
 
+  def wait_workflow(self, workflow_id, timeout=-1):
+    '''
+    Waits for the workflow to end (status constants.WORKFLOW_DONE).
+    The wait is done on the computing resource side in a single call: it 
+    returns as soon as the workflow status is updated.
+
+    * workflow_id *workflow identifier*
+
+    * timeout *int*
+        The call to wait_workflow exits before timeout seconds.
+        A negative value means that the method will wait indefinetely.
+
+    Raises *UnknownObjectError* if the workflow_id is not valid
+    '''
+    self._engine_proxy.wait_workflow(workflow_id, timeout)
+
   def kill_job(self, job_id ):
     '''
     **deprecated since version 2.4:** Use stop_workflow instead.
@@ -648,7 +715,11 @@ class WorkflowController(object):
 
   ########## FILE TRANSFER CONTROL #######################################
 
-  def transfer_files(self, transfer_ids, buffer_size = 512**2):
+  def transfer_files(self, 
+                     transfer_ids, 
+                     buffer_size = 512**2, 
+                     nb_workers=None, 
+                     callback=None):
     '''
     Transfer file(s) associated to the transfer_id.
     If the files are only located on the client side (that is the transfer
@@ -658,6 +729,8 @@ class WorkflowController(object):
     transfer status is constants.FILES_ON_CR or
     constants.FILES_ON_CLIENT_AND_CR)
     the files will be transfered from the computing resource to the client.
+    When the files are transfered piece by piece, an interrupted transfer is
+    resumed after the pieces which are already identical on both sides.
 
     * transfer_id *FileTransfer identifier*
 
@@ -666,17 +739,140 @@ class WorkflowController(object):
         piece. The size of each piece can be tuned using the buffer_size
         argument.
 
+    * nb_workers *int*
+        Number of files transfered at once. Depending on the transfer method,
+        the files of a directory can be transfered in parallel too. By
+        default, the value of the TRANSFER_WORKERS configuration item (4 if
+        it is not set).
+
+    * callback *function(int, int)*
+        Optional function called in the calling thread as the transfers go
+        on, with the cumulated size of the data to transfer and the size of
+        the data already transfered.
+
     * returns: *boolean*
         The transfer was done. (TBI right error management)
 
     Raises *UnknownObjectError* if the transfer_id is not valid
+    Raises *ValueError* if nb_workers is lower than 1
     #Raises *TransferError*
     '''
-    if not type(transfer_ids) in types.StringTypes:
-        for transfer_id in transfer_ids:
-          self._transfer_file(transfer_id, buffer_size)
+    if type(transfer_ids) in types.StringTypes:
+      transfer_ids = [transfer_ids]
+    if nb_workers == None:
+      nb_workers = self.config.get_transfer_workers()
+    if nb_workers < 1:
+      raise ValueError("The number of transfer workers must be at least 1: "
+                       "%s" % repr(nb_workers))
+
+    # transfer_id -> [workflow_id, number of files left to transfer]
+    transfers = {}
+    # tuples (transfer_id, to_remote, tuple returned by the split of the
+    # transfer: (source path, destination path[, bundle]))
+    tasks = Queue.Queue()
+    nb_tasks = 0
+    data_size = 0
+    for transfer_id in transfer_ids:
+      transfer = self._prepare_transfer(transfer_id)
+      if transfer == None:
+        continue
+      (workflow_id, to_remote, paths) = transfer
+      files = []
+      for source, destination in paths:
+        if to_remote:
+          if callback != None:
+            if os.path.isfile(source):
+              data_size = data_size + os.path.getsize(source)
+            else:
+              data_size = data_size + \
+                          self._transfer_monitoring.get_dir_size(source)
+          files.extend(self._transfer.split_transfer_to_remote(source,
+                                                               destination))
+        else:
+          if callback != None:
+            data_size = data_size + \
+              self._transfer_monitoring.transfer_from_remote_progression(
+                                                        source,
+                                                        destination)[0]
+          files.extend(self._transfer.split_transfer_from_remote(source,
+                                                                 destination))
+      if not files:
+        self._end_transfer(transfer_id, workflow_id)
+        continue
+      transfers[transfer_id] = [workflow_id, len(files)]
+      for split_transfer in files:
+        tasks.put((transfer_id, to_remote, split_transfer))
+      nb_tasks = nb_tasks + len(files)
+
+    # tuples (task, exception) when a transfer ends, 
+    # or (None, size of the data transfered)
+    events = Queue.Queue()
+    workers = []
+    for i in range(min(nb_workers, nb_tasks)):
+      tasks.put(None)
+      worker = threading.Thread(target=WorkflowController._run_transfers,
+                                args=(self._transfer.copy(),
+                                      tasks,
+                                      events,
+                                      callback != None))
+      worker.setDaemon(True)
+      worker.start()
+      workers.append(worker)
+
+    data_transfered = 0
+    errors = []
+    while nb_tasks:
+      (task, event) = events.get()
+      if task == None:
+        data_transfered = data_transfered + event
+        callback(data_size, data_transfered)
+        continue
+      nb_tasks = nb_tasks - 1
+      transfer_id = task[0]
+      if event != None:
+        errors.append(event)
+        transfers[transfer_id][1] = None
+      elif transfers[transfer_id][1] != None:
+        transfers[transfer_id][1] = transfers[transfer_id][1] - 1
+        if transfers[transfer_id][1] == 0:
+          self._end_transfer(transfer_id, transfers[transfer_id][0])
+    for worker in workers:
+      worker.join()
+    if errors:
+      raise errors[0]
+
+
+  @staticmethod
+  def _run_transfers(transfer, tasks, events, report_progress):
+    '''
+    Transfers the files of the tasks queue, until it gets None.
+    '''
+    if report_progress:
+      callback = lambda size: events.put((None, size))
     else:
-      self._transfer_file(transfer_ids, buffer_size)
+      callback = None
+    task = tasks.get()
+    while task != None:
+      (transfer_id, to_remote, split_transfer) = task
+      try:
+        if len(split_transfer) == 3:
+          # bundle of files of a directory
+          (source, destination, relative_paths) = split_transfer
+          transfer.transfer_to_remote(source,
+                                      destination,
+                                      callback=callback,
+                                      relative_paths=relative_paths)
+        elif to_remote:
+          (source, destination) = split_transfer
+          transfer.transfer_to_remote(source, destination, callback=callback)
+        else:
+          (source, destination) = split_transfer
+          transfer.transfer_from_remote(source, destination, callback=callback)
+      except Exception, e:
+        events.put((task, e))
+      else:
+        events.put((task, None))
+      task = tasks.get()
 
 
 
@@ -784,7 +980,16 @@ class WorkflowController(object):
       return transfer_type
 
 
-  def _transfer_file(self, transfer_id, buffer_size):
+  def _prepare_transfer(self, transfer_id):
+    '''
+    Initializes the transfer.
+
+    * returns: *tuple or None*
+        None if there is nothing to transfer, otherwise a tuple:
+        * workflow_id
+        * True if the transfer is from the client to the computing resource
+        * sequence of tuples (source path, destination path)
+    '''
 
     (transfer_id,
      client_path,
@@ -810,24 +1015,15 @@ class WorkflowController(object):
 
       if transfer_type == constants.TR_FILE_C_TO_CR or \
          transfer_type == constants.TR_DIR_C_TO_CR:
-        self._transfer.transfer_to_remote(client_path,
-                                         remote_path)
-        self._engine_proxy.set_transfer_status(transfer_id,
-                                               constants.FILES_ON_CLIENT_AND_CR)
-        self._engine_proxy.signalTransferEnded(transfer_id, workflow_id)
-        return True
+        return (workflow_id, True, [(client_path, remote_path)])
 
       if transfer_type == constants.TR_MFF_C_TO_CR:
+        paths = []
         for path in client_paths:
           relative_path = os.path.basename(path)
           r_path = posixpath.join(remote_path, relative_path)
-          self._transfer.transfer_to_remote(path,
-                                            r_path)
-
-        self._engine_proxy.set_transfer_status(transfer_id,
-                                               constants.FILES_ON_CLIENT_AND_CR)
-        self._engine_proxy.signalTransferEnded(transfer_id, workflow_id)
-        return True
+          paths.append((path, r_path))
+        return (workflow_id, True, paths)
 
     if status == constants.FILES_ON_CR or \
        status == constants.TRANSFERING_FROM_CR_TO_CLIENT or \
@@ -847,26 +1043,23 @@ class WorkflowController(object):
       if transfer_type == constants.TR_FILE_CR_TO_C or \
          transfer_type == constants.TR_DIR_CR_TO_C:
         # file case
-        self._transfer.transfer_from_remote(remote_path,
-                                            client_path)
-        self._engine_proxy.set_transfer_status(transfer_id,
-                                               constants.FILES_ON_CLIENT_AND_CR)
-        self._engine_proxy.signalTransferEnded(transfer_id, workflow_id)
-        return True
+        return (workflow_id, False, [(remote_path, client_path)])
 
       if transfer_type == constants.TR_MFF_CR_TO_C:
+        paths = []
         for path in client_paths:
           relative_path = os.path.basename(path)
           r_path = posixpath.join(remote_path, relative_path)
-          self._transfer.transfer_from_remote(r_path,
-                                              path)
+          paths.append((r_path, path))
+        return (workflow_id, False, paths)
+
+    return None
 
-        self._engine_proxy.set_transfer_status(transfer_id,
-                                               constants.FILES_ON_CLIENT_AND_CR)
-        self._engine_proxy.signalTransferEnded(transfer_id, workflow_id)
-        return True
 
-    return False
+  def _end_transfer(self, transfer_id, workflow_id):
+    self._engine_proxy.set_transfer_status(transfer_id,
+                                           constants.FILES_ON_CLIENT_AND_CR)
+    self._engine_proxy.signalTransferEnded(transfer_id, workflow_id)
 
 
   def _transfer_progression(self,
@@ -1046,20 +1239,16 @@ class Helper(object):
     * wf_ctrl *client.WorkflowController*
     '''
 
-    element_status = wf_ctrl.workflow_elements_status(workflow_id)
-    job_ids = []
-    for job_info in element_status[0]:
-      job_ids.append(job_info[0])
-
-
-    wf_ctrl.wait_job(job_ids)
+    wf_ctrl.wait_workflow(workflow_id)
 
 
 
   @staticmethod
   def transfer_input_files(workflow_id,
                            wf_ctrl,
-                           buffer_size = 512**2):
+                           buffer_size = 512**2,
+                           nb_workers=None,
+                           callback=None):
     '''
     Transfers all the input files of a workflow.
 
@@ -1071,6 +1260,14 @@ class Helper(object):
         Depending on the transfer method, the files can be transfered piece by
         piece. The size of each piece can be tuned using the buffer_size
         argument.
+
+    * nb_workers *int*
+        Number of files transfered at once (see
+        WorkflowController.transfer_files).
+
+    * callback *function(int, int)*
+        Optional function called with the cumulated size of the data to
+        transfer and the size of the data already transfered.
     '''
     transfer_info = None
     wf_elements_status = wf_ctrl.workflow_elements_status(workflow_id)
@@ -1085,14 +1282,16 @@ class Helper(object):
         engine_path = transfer_info[0]
         to_transfer.append(engine_path)
 
-    wf_ctrl.transfer_files(to_transfer, buffer_size)
+    wf_ctrl.transfer_files(to_transfer, buffer_size, nb_workers, callback)
 
 
 
   @staticmethod
   def transfer_output_files(workflow_id,
                             wf_ctrl,
-                            buffer_size=512**2):
+                            buffer_size=512**2,
+                            nb_workers=None,
+                            callback=None):
     '''
     Transfers all the output files of a workflow which are ready to transfer.
 
@@ -1104,6 +1303,14 @@ class Helper(object):
         Depending on the transfer method, the files can be transfered piece by
         piece. The size of each piece can be tuned using the buffer_size
         argument.
+
+    * nb_workers *int*
+        Number of files transfered at once (see
+        WorkflowController.transfer_files).
+
+    * callback *function(int, int)*
+        Optional function called with the cumulated size of the data to
+        transfer and the size of the data already transfered.
     '''
     transfer_info = None
     wf_elements_status = wf_ctrl.workflow_elements_status(workflow_id)
@@ -1118,7 +1325,7 @@ class Helper(object):
         engine_path = transfer_info[0]
         to_transfer.append(engine_path)
 
-    wf_ctrl.transfer_files(to_transfer, buffer_size)
+    wf_ctrl.transfer_files(to_transfer, buffer_size, nb_workers, callback)
 
 
 
@@ -109,6 +109,11 @@ class Job(object):
     .. warning::
       The computing resources must be configured explicitly to use this feature.
 
+  **memory**: *int*
+    Memory needed by the Job, in MB. The local scheduler starts a Job only if
+    its memory fits in the memory left by the running Jobs (see the MAX_MEMORY
+    and JOB_MEMORY configuration items; JOB_MEMORY is used if it is not set).
+
   **user_storage**: *picklable object*
     For the user needs, any small and picklable object can be stored here.
 
@@ -153,6 +158,9 @@ class Job(object):
   # tuple(string, int)
   parallel_job_info = None
 
+  # int (in MB)
+  memory = None
+
   # int (in hours)
   disposal_timeout = None
 
@@ -173,7 +181,8 @@ class Job(object):
                 parallel_job_info=None,
                 priority=0,
                 native_specification=None,
-                user_storage=None):
+                user_storage=None,
+                memory=None):
     if not name and len(command) != 0:
       self.name = command[0]
     else:
@@ -194,6 +203,7 @@ class Job(object):
     self.parallel_job_info = parallel_job_info
     self.priority = priority
     self.native_specification = native_specification
+    self.memory = memory
 
     for command_elem in self.command:
       if type(command_elem) in types.StringTypes:
@@ -254,6 +264,7 @@ class Job(object):
                  "priority",
                  "native_specification",
                  "parallel_job_info",
+                 "memory",
                  "disposal_timeout",
                  ]
     for attr_name in attributs:
@@ -349,6 +360,7 @@ class Job(object):
                  "priority",
                  "native_specification",
                  "parallel_job_info",
+                 "memory",
                  "disposal_timeout",
                 ]
   
@@ -18,7 +18,9 @@ from __future__ import with_statement # allow python 2.5 to work
 #-------------------------------------------------------------------------------
 
 import os
+import re
 import sys
+import shutil
 import socket
 import ConfigParser
 
@@ -66,6 +68,12 @@ OCFG_LOGIN = 'LOGIN'
 OCFG_SSHPort = 'SSHPort'
 OCFG_INSTALLPATH = 'INSTALLPATH'
 
+#OCFG_TRANSFER_WORKERS is the number of files the client transfers at once.
+OCFG_TRANSFER_WORKERS = 'TRANSFER_WORKERS'
+#OCFG_TRANSFER_BUNDLE_THRESHOLD is the size (in KB) under which the files of a
+#directory are transfered in bundles, with the portable transfer.
+OCFG_TRANSFER_BUNDLE_THRESHOLD = 'TRANSFER_BUNDLE_THRESHOLD'
+
 #OCFG_MAX_JOB_IN_QUEUE allow to specify a maximum number of job N which can be
 #in the queue for one user. The engine won't submit more than N job at once. The
 #also wait for the job to leave the queue before submitting new jobs.
@@ -121,6 +129,8 @@ OCFG_NATIVE_SPECIFICATION = 'NATIVE_SPECIFICATION'
 
 OCFG_SCDL_CPU_NB = "CPU_NB"
 OCFG_SCDL_INTERVAL = "SCHEDULER_INTERVAL"
+OCFG_SCDL_MAX_MEMORY = "MAX_MEMORY"
+OCFG_SCDL_JOB_MEMORY = "JOB_MEMORY"
 OCFG_SWF_DIR = "SOMA_WORKFLOW_DIR"
 
 
@@ -169,6 +179,10 @@ class Configuration(observer.Observable):
 
   _res_install_path = None
 
+  _transfer_workers = None
+
+  _transfer_bundle_threshold = None
+
   _shared_temporary_dir = None
 
   parallel_job_config = None
@@ -360,7 +374,7 @@ class Configuration(observer.Observable):
             and config_parser.has_option(resource_id, OCFG_SWF_DIR):
           swf_dir = config_parser.get(resource_id, OCFG_SWF_DIR)
 
-      database_file = os.path.join(swf_dir, "soma_workflow-%s.db" % DB_VERSION)
+      database_file = Configuration.get_light_mode_database_file(swf_dir)
       transfered_file_dir = os.path.join(swf_dir, "transfered_files")
 
       config = cls(resource_id=resource_id,
@@ -447,6 +461,47 @@ class Configuration(observer.Observable):
         return self._sshport
 
 
+  def get_transfer_workers(self):
+    if self._transfer_workers != None:
+      return self._transfer_workers
+
+    if self._config_parser != None and \
+       self._config_parser.has_option(self._resource_id,
+                                      OCFG_TRANSFER_WORKERS):
+      self._transfer_workers = int(self._config_parser.get(
+                                                      self._resource_id,
+                                                      OCFG_TRANSFER_WORKERS))
+      if self._transfer_workers < 1:
+        raise ConfigurationError("The configuration item %s of the resource "
+                                 "%s must be at least 1: %d" 
+                                 %(OCFG_TRANSFER_WORKERS,
+                                   repr(self._resource_id),
+                                   self._transfer_workers))
+    else:
+      self._transfer_workers = 4
+
+    return self._transfer_workers
+
+
+  def get_transfer_bundle_threshold(self):
+    '''
+    returns the size in bytes
+    '''
+    if self._transfer_bundle_threshold != None:
+      return self._transfer_bundle_threshold
+
+    if self._config_parser != None and \
+       self._config_parser.has_option(self._resource_id,
+                                      OCFG_TRANSFER_BUNDLE_THRESHOLD):
+      self._transfer_bundle_threshold = 1024 * int(self._config_parser.get(
+                                              self._resource_id,
+                                              OCFG_TRANSFER_BUNDLE_THRESHOLD))
+    else:
+      self._transfer_bundle_threshold = 256 * 1024
+
+    return self._transfer_bundle_threshold
+
+
   def get_submitting_machines(self):
     if self._config_parser == None or self._submitting_machines:
       return self._submitting_machines
@@ -466,6 +521,41 @@ class Configuration(observer.Observable):
     return self._submitting_machines
 
 
+  @staticmethod
+  def get_light_mode_database_file(swf_dir):
+    '''
+    returns the path of the database file of the light mode, which depends
+    on the database version. If it does not exist yet, the database file of
+    the most recent previous version is copied to it, so that the database 
+    server migrates it and the workflows are kept. The previous file is left
+    for the previous versions of soma-workflow.
+    '''
+    database_file = os.path.join(swf_dir, "soma_workflow-%s.db" % DB_VERSION)
+    if os.path.isfile(database_file) or not os.path.isdir(swf_dir):
+      return database_file
+
+    current_version = [int(n) for n in DB_VERSION.split('.')]
+    previous_versions = []
+    for file_name in os.listdir(swf_dir):
+      match = re.match(r"^soma_workflow-([0-9.]+)\.db$", file_name)
+      if not match:
+        continue
+      try:
+        version = [int(n) for n in match.group(1).split('.')]
+      except ValueError:
+        continue
+      if version < current_version:
+        previous_versions.append((version, file_name))
+    if previous_versions:
+      previous_file = os.path.join(swf_dir, max(previous_versions)[1])
+      # the changes of a database in WAL mode may still be in the -wal file.
+      # The database file is copied last: it is not used before.
+      for suffix in ["-wal", ""]:
+        if os.path.isfile(previous_file + suffix):
+          shutil.copy2(previous_file + suffix, database_file + suffix)
+    return database_file
+
+
   @staticmethod
   def search_config_path():
     '''
@@ -917,25 +1007,43 @@ class LocalSchedulerCfg(observer.Observable):
   # interval (second)
   _interval = None
 
+  # memory available to the jobs (MB), None if not accounted
+  _max_memory = None
+
+  # memory budget of a job (MB)
+  _job_memory = None
+
   # path of the configuration file
   _config_path = None
 
 
   PROC_NB_CHANGED = 0
   INTERVAL_CHANGED = 1
+  MEMORY_CHANGED = 2
 
-  def __init__(self, proc_nb=1, interval=1):
+  def __init__(self, proc_nb=1, interval=1, max_memory=None, job_memory=None):
     '''
     * proc_nb *int*
-      Number of processus which can run in parallel
+      Number of processus which can run in parallel. A parallel job takes
+      as many processus slots as the number of CPU of its parallel_job_info.
 
     * interval *int*
       Update interval in second
+
+    * max_memory *int*
+      Memory available to the jobs in MB. If None the memory is not taken 
+      into account to start the jobs.
+
+    * job_memory *int*
+      Memory budget in MB of the jobs which do not declare their memory 
+      (Job.memory), used if max_memory is set.
     '''
 
     super(LocalSchedulerCfg, self).__init__()
     self._proc_nb = proc_nb
     self._interval = interval
+    self._max_memory = max_memory
+    self._job_memory = job_memory
 
 
   @classmethod
@@ -971,26 +1079,15 @@ class LocalSchedulerCfg(observer.Observable):
                                "section " + hostname + " in configuration "
                                "file: " + config_path)
 
-    proc_nb = None
-    interval = None
-
-    if config_parser.has_option(hostname,
-                                OCFG_SCDL_CPU_NB):
-      proc_nb_str = config_parser.get(socket.gethostname(),
-                                      OCFG_SCDL_CPU_NB)
-      proc_nb = int(proc_nb_str)
-    if config_parser.has_option(hostname,
-                                OCFG_SCDL_INTERVAL):
-      interval_str = config_parser.get(hostname,
-                                       OCFG_SCDL_INTERVAL)
-      interval = int(interval_str)
-
-    if proc_nb == None and interval == None:
-      config = cls()
-    elif proc_nb == None and interval != None:
-      config = cls(interval=interval)
-    else:
-      config = cls(proc_nb=proc_nb, interval=interval)
+    kwargs = {}
+    for option, argument in [(OCFG_SCDL_CPU_NB, "proc_nb"),
+                             (OCFG_SCDL_INTERVAL, "interval"),
+                             (OCFG_SCDL_MAX_MEMORY, "max_memory"),
+                             (OCFG_SCDL_JOB_MEMORY, "job_memory")]:
+      if config_parser.has_option(hostname, option):
+        kwargs[argument] = int(config_parser.get(hostname, option))
+
+    config = cls(**kwargs)
     config._config_path = config_path
     return config
 
@@ -1032,6 +1129,12 @@ class LocalSchedulerCfg(observer.Observable):
   def get_interval(self):
     return self._interval
 
+  def get_max_memory(self):
+    return self._max_memory
+
+  def get_job_memory(self):
+    return self._job_memory
+
   def set_proc_nb(self, proc_nb):
     self._proc_nb = proc_nb
     self.notifyObservers(LocalSchedulerCfg.PROC_NB_CHANGED)
@@ -1040,6 +1143,11 @@ class LocalSchedulerCfg(observer.Observable):
     self._interval = interval
     self.notifyObservers(LocalSchedulerCfg.INTERVAL_CHANGED)
 
+  def set_memory(self, max_memory, job_memory):
+    self._max_memory = max_memory
+    self._job_memory = job_memory
+    self.notifyObservers(LocalSchedulerCfg.MEMORY_CHANGED)
+
   def save_to_file(self, config_path=None):
     hostname = socket.gethostname()
     if not config_path:
@@ -1064,6 +1172,12 @@ class LocalSchedulerCfg(observer.Observable):
     config_parser.set(hostname,
                       OCFG_SCDL_INTERVAL,
                       str(self._interval))
+    for option, value in [(OCFG_SCDL_MAX_MEMORY, self._max_memory),
+                          (OCFG_SCDL_JOB_MEMORY, self._job_memory)]:
+      if value == None:
+        config_parser.remove_option(hostname, option)
+      else:
+        config_parser.set(hostname, option, str(value))
     config_file = open(config_path, "w")
     config_parser.write(config_file)
     config_file.close()
@@ -22,15 +22,17 @@ import os
 import shutil
 import logging
 import pickle
+import copy
 from datetime import date
 from datetime import timedelta
 from datetime import datetime
 import socket
 
 import soma_workflow.constants as constants
-from soma_workflow.client import FileTransfer, TemporaryPath
+from soma_workflow.client import FileTransfer, TemporaryPath, Group
 from soma_workflow.errors import UnknownObjectError, DatabaseError
 from soma_workflow.info import DB_VERSION
+from soma_workflow.engine_types import EngineWorkflow
 
 
 #-----------------------------------------------------------------------------
@@ -39,6 +41,18 @@ from soma_workflow.info import DB_VERSION
 
 strtime_format = '%Y-%m-%d %H:%M:%S'
 file_separator = ', '
+# maximum number of parameters in a SQL request 
+# (default value of SQLITE_MAX_VARIABLE_NUMBER)
+sqlite_max_variable_number = 999
+# SQLite settings of the database server connections:
+# with the WAL journal mode the readers do not block the writers and the 
+# writers do not block the readers.
+sqlite_journal_mode = "WAL"
+# NORMAL is safe against corruption in WAL mode (the last transactions may 
+# only be lost on power failure)
+sqlite_synchronous = "NORMAL"
+# page cache size of each connection (negative values are in KiB)
+sqlite_cache_size = -16000
 
 #-----------------------------------------------------------------------------
 # Local utilities
@@ -49,6 +63,53 @@ def adapt_datetime(ts):
 
 sqlite3.register_adapter(datetime, adapt_datetime)
 
+class ThreadConnection(sqlite3.Connection):
+  '''
+  SQLite connection kept open by a thread between the calls to the database 
+  server methods. Closing it only discards the changes which were not 
+  committed, as closing the connection would do. The connection is really 
+  closed by close_connection, when the thread has ended or when the database
+  server closes all its connections.
+  '''
+
+  def close(self):
+    self.rollback()
+
+  def close_connection(self):
+    super(ThreadConnection, self).close()
+
+
+def split_in_chunks(sequence, chunk_size=sqlite_max_variable_number):
+    '''
+    Splits a sequence in lists of chunk_size elements at most, so that each 
+    list can be used as arguments of a "WHERE ... IN (...)" request.
+    '''
+    sequence = list(sequence)
+    return [sequence[i:i + chunk_size] 
+            for i in range(0, len(sequence), chunk_size)]
+
+
+def pickle_engine_job(engine_job):
+    '''
+    Pickles an EngineJob on its own: only the transfers referenced by the job
+    are kept (the jobs of a workflow share the transfer mapping of the 
+    workflow) and the path translation, only used to build the job, is 
+    dropped.
+    '''
+    stored_job = copy.copy(engine_job)
+    stored_job.transfer_mapping = engine_job.own_transfer_mapping()
+    stored_job.path_translation = None
+    return sqlite3.Binary(pickle.dumps(stored_job, pickle.HIGHEST_PROTOCOL))
+
+
+def unpickle_engine_job(pickled_job):
+    if pickled_job is None:
+        return None
+    if isinstance(pickled_job, unicode):
+        # text pickle written by the previous versions
+        pickled_job = pickled_job.encode('utf-8')
+    return pickle.loads(str(pickled_job))
+
 
 #-----------------------------------------------------------------------------
 # Classes and functions
@@ -125,6 +186,14 @@ Job server database tables:
       resource_usage_file  : string, optional
                              contain the resource usage information of the job.
 
+    => used to build back the workflows
+      pickled_engine_job : the EngineJob with the transfers it references
+
+    => used to send the workflow status changes only
+      version            : int
+                           version of the workflow at the last change of the
+                           job status (see the workflows table)
+
 
 
   Transfer
@@ -137,6 +206,16 @@ Job server database tables:
     status
     client_paths
     transfer_type
+    version (workflow version at the last change of the transfer status)
+
+  Temporary paths
+    temp_path_id
+    engine file path
+    expiration date
+    user_id
+    workflow_id (optional)
+    status
+    version (workflow version at the last change of the status)
 
   Input/Ouput junction table
     job_id
@@ -146,11 +225,30 @@ Job server database tables:
   Workflows
     id,
     user_id,
-    pickled_engine_workflow,
+    pickled_engine_workflow (not used since the version 1.3),
     expiration_date,
     name,
     ended_transfered,
-    status
+    status,
+    user_storage (pickled),
+    version (incremented on each status change of the workflow jobs, 
+             transfers and temporary paths. Maintained by triggers.)
+
+  Dependencies
+    workflow_id
+    predecessor_id (job id)
+    successor_id (job id)
+
+  Job groups
+    id
+    workflow_id
+    name
+
+  Group elements
+    workflow_id
+    group_id (None for the root group of the workflow)
+    rank
+    job_id or element_group_id
 '''
 
 def create_database(database_file):
@@ -188,7 +286,9 @@ def create_database(database_file):
                                        terminating_signal   VARCHAR(255),
                                        resource_usage       TEXT,
 
-                                       pickled_engine_job   TEXT
+                                       pickled_engine_job   TEXT,
+
+                                       version              INTEGER NOT NULL DEFAULT 0
                                        )''')
 
   cursor.execute('''CREATE TABLE transfers (engine_file_path  TEXT PRIMARY KEY NOT NULL,
@@ -199,7 +299,8 @@ def create_database(database_file):
                                             workflow_id      INTEGER CONSTRAINT known_workflow REFERENCES workflows (id),
                                             status           VARCHAR(255) NOT NULL,
                                             client_paths     TEXT,
-                                            transfer_type TEXT)''')
+                                            transfer_type TEXT,
+                                            version          INTEGER NOT NULL DEFAULT 0)''')
 
   cursor.execute('''CREATE TABLE temporary_paths (
       temp_path_id     INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -207,7 +308,8 @@ def create_database(database_file):
       expiration_date  DATE NOT NULL,
       user_id          INTEGER NOT NULL CONSTRAINT known_user REFERENCES users (id),
       workflow_id      INTEGER CONSTRAINT known_workflow REFERENCES workflows (id),
-      status           VARCHAR(255) NOT NULL)''')
+      status           VARCHAR(255) NOT NULL,
+      version          INTEGER NOT NULL DEFAULT 0)''')
 
   cursor.execute('''CREATE TABLE ios (job_id           INTEGER NOT NULL CONSTRAINT known_job REFERENCES jobs(id),
                                       engine_file_path  TEXT NOT NULL CONSTRAINT known_engine_file REFERENCES transfers (engine_file_path),
@@ -231,7 +333,13 @@ def create_database(database_file):
                                            ended_transfers    TEXT,
                                            status             TEXT,
                                            last_status_update DATE NOT NULL,
-                                           queue              TEXT) ''')
+                                           queue              TEXT,
+                                           user_storage       TEXT,
+                                           version            INTEGER NOT NULL DEFAULT 0) ''')
+
+  create_indexes(cursor)
+  create_workflow_structure_tables(cursor)
+  create_version_triggers(cursor)
 
   cursor.execute('''CREATE TABLE db_version (version TEXT NOT NULL)''')
   cursor.execute('INSERT INTO db_version (version) VALUES (?)', [DB_VERSION])
@@ -240,6 +348,238 @@ def create_database(database_file):
   connection.commit()
   connection.close()
 
+def create_indexes(cursor):
+  '''
+  Indexes on the columns used to select rows in the frequent requests
+  (besides the primary keys). 
+  The (user_id, status, queue) index is also used by the requests on 
+  (user_id, status) only.
+  '''
+  cursor.execute('''CREATE INDEX IF NOT EXISTS jobs_workflow_id 
+                    ON jobs (workflow_id)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS jobs_user_status_queue 
+                    ON jobs (user_id, status, queue)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS transfers_workflow_id 
+                    ON transfers (workflow_id)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS temporary_paths_workflow_id
+                    ON temporary_paths (workflow_id)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS ios_engine_file_path 
+                    ON ios (engine_file_path)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS ios_tmp_temp_path_id 
+                    ON ios_tmp (temp_path_id)''')
+
+def create_workflow_structure_tables(cursor):
+  '''
+  Tables holding the workflow dependencies and groups. The jobs are stored
+  one by one in the jobs table (pickled_engine_job) so that a workflow can be
+  built back partially.
+  '''
+  cursor.execute('''CREATE TABLE dependencies (
+      workflow_id    INTEGER NOT NULL CONSTRAINT known_workflow REFERENCES workflows (id),
+      predecessor_id INTEGER NOT NULL CONSTRAINT known_job REFERENCES jobs (id),
+      successor_id   INTEGER NOT NULL CONSTRAINT known_job REFERENCES jobs (id))''')
+
+  cursor.execute('''CREATE TABLE job_groups (
+      id          INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+      workflow_id INTEGER NOT NULL CONSTRAINT known_workflow REFERENCES workflows (id),
+      name        TEXT)''')
+
+  cursor.execute('''CREATE TABLE group_elements (
+      workflow_id      INTEGER NOT NULL CONSTRAINT known_workflow REFERENCES workflows (id),
+      group_id         INTEGER CONSTRAINT known_group REFERENCES job_groups (id),
+      rank             INTEGER NOT NULL,
+      job_id           INTEGER CONSTRAINT known_job REFERENCES jobs (id),
+      element_group_id INTEGER CONSTRAINT known_group REFERENCES job_groups (id))''')
+
+  cursor.execute('''CREATE INDEX IF NOT EXISTS dependencies_workflow_id
+                    ON dependencies (workflow_id)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS job_groups_workflow_id
+                    ON job_groups (workflow_id)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS group_elements_workflow_id
+                    ON group_elements (workflow_id)''')
+
+def create_version_triggers(cursor):
+  '''
+  Indexes and triggers maintaining the workflow versions: each change of the
+  status of a job, a transfer or a temporary path of a workflow increments 
+  the version of the workflow and tags the row with the new version, so that 
+  the elements which changed since a given version can be selected 
+  (see WorkflowDatabaseServer.get_workflow_status_changes).
+  The status written again without change (status heartbeat) do not change 
+  the version. The jobs which do not belong to any workflow have the
+  workflow_id -1.
+  '''
+  cursor.execute('''CREATE INDEX IF NOT EXISTS jobs_workflow_id_version
+                    ON jobs (workflow_id, version)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS transfers_workflow_id_version
+                    ON transfers (workflow_id, version)''')
+  cursor.execute('''CREATE INDEX IF NOT EXISTS 
+                    temporary_paths_workflow_id_version
+                    ON temporary_paths (workflow_id, version)''')
+
+  cursor.execute('''CREATE TRIGGER IF NOT EXISTS jobs_version
+      AFTER UPDATE OF status, queue, submission_date, execution_date, 
+                      ending_date, exit_status, exit_value, 
+                      terminating_signal, resource_usage ON jobs
+      WHEN NEW.workflow_id IS NOT NULL AND
+           (NEW.status IS NOT OLD.status OR
+            NEW.queue IS NOT OLD.queue OR
+            NEW.submission_date IS NOT OLD.submission_date OR
+            NEW.execution_date IS NOT OLD.execution_date OR
+            NEW.ending_date IS NOT OLD.ending_date OR
+            NEW.exit_status IS NOT OLD.exit_status OR
+            NEW.exit_value IS NOT OLD.exit_value OR
+            NEW.terminating_signal IS NOT OLD.terminating_signal OR
+            NEW.resource_usage IS NOT OLD.resource_usage)
+      BEGIN
+        UPDATE workflows SET version=version+1 WHERE id=NEW.workflow_id;
+        UPDATE jobs 
+        SET version=COALESCE((SELECT version FROM workflows 
+                              WHERE id=NEW.workflow_id),
+                             version)
+        WHERE id=NEW.id;
+      END''')
+
+  cursor.execute('''CREATE TRIGGER IF NOT EXISTS transfers_version
+      AFTER UPDATE OF status, client_paths, transfer_type ON transfers
+      WHEN NEW.workflow_id IS NOT NULL AND
+           (NEW.status IS NOT OLD.status OR
+            NEW.client_paths IS NOT OLD.client_paths OR
+            NEW.transfer_type IS NOT OLD.transfer_type)
+      BEGIN
+        UPDATE workflows SET version=version+1 WHERE id=NEW.workflow_id;
+        UPDATE transfers 
+        SET version=COALESCE((SELECT version FROM workflows 
+                              WHERE id=NEW.workflow_id),
+                             version)
+        WHERE engine_file_path=NEW.engine_file_path;
+      END''')
+
+  cursor.execute('''CREATE TRIGGER IF NOT EXISTS temporary_paths_version
+      AFTER UPDATE OF status ON temporary_paths
+      WHEN NEW.workflow_id IS NOT NULL AND NEW.status IS NOT OLD.status
+      BEGIN
+        UPDATE workflows SET version=version+1 WHERE id=NEW.workflow_id;
+        UPDATE temporary_paths 
+        SET version=COALESCE((SELECT version FROM workflows 
+                              WHERE id=NEW.workflow_id),
+                             version)
+        WHERE temp_path_id=NEW.temp_path_id;
+      END''')
+
+def insert_workflow_structure(cursor, engine_workflow):
+  '''
+  Registers the dependencies and the groups of a workflow whose jobs are 
+  registered.
+  '''
+  wf_id = engine_workflow.wf_id
+  job_mapping = engine_workflow.job_mapping
+  cursor.executemany('''INSERT INTO dependencies (workflow_id,
+                                                   predecessor_id,
+                                                   successor_id)
+                        VALUES (?, ?, ?)''',
+                     ((wf_id, 
+                       job_mapping[job_a].job_id, 
+                       job_mapping[job_b].job_id)
+                      for job_a, job_b in engine_workflow.dependencies))
+
+  group_ids = {}
+  for group in engine_workflow.groups:
+    cursor.execute('''INSERT INTO job_groups (workflow_id, name) 
+                      VALUES (?, ?)''', 
+                   (wf_id, group.name))
+    group_ids[group] = cursor.lastrowid
+
+  group_elements = []
+  for group_id, elements in [(None, engine_workflow.root_group)] + \
+                            [(group_ids[group], group.elements)
+                             for group in engine_workflow.groups]:
+    for rank, element in enumerate(elements):
+      if isinstance(element, Group):
+        group_elements.append((wf_id, group_id, rank, 
+                               None, group_ids[element]))
+      else:
+        group_elements.append((wf_id, group_id, rank, 
+                               job_mapping[element].job_id, None))
+  cursor.executemany('''INSERT INTO group_elements (workflow_id,
+                                                     group_id,
+                                                     rank,
+                                                     job_id,
+                                                     element_group_id)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     group_elements)
+
+def migrate_from_1_1(cursor):
+  '''
+  1.1 -> 1.2: indexes creation.
+  '''
+  create_indexes(cursor)
+  return '1.2'
+
+def migrate_from_1_2(cursor):
+  '''
+  1.2 -> 1.3: the workflow structure is stored in tables instead of the 
+  pickled_engine_workflow column.
+  '''
+  create_workflow_structure_tables(cursor)
+  cursor.execute('ALTER TABLE workflows ADD COLUMN user_storage TEXT')
+  wf_ids = [row[0] for row in cursor.execute('''SELECT id FROM workflows
+                     WHERE pickled_engine_workflow IS NOT NULL''')]
+  for wf_id in wf_ids:
+    pickled_workflow = cursor.execute('''SELECT pickled_engine_workflow
+                                        FROM workflows WHERE id=?''',
+                                      [wf_id]).next()[0]
+    workflow = pickle.loads(pickled_workflow.encode('utf-8'))
+    cursor.executemany('UPDATE jobs SET pickled_engine_job=? WHERE id=?',
+                       ((pickle_engine_job(job), job.job_id) 
+                        for job in workflow.job_mapping.itervalues()))
+    insert_workflow_structure(cursor, workflow)
+    cursor.execute('''UPDATE workflows 
+                      SET pickled_engine_workflow=NULL, 
+                          user_storage=?
+                      WHERE id=?''',
+                   (sqlite3.Binary(pickle.dumps(workflow.user_storage, 
+                                                pickle.HIGHEST_PROTOCOL)),
+                    wf_id))
+  return '1.3'
+
+def migrate_from_1_3(cursor):
+  '''
+  1.3 -> 1.4: workflow versions (see create_version_triggers).
+  '''
+  for table in ['jobs', 'transfers', 'temporary_paths', 'workflows']:
+    cursor.execute('ALTER TABLE %s ADD COLUMN '
+                   'version INTEGER NOT NULL DEFAULT 0' % table)
+  create_version_triggers(cursor)
+  return '1.4'
+
+# database migrations: version -> function upgrading the database to the 
+# next version and returning the new version 
+migrations = {'1.1': migrate_from_1_1,
+              '1.2': migrate_from_1_2,
+              '1.3': migrate_from_1_3}
+
+def migrate_database(connection, version):
+  '''
+  Upgrades the database from version to DB_VERSION, if a migration path 
+  exists.
+
+  * returns: *string*
+    The version of the database after the migrations.
+  '''
+  cursor = connection.cursor()
+  try:
+    while version != DB_VERSION and version in migrations:
+      version = migrations[version](cursor)
+      cursor.execute('UPDATE db_version SET version=?', [version])
+  except Exception:
+    connection.rollback()
+    cursor.close()
+    raise
+  connection.commit()
+  cursor.close()
+  return version
+
 def print_job_status(database_file):
   connection = sqlite3.connect(database_file, timeout = 5, isolation_level = "EXCLUSIVE")
   cursor = connection.cursor()
@@ -319,8 +659,19 @@ class WorkflowDatabaseServer( object ):
     from engine import EngineTemporaryPath
     EngineTemporaryPath.temporary_directory = self._shared_temp_dir
 
+    # the write requests are serialized, the read requests are run 
+    # concurrently in deferred transactions
     self._lock = threading.RLock()
 
+    # connection of each thread to the database (see _connect)
+    self._thread_connections = threading.local()
+
+    # dictionary: thread -> ThreadConnection
+    # all the connections which are open, so that they are closed when their
+    # thread ends (see _close_connections)
+    self._connections = {}
+    self._connections_lock = threading.Lock()
+
     self.logger = logging.getLogger('jobServer')
 
     with self._lock:
@@ -343,7 +694,12 @@ class WorkflowDatabaseServer( object ):
             count = cursor.execute("SELECT count(*) FROM workflows WHERE "
                                   "queue=?", ["default queue"]).next()[0]
           elif unicode(version) != unicode(DB_VERSION):
-            raise Exception('Wrong db version')
+            self.logger.info("Database migration from version " + 
+                             repr(version) + " to " + repr(DB_VERSION))
+            version = migrate_database(connection, 
+                                       self._string_conversion(version))
+            if unicode(version) != unicode(DB_VERSION):
+              raise Exception('Wrong db version')
         except Exception, e:
           cursor.close()
           connection.close()
@@ -354,16 +710,73 @@ class WorkflowDatabaseServer( object ):
                               " " + repr(socket.gethostname()) + " (if it is not the current machine). \n  2. Delete"
                               " the file " + str(database_file)+" \n"
                               "  3. Clear the content of the directory: " + repr(tmp_file_dir_path))
+      self._set_journal_mode()
 
 
   def __del__(self):
     # send VACUUM command ?
-    pass
+    if getattr(self, "_connections", None) != None:
+      self.close_connections()
+
+  def close_connections(self):
+    '''
+    Closes the connections of all the threads to the database, when the 
+    database server is shut down.
+    '''
+    self._close_connections(ended_threads_only=False)
+
+  def _close_connections(self, ended_threads_only=True):
+    with self._connections_lock:
+      for thread, connection in self._connections.items():
+        if ended_threads_only and thread.is_alive():
+          continue
+        del self._connections[thread]
+        try:
+          connection.close_connection()
+        except sqlite3.Error, e:
+          self.logger.warning("Could not close a database connection: %s" % e)
 
 
-  def _connect(self):
+  def _set_journal_mode(self):
+    # the journal mode is persistent: it is stored in the database file
+    connection = self._connect()
     try:
-      connection = sqlite3.connect(self._database_file, timeout = 10, isolation_level = "EXCLUSIVE")
+      connection.execute("PRAGMA journal_mode=%s" % sqlite_journal_mode)
+    except Exception, e:
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+
+  def _connect(self, read_only=False):
+    '''
+    Returns the connection of the current thread to the database. It is 
+    opened at the first call and kept open for the next ones.
+
+    * read_only *boolean*
+      If True a deferred transaction is started: all the requests read the 
+      same state of the database until the connection is "closed", without 
+      blocking the writers.
+    '''
+    connection = getattr(self._thread_connections, "connection", None)
+    try:
+      if connection is None:
+        # the connections of the threads which ended are closed from another
+        # thread
+        self._close_connections()
+        connection = sqlite3.connect(self._database_file, 
+                                     timeout = 10, 
+                                     isolation_level = "EXCLUSIVE",
+                                     factory = ThreadConnection,
+                                     check_same_thread = False)
+        connection.execute("PRAGMA synchronous=%s" % sqlite_synchronous)
+        connection.execute("PRAGMA cache_size=%d" % sqlite_cache_size)
+        self._thread_connections.connection = connection
+        with self._connections_lock:
+          self._connections[threading.current_thread()] = connection
+      else:
+        # a method which raised an exception may have left a transaction 
+        # open
+        connection.rollback()
+      if read_only:
+        connection.execute("BEGIN DEFERRED")
     except Exception, e:
         raise DatabaseError('%s: %s \n' %(type(e), e))
     return connection
@@ -441,6 +854,14 @@ class WorkflowDatabaseServer( object ):
 
         cursor.execute('DELETE FROM jobs WHERE expiration_date < ?', [date.today()])
 
+        #########################################################################
+        # Workflows structure
+        for table in ["dependencies", "job_groups", "group_elements"]:
+          cursor.execute('''DELETE FROM %s WHERE workflow_id IN 
+                              (SELECT id FROM workflows 
+                               WHERE expiration_date < ?)''' % table,
+                         [date.today()])
+
         #########################################################################
         # Transfers
 
@@ -873,45 +1294,44 @@ class WorkflowDatabaseServer( object ):
     @returns: (engine_file_path, client_file_path, expiration_date, workflow_id, client_paths, transfer_type, status)
     '''
     self.logger.debug("=> get_transfer_information")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_transfer(connection, cursor, engine_file_path, user_id)
-      try:
-        (engine_file_path,
-         client_file_path,
-         expiration_date,
-         workflow_id,
-         client_paths,
-         transfer_type,
-         status) = cursor.execute('''SELECT
-                                  engine_file_path,
-                                  client_file_path,
-                                  expiration_date,
-                                  workflow_id,
-                                  client_paths,
-                                  transfer_type,
-                                  status
-                                  FROM transfers
-                                  WHERE engine_file_path=?''',
-                                  [engine_file_path]).next()
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-
-      engine_file_path = self._string_conversion(engine_file_path)
-      client_file_path = self._string_conversion(client_file_path)
-      expiration_date = self._str_to_date_conversion(expiration_date)
-      if client_paths:
-        client_paths = self._string_conversion(client_paths).split(file_separator)
-      else:
-        client_path = None
-      transfer_type = self._string_conversion(transfer_type)
-      status = self._string_conversion(status)
-
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_transfer(connection, cursor, engine_file_path, user_id)
+    try:
+      (engine_file_path,
+       client_file_path,
+       expiration_date,
+       workflow_id,
+       client_paths,
+       transfer_type,
+       status) = cursor.execute('''SELECT
+                                engine_file_path,
+                                client_file_path,
+                                expiration_date,
+                                workflow_id,
+                                client_paths,
+                                transfer_type,
+                                status
+                                FROM transfers
+                                WHERE engine_file_path=?''',
+                                [engine_file_path]).next()
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+
+    engine_file_path = self._string_conversion(engine_file_path)
+    client_file_path = self._string_conversion(client_file_path)
+    expiration_date = self._str_to_date_conversion(expiration_date)
+    if client_paths:
+      client_paths = self._string_conversion(client_paths).split(file_separator)
+    else:
+      client_path = None
+    transfer_type = self._string_conversion(transfer_type)
+    status = self._string_conversion(status)
+
+    cursor.close()
+    connection.close()
     return (engine_file_path,
             client_file_path,
             expiration_date,
@@ -934,37 +1354,36 @@ class WorkflowDatabaseServer( object ):
     @returns: (temp_path_id, engine_file_path, expiration_date, workflow_id, status)
     '''
     self.logger.debug("=> get_temporary_information")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_transfer(connection, cursor, engine_file_path, user_id)
-      try:
-        (engine_file_path,
-         client_file_path,
-         expiration_date,
-         workflow_id,
-         client_paths,
-         transfer_type,
-         status) = cursor.execute('''SELECT
-                                  temp_path_id,
-                                  engine_file_path,
-                                  expiration_date,
-                                  workflow_id,
-                                  status
-                                  FROM temporary_paths
-                                  WHERE temp_path_id=?''',
-                                  [temp_path_id]).next()
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-
-      engine_file_path = self._string_conversion(engine_file_path)
-      expiration_date = self._str_to_date_conversion(expiration_date)
-      status = self._string_conversion(status)
-
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_transfer(connection, cursor, engine_file_path, user_id)
+    try:
+      (engine_file_path,
+       client_file_path,
+       expiration_date,
+       workflow_id,
+       client_paths,
+       transfer_type,
+       status) = cursor.execute('''SELECT
+                                temp_path_id,
+                                engine_file_path,
+                                expiration_date,
+                                workflow_id,
+                                status
+                                FROM temporary_paths
+                                WHERE temp_path_id=?''',
+                                [temp_path_id]).next()
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+
+    engine_file_path = self._string_conversion(engine_file_path)
+    expiration_date = self._str_to_date_conversion(expiration_date)
+    status = self._string_conversion(status)
+
+    cursor.close()
+    connection.close()
     return (temp_path_id,
             engine_file_path,
             expiration_date,
@@ -981,19 +1400,18 @@ class WorkflowDatabaseServer( object ):
       return self.get_temporary_status(engine_file_path, user_id)
 
     self.logger.debug("=> get_transfer_status")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_transfer(connection, cursor, engine_file_path, user_id)
-      try:
-        status = cursor.execute('SELECT status FROM transfers WHERE engine_file_path=?', [engine_file_path]).next()[0]
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-      status = self._string_conversion(status)
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_transfer(connection, cursor, engine_file_path, user_id)
+    try:
+      status = cursor.execute('SELECT status FROM transfers WHERE engine_file_path=?', [engine_file_path]).next()[0]
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    status = self._string_conversion(status)
+    cursor.close()
+    connection.close()
 
     return status
 
@@ -1003,19 +1421,18 @@ class WorkflowDatabaseServer( object ):
     Returns the temporary path status stored in the database.
     '''
     self.logger.debug("=> get_temporary_status")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_temporary(connection, cursor, temp_path_id, user_id)
-      try:
-        status = cursor.execute('SELECT status FROM temporary_paths WHERE temp_path_id=?', [temp_path_id]).next()[0]
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-      status = self._string_conversion(status)
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_temporary(connection, cursor, temp_path_id, user_id)
+    try:
+      status = cursor.execute('SELECT status FROM temporary_paths WHERE temp_path_id=?', [temp_path_id]).next()[0]
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    status = self._string_conversion(status)
+    cursor.close()
+    connection.close()
 
     return status
 
@@ -1189,15 +1606,19 @@ class WorkflowDatabaseServer( object ):
                           name,
                           status,
                           last_status_update,
-                          queue)
-                          VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          queue,
+                          user_storage)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
                          (user_id,
                           None,
                           engine_workflow.expiration_date,
                           name,
                           constants.WORKFLOW_NOT_STARTED,
                           datetime.now(),
-                          engine_workflow.queue))
+                          engine_workflow.queue,
+                          sqlite3.Binary(pickle.dumps(
+                                            engine_workflow.user_storage,
+                                            pickle.HIGHEST_PROTOCOL))))
 
         engine_workflow.wf_id = cursor.lastrowid
 
@@ -1224,15 +1645,7 @@ class WorkflowDatabaseServer( object ):
           job_info.append((job.job_id, job.stdout_file, job.stderr_file))
           engine_workflow.registered_jobs[job.job_id] = job
 
-
-        pickled_workflow = pickle.dumps(engine_workflow)
-
-
-        cursor.execute('''UPDATE workflows
-                          SET pickled_engine_workflow=?
-                          WHERE id=?''',
-                        (pickled_workflow,
-                         engine_workflow.wf_id))
+        insert_workflow_structure(cursor, engine_workflow)
       except Exception, e:
         connection.rollback()
         cursor.close()
@@ -1298,38 +1711,132 @@ class WorkflowDatabaseServer( object ):
       cursor.close()
       connection.close()
 
-  def get_engine_workflow(self, wf_id, user_id):
+  def get_engine_workflow(self, wf_id, user_id, undone_jobs_only=False):
     '''
-    Returns a EngineWorkflow object.
+    Returns a EngineWorkflow object built back from the jobs, dependencies
+    and groups registered on the database.
     The wf_id must be valid.
 
     @type wf_id: C{WorflowIdentifier}
+    @type undone_jobs_only: boolean
+    @param undone_jobs_only: if True, the workflow only holds the jobs which
+    did not end with success (and the dependencies between them), which is
+    enough to restart or stop the workflow. The groups are not built.
     @rtype: C{EngineWorkflow}
     @return: workflow object
     '''
     self.logger.debug("=> get_engine_workflow")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_workflow(connection, cursor, wf_id, user_id)
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_workflow(connection, cursor, wf_id, user_id)
 
-      try:
-        pickled_workflow = cursor.execute('''SELECT
-                                              pickled_engine_workflow
-                                              FROM workflows WHERE id=?''', [wf_id]).next()[0]
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    request = '''SELECT id,
+                        status,
+                        drmaa_id,
+                        exit_status,
+                        exit_value,
+                        terminating_signal,
+                        resource_usage,
+                        pickled_engine_job
+                 FROM jobs WHERE workflow_id=?'''
+    request_args = [wf_id]
+    if undone_jobs_only:
+      request = request + ''' AND (status<>? OR
+                                     exit_status IS NULL OR
+                                     exit_status<>? OR
+                                     exit_value IS NULL OR
+                                     exit_value<>0 OR
+                                     terminating_signal IS NOT NULL)'''
+      request_args.extend([constants.DONE, constants.FINISHED_REGULARLY])
+
+    try:
+      (name, 
+       queue, 
+       expiration_date, 
+       status, 
+       user_storage) = cursor.execute('''SELECT name,
+                                                queue,
+                                                expiration_date,
+                                                status,
+                                                user_storage
+                                         FROM workflows WHERE id=?''',
+                                      [wf_id]).next()
+
+      jobs = {}
+      for row in cursor.execute(request, request_args):
+        (job_id, 
+         job_status, 
+         drmaa_id, 
+         exit_status, 
+         exit_value, 
+         terminating_signal, 
+         resource_usage, 
+         pickled_job) = row
+        job = unpickle_engine_job(pickled_job)
+        job.job_id = job_id
+        job.status = job_status
+        job.drmaa_id = self._string_conversion(drmaa_id)
+        job.exit_status = exit_status
+        job.exit_value = exit_value
+        job.terminating_signal = terminating_signal
+        job.str_rusage = resource_usage
+        jobs[job_id] = job
+
+      dependencies = []
+      for predecessor_id, successor_id in cursor.execute('''SELECT 
+                                                  predecessor_id,
+                                                  successor_id
+                                           FROM dependencies 
+                                           WHERE workflow_id=?''', 
+                                           [wf_id]):
+        if predecessor_id in jobs and successor_id in jobs:
+          dependencies.append((jobs[predecessor_id], jobs[successor_id]))
+
+      root_group = None
+      if not undone_jobs_only:
+        groups = {}
+        for group_id, group_name in cursor.execute('''SELECT id, name
+                                                   FROM job_groups
+                                                   WHERE workflow_id=?''',
+                                                   [wf_id]):
+          groups[group_id] = Group([], self._string_conversion(group_name))
+        root_group = []
+        for group_id, job_id, element_group_id in cursor.execute('''SELECT
+                                                  group_id,
+                                                  job_id,
+                                                  element_group_id
+                                           FROM group_elements
+                                           WHERE workflow_id=?
+                                           ORDER BY rank''',
+                                           [wf_id]):
+          if job_id is not None:
+            element = jobs[job_id]
+          else:
+            element = groups[element_group_id]
+          if group_id is None:
+            root_group.append(element)
+          else:
+            groups[group_id].elements.append(element)
+    except Exception, e:
       cursor.close()
       connection.close()
-
-    if pickled_workflow:
-      pickled_workflow = pickled_workflow.encode('utf-8')
-      workflow = pickle.loads(pickled_workflow)
-    else:
-      workflow = None
-
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
+
+    if user_storage is not None:
+      user_storage = pickle.loads(str(user_storage))
+
+    workflow = EngineWorkflow.from_registered_jobs(
+                  wf_id=wf_id,
+                  jobs=sorted(jobs.itervalues(), key=lambda job: job.job_id),
+                  dependencies=dependencies,
+                  root_group=root_group,
+                  queue=self._string_conversion(queue),
+                  expiration_date=self._str_to_date_conversion(expiration_date),
+                  name=self._string_conversion(name),
+                  status=status,
+                  user_storage=user_storage)
     return workflow
 
 
@@ -1381,27 +1888,60 @@ class WorkflowDatabaseServer( object ):
     (updated by L{DrmaaWorkflowEngine}) and the date of its last update.
     '''
     self.logger.debug("=> get_workflow_status")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_workflow(connection, cursor, wf_id, user_id)
-      try:
-        (status, strdate) = cursor.execute('''SELECT status,
-                                                    last_status_update
-                                              FROM workflows WHERE id=?''',
-                                              [wf_id]).next()
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-      status = self._string_conversion(status)
-      date = self._str_to_date_conversion(strdate)
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_workflow(connection, cursor, wf_id, user_id)
+    try:
+      (status, strdate) = cursor.execute('''SELECT status,
+                                                  last_status_update
+                                            FROM workflows WHERE id=?''',
+                                            [wf_id]).next()
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    status = self._string_conversion(status)
+    date = self._str_to_date_conversion(strdate)
+    cursor.close()
+    connection.close()
 
     return (status, date)
 
 
+  def get_workflows_status(self, workflow_ids, user_id):
+    '''
+    Returns the status stored in the database of several workflows and the 
+    dates of their last update, with one request per chunk of workflow ids.
+
+    @rtype: dictionary: workflow id -> (status, last status update)
+    @returns: the status of the workflows of workflow_ids which are valid and 
+    belong to the user.
+    '''
+    self.logger.debug("=> get_workflows_status")
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    result = {}
+    try:
+      # the user id is one of the request variables
+      for wf_ids in split_in_chunks(workflow_ids, 
+                                    sqlite_max_variable_number - 1):
+        for wf_id, status, strdate in cursor.execute(
+                              '''SELECT id, status, last_status_update
+                                 FROM workflows 
+                                 WHERE user_id=? AND id IN (%s)'''
+                                 % ",".join("?" * len(wf_ids)),
+                              [user_id] + wf_ids):
+          result[wf_id] = (self._string_conversion(status),
+                           self._str_to_date_conversion(strdate))
+    except Exception, e:
+      cursor.close()
+      connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
+
+    return result
+
 
   def get_detailed_workflow_status(self, wf_id):
     '''
@@ -1429,93 +1969,138 @@ class WorkflowDatabaseServer( object ):
                   )
     '''
     self.logger.debug("=> get_detailed_workflow_status")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
+    return self._get_workflow_elements_status(wf_id)[1]
 
-      try:
-        # workflow status
-        (wf_status, wf_queue) = cursor.execute('''SELECT
-                                      status,
-                                      queue
-                                      FROM workflows WHERE id=?''',
-                                      [wf_id]).next()#supposes that the wf_id is valid
-
-        workflow_status = ([],[], wf_status, wf_queue, [])
-        # jobs
-        for row in cursor.execute('''SELECT id,
-                                            status,
-                                            exit_status,
-                                            exit_value,
-                                            terminating_signal,
-                                            resource_usage,
-                                            submission_date,
-                                            execution_date,
-                                            ending_date,
-                                            queue
-                                     FROM jobs WHERE workflow_id=?''', [wf_id]):
-          job_id, status, exit_status, exit_value, term_signal, resource_usage, submission_date, execution_date, ending_date, queue = row
-
-          submission_date = self._str_to_date_conversion(submission_date)
-          execution_date = self._str_to_date_conversion(execution_date)
-          ending_date = self._str_to_date_conversion(ending_date)
-          queue = self._string_conversion(queue)
-
-
-          workflow_status[0].append((job_id, status, queue, (exit_status, exit_value, term_signal, resource_usage), (submission_date, execution_date, ending_date, queue)))
-
-        # transfers
-        for row in cursor.execute('''SELECT engine_file_path,
-                                            client_file_path,
-                                            client_paths,
-                                            status,
-                                            transfer_type
-                                     FROM transfers WHERE workflow_id=?''', [wf_id]):
-          (engine_file_path,
-           client_file_path,
-           client_paths,
-           status,
-           transfer_type) = row
-
-          engine_file_path = self._string_conversion(engine_file_path)
-          client_file_path = self._string_conversion(client_file_path)
-          status = self._string_conversion(status)
-          transfer_type = self._string_conversion(transfer_type)
-          if client_paths:
-            client_paths = self._string_conversion(client_paths).split(file_separator)
-          else:
-            client_paths = None
 
-          workflow_status[1].append((engine_file_path,
-                                     client_file_path,
-                                     client_paths,
-                                     status,
-                                     transfer_type))
+  def get_workflow_status_changes(self, wf_id, since_version=None):
+    '''
+    Gets back the status of the workflow elements which changed since the 
+    version since_version of the workflow. The transfers being transfered
+    are always returned since their progression changes without status 
+    change.
 
-        # temporary_paths
-        for row in cursor.execute('''SELECT temp_path_id,
-                                            engine_file_path,
-                                            status
-                                     FROM temporary_paths WHERE workflow_id=?''', [wf_id]):
-          (temp_path_id,
-           engine_file_path,
-           status) = row
+    @type since_version: int or None
+    @param since_version: version returned by a previous call. If None the 
+    status of all the elements is returned.
+    @rtype: tuple (version of the workflow, 
+                   status of the elements as returned by 
+                   get_detailed_workflow_status)
+    '''
+    self.logger.debug("=> get_workflow_status_changes")
+    return self._get_workflow_elements_status(wf_id, since_version)
 
-          engine_file_path = self._string_conversion(engine_file_path)
-          status = self._string_conversion(status)
 
-          workflow_status[4].append((temp_path_id,
-                                     engine_file_path,
-                                     status))
+  def _get_workflow_elements_status(self, wf_id, since_version=None):
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
 
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    try:
+      # the version is read first: the changes committed while the elements 
+      # are read will be sent again with the next version.
+      (wf_status, 
+       wf_queue,
+       version) = cursor.execute('''SELECT
+                                    status,
+                                    queue,
+                                    version
+                                    FROM workflows WHERE id=?''',
+                                    [wf_id]).next()#supposes that the wf_id is valid
+
+      if since_version == None:
+        job_condition = "workflow_id=?"
+        job_args = [wf_id]
+        transfer_condition = "workflow_id=?"
+        transfer_args = [wf_id]
+      else:
+        job_condition = "workflow_id=? AND version>?"
+        job_args = [wf_id, since_version]
+        transfer_condition = """workflow_id=? AND 
+                                (version>? OR status IN (?, ?))"""
+        transfer_args = [wf_id, 
+                         since_version, 
+                         constants.TRANSFERING_FROM_CLIENT_TO_CR,
+                         constants.TRANSFERING_FROM_CR_TO_CLIENT]
+
+      workflow_status = ([],[], wf_status, wf_queue, [])
+      # jobs
+      for row in cursor.execute('''SELECT id,
+                                          status,
+                                          exit_status,
+                                          exit_value,
+                                          terminating_signal,
+                                          resource_usage,
+                                          submission_date,
+                                          execution_date,
+                                          ending_date,
+                                          queue
+                                   FROM jobs WHERE %s''' % job_condition, 
+                                job_args):
+        job_id, status, exit_status, exit_value, term_signal, resource_usage, submission_date, execution_date, ending_date, queue = row
+
+        submission_date = self._str_to_date_conversion(submission_date)
+        execution_date = self._str_to_date_conversion(execution_date)
+        ending_date = self._str_to_date_conversion(ending_date)
+        queue = self._string_conversion(queue)
+
+
+        workflow_status[0].append((job_id, status, queue, (exit_status, exit_value, term_signal, resource_usage), (submission_date, execution_date, ending_date, queue)))
+
+      # transfers
+      for row in cursor.execute('''SELECT engine_file_path,
+                                          client_file_path,
+                                          client_paths,
+                                          status,
+                                          transfer_type
+                                   FROM transfers WHERE %s''' 
+                                   % transfer_condition, 
+                                transfer_args):
+        (engine_file_path,
+         client_file_path,
+         client_paths,
+         status,
+         transfer_type) = row
+
+        engine_file_path = self._string_conversion(engine_file_path)
+        client_file_path = self._string_conversion(client_file_path)
+        status = self._string_conversion(status)
+        transfer_type = self._string_conversion(transfer_type)
+        if client_paths:
+          client_paths = self._string_conversion(client_paths).split(file_separator)
+        else:
+          client_paths = None
+
+        workflow_status[1].append((engine_file_path,
+                                   client_file_path,
+                                   client_paths,
+                                   status,
+                                   transfer_type))
+
+      # temporary_paths
+      for row in cursor.execute('''SELECT temp_path_id,
+                                          engine_file_path,
+                                          status
+                                   FROM temporary_paths WHERE %s''' 
+                                   % job_condition, 
+                                job_args):
+        (temp_path_id,
+         engine_file_path,
+         status) = row
+
+        engine_file_path = self._string_conversion(engine_file_path)
+        status = self._string_conversion(status)
+
+        workflow_status[4].append((temp_path_id,
+                                   engine_file_path,
+                                   status))
+
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
 
-    return workflow_status
+    return (version, workflow_status)
 
 
   ###########################################
@@ -1540,29 +2125,28 @@ class WorkflowDatabaseServer( object ):
 
   def is_valid_job(self, job_id, user_id):
     self.logger.debug("=> is_valid_job")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      last_status_update = None
-      try:
-        count = cursor.execute('''SELECT count(*)
-                                  FROM jobs
-                                  WHERE id=? and
-                                        user_id=?''',
-                                  [job_id, user_id]).next()[0]
-
-        if count != 0:
-          last_status_update = cursor.execute('''SELECT last_status_update
-                                                 FROM jobs
-                                                 WHERE id=?''',
-                                                 [job_id]).next()[0]
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    last_status_update = None
+    try:
+      count = cursor.execute('''SELECT count(*)
+                                FROM jobs
+                                WHERE id=? and
+                                      user_id=?''',
+                                [job_id, user_id]).next()[0]
+
+      if count != 0:
+        last_status_update = cursor.execute('''SELECT last_status_update
+                                               FROM jobs
+                                               WHERE id=?''',
+                                               [job_id]).next()[0]
+    except Exception, e:
       cursor.close()
       connection.close()
-      last_status_update = self._str_to_date_conversion(last_status_update)
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
+    last_status_update = self._str_to_date_conversion(last_status_update)
     return (count != 0, last_status_update)
 
 
@@ -1693,15 +2277,11 @@ class WorkflowDatabaseServer( object ):
                           None, #terminating_signal,
                           None, #resource_usage,
 
-                          None #pickled_engine_job
+                          pickle_engine_job(engine_job)
                           ))
 
         job_id = cursor.lastrowid
         engine_job.job_id = job_id
-        if not engine_job.workflow_id or engine_job.workflow_id == -1:
-          pickled_engine_job = pickle.dumps(engine_job)
-          cursor.execute('UPDATE jobs SET pickled_engine_job=? WHERE id=?',
-                        (pickled_engine_job, job_id))
 
         for engine_path in referenced_input_files:
           cursor.execute('''INSERT INTO ios (job_id,
@@ -1755,27 +2335,24 @@ class WorkflowDatabaseServer( object ):
     @return: workflow object
     '''
     self.logger.debug("=> get_engine_job")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_job(connection, cursor, job_id, user_id)
-      try:
-        (pickled_job, workflow_id) = cursor.execute('''SELECT
-                                      pickled_engine_job,
-                                      workflow_id
-                                      FROM jobs WHERE id=?''', [job_id]).next()
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_job(connection, cursor, job_id, user_id)
+    try:
+      (pickled_job, workflow_id) = cursor.execute('''SELECT
+                                    pickled_engine_job,
+                                    workflow_id
+                                    FROM jobs WHERE id=?''', [job_id]).next()
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
 
-    if pickled_job:
-      pickled_job = pickled_job.encode('utf-8')
-      job = pickle.loads(pickled_job)
-    else:
-      job = None
+    job = unpickle_engine_job(pickled_job)
+    if job is not None:
+      job.job_id = job_id
 
     return (job, workflow_id)
 
@@ -1844,44 +2421,52 @@ class WorkflowDatabaseServer( object ):
   def set_jobs_status(self, job_status, force=False):
     '''
     job_status: dictionary: job_id -> status
+
+    The previous states of the jobs are fetched with one request per chunk 
+    of job ids and the updates are applied with executemany.
     '''
     self.logger.debug("=> set_jobs_status")
+    if not job_status:
+      return
     with self._lock:
       # TBI if the status is not valid raise an exception ??
       connection = self._connect()
       cursor = connection.cursor()
       try:
-        for job_id, status in job_status.iteritems():
-          count = cursor.execute('SELECT count(*) FROM jobs WHERE id=?', [job_id]).next()[0]
-          if not count == 0 :
-            (previous_status,
-            execution_date,
-            ending_date) = cursor.execute(''' SELECT status,
-                                                      execution_date,
-                                                      ending_date
-                                              FROM jobs WHERE id=?''',
-                                              [job_id]).next()#supposes that the job_id is valid
-            previous_status = self._string_conversion(previous_status)
-            execution_date = self._str_to_date_conversion(execution_date)
-            ending_date = self._str_to_date_conversion(ending_date)
-            if previous_status != status:
-              if not execution_date and status == constants.RUNNING:
-                execution_date = datetime.now()
-              if not ending_date and status == constants.DONE or \
-                status == constants.FAILED:
-                ending_date = datetime.now()
-                if not execution_date :
-                  execution_date = datetime.now()
-            if force or \
-              (previous_status != constants.DELETE_PENDING and \
-                previous_status != constants.KILL_PENDING):
-              cursor.execute('''UPDATE jobs SET status=?,
-                                                last_status_update=?,
-                                                execution_date=?,
-                                                ending_date=? WHERE id=?''',
-                                                (status, datetime.now(),
-                                                execution_date, ending_date,
-                                                job_id))
+        previous_states = []
+        for job_ids in split_in_chunks(job_status.iterkeys()):
+          previous_states.extend(cursor.execute(
+                          '''SELECT id, status, execution_date, ending_date
+                             FROM jobs WHERE id IN (%s)''' 
+                             % ",".join("?" * len(job_ids)),
+                          job_ids).fetchall())
+        now = datetime.now()
+        updates = []
+        for (job_id, 
+             previous_status, 
+             execution_date, 
+             ending_date) in previous_states:
+          status = job_status[job_id]
+          previous_status = self._string_conversion(previous_status)
+          # the dates are written back as they were read when they do not 
+          # change: no need to convert them
+          if previous_status != status:
+            if not execution_date and status == constants.RUNNING:
+              execution_date = now
+            if not ending_date and status == constants.DONE or \
+              status == constants.FAILED:
+              ending_date = now
+              if not execution_date :
+                execution_date = now
+          if force or \
+            (previous_status != constants.DELETE_PENDING and \
+              previous_status != constants.KILL_PENDING):
+            updates.append((status, now, execution_date, ending_date, job_id))
+        cursor.executemany('''UPDATE jobs SET status=?,
+                                              last_status_update=?,
+                                              execution_date=?,
+                                              ending_date=? WHERE id=?''',
+                           updates)
       except Exception, e:
         connection.rollback()
         cursor.close()
@@ -1955,25 +2540,24 @@ class WorkflowDatabaseServer( object ):
     other user.
     '''
     self.logger.debug("=> get_job_status")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_job(connection, cursor, job_id, user_id)
-      try:
-       (status,
-        strdate) = cursor.execute('''SELECT status, last_status_update
-                                     FROM jobs
-                                     WHERE id=?''',
-                                  [job_id]).next()
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_job(connection, cursor, job_id, user_id)
+    try:
+     (status,
+      strdate) = cursor.execute('''SELECT status, last_status_update
+                                   FROM jobs
+                                   WHERE id=?''',
+                                [job_id]).next()
 
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-      status = self._string_conversion(status)
-      date = self._str_to_date_conversion(strdate)
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    status = self._string_conversion(status)
+    date = self._str_to_date_conversion(strdate)
+    cursor.close()
+    connection.close()
 
     return (status, date)
 
@@ -2036,22 +2620,21 @@ class WorkflowDatabaseServer( object ):
     @return: DRMAA job identifier (job identifier on DRMS if submitted via DRMAA)
     '''
     self.logger.debug("=> get_drmaa_job_id")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      try:
-        count = cursor.execute('SELECT count(*) FROM jobs WHERE id=?', [job_id]).next()[0]
-        if not count == 0 :
-          drmaa_id = cursor.execute('SELECT drmaa_id FROM jobs WHERE id=?', [job_id]).next()[0] #supposes that the job_id is valid
-        else:
-          drmaa_id = None
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    try:
+      count = cursor.execute('SELECT count(*) FROM jobs WHERE id=?', [job_id]).next()[0]
+      if not count == 0 :
+        drmaa_id = cursor.execute('SELECT drmaa_id FROM jobs WHERE id=?', [job_id]).next()[0] #supposes that the job_id is valid
+      else:
+        drmaa_id = None
+    except Exception, e:
       cursor.close()
       connection.close()
-      return drmaa_id
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
+    return drmaa_id
 
   def get_std_out_err_file_path(self, job_id, user_id):
     '''
@@ -2063,35 +2646,34 @@ class WorkflowDatabaseServer( object ):
     @return: (stdout_file_path, stderr_file_path)
     '''
     self.logger.debug("=> get_std_out_err_file_path")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      try:
-        count = cursor.execute('''SELECT count(*)
-                                  FROM jobs
-                                  WHERE id=? and
-                                        user_id=?''',
-                               [job_id, user_id]).next()[0]
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    try:
+      count = cursor.execute('''SELECT count(*)
+                                FROM jobs
+                                WHERE id=? and
+                                      user_id=?''',
+                             [job_id, user_id]).next()[0]
 
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    except Exception, e:
+      cursor.close()
+      connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
 
 
-      if count == 0:
-        raise UnknownObjectError("The job id " + repr(job_id) + " is not "
-                                 "valid or does not belong to "
-                                 "user " + repr(user_id))
+    if count == 0:
+      raise UnknownObjectError("The job id " + repr(job_id) + " is not "
+                               "valid or does not belong to "
+                               "user " + repr(user_id))
 
-      try:
-        result = cursor.execute('SELECT stdout_file, stderr_file FROM jobs WHERE id=?', [job_id]).next()
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    try:
+      result = cursor.execute('SELECT stdout_file, stderr_file FROM jobs WHERE id=?', [job_id]).next()
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
     stdout_file_path = self._string_conversion(result[0])
     stderr_file_path = self._string_conversion(result[1])
     return (stdout_file_path, stderr_file_path)
@@ -2106,23 +2688,22 @@ class WorkflowDatabaseServer( object ):
     @return: (exit_status, exit_value, terminating_signal, resource_usage)
     '''
     self.logger.debug("=> get_job_exit_info")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      self._check_job(connection, cursor, job_id, user_id)
-      try:
-        result = cursor.execute('''SELECT exit_status,
-                                          exit_value,
-                                          terminating_signal,
-                                          resource_usage
-                                FROM jobs WHERE id=?''',
-                                [job_id]).next()
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    self._check_job(connection, cursor, job_id, user_id)
+    try:
+      result = cursor.execute('''SELECT exit_status,
+                                        exit_value,
+                                        terminating_signal,
+                                        resource_usage
+                              FROM jobs WHERE id=?''',
+                              [job_id]).next()
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
     exit_status = self._string_conversion(result[0])
     exit_value = result[1]
     terminating_signal = self._string_conversion(result[2])
@@ -2132,19 +2713,31 @@ class WorkflowDatabaseServer( object ):
 
 
   def set_jobs_exit_info(self, job_dict):
+    '''
+    job_dict: dictionary: job_id -> EngineJob
+
+    The updates are applied with executemany (updating an unknown job id 
+    has no effect).
+    '''
     self.logger.debug("=> set_jobs_exit_info")
+    if not job_dict:
+      return
     with self._lock:
       connection = self._connect()
       cursor = connection.cursor()
       try:
-        for job_id, job in job_dict.iteritems():
-          self.set_job_exit_info( job_id,
-                                  job.exit_status,
-                                  job.exit_value,
-                                  job.terminating_signal,
-                                  job.str_rusage,
-                                  cursor)
+        cursor.executemany('''UPDATE jobs SET exit_status=?,
+                                              exit_value=?,
+                                              terminating_signal=?,
+                                              resource_usage=?
+                                              WHERE id=?''',
+                           [(job.exit_status,
+                             job.exit_value,
+                             job.terminating_signal,
+                             job.str_rusage,
+                             job_id) for job_id, job in job_dict.iteritems()])
       except Exception, e:
+        connection.rollback()
         cursor.close()
         connection.close()
         raise DatabaseError('%s: %s \n' %(type(e), e))
@@ -2260,25 +2853,24 @@ class WorkflowDatabaseServer( object ):
       request = request + ")"
       argument = job_ids
 
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      result = {}
-      try:
-        for row in cursor.execute(request, argument):
-          jid, name, command, submission_date = row
-          result[jid]=(self._string_conversion(name),
-                       self._string_conversion(command),
-                       self._str_to_date_conversion(submission_date))
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    result = {}
+    try:
+      for row in cursor.execute(request, argument):
+        jid, name, command, submission_date = row
+        result[jid]=(self._string_conversion(name),
+                     self._string_conversion(command),
+                     self._str_to_date_conversion(submission_date))
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
 
-      return result
+    cursor.close()
+    connection.close()
+
+    return result
 
 
   def nb_queued_jobs(self, user_id, queue_name):
@@ -2291,33 +2883,32 @@ class WorkflowDatabaseServer( object ):
     @rtype: int
     '''
     self.logger.debug("=> nb_queued_jobs")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      try:
-        if queue_name != None:
-          count = cursor.execute("SELECT count(*) FROM jobs WHERE "
-                                 "user_id=? and ( status=? or status=?) "
-                                 "and queue=?",
-                                 [user_id,
-                                  constants.QUEUED_ACTIVE,
-                                  constants.UNDETERMINED,
-                                  queue_name]).next()[0]
-        else:
-          count = cursor.execute("SELECT count(*) FROM jobs WHERE "
-                                 "user_id=? and ( status=? or status=?) "
-                                 "and queue ISNULL",
-                                 [user_id,
-                                  constants.QUEUED_ACTIVE,
-                                  constants.UNDETERMINED]).next()[0]
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    try:
+      if queue_name != None:
+        count = cursor.execute("SELECT count(*) FROM jobs WHERE "
+                               "user_id=? and ( status=? or status=?) "
+                               "and queue=?",
+                               [user_id,
+                                constants.QUEUED_ACTIVE,
+                                constants.UNDETERMINED,
+                                queue_name]).next()[0]
+      else:
+        count = cursor.execute("SELECT count(*) FROM jobs WHERE "
+                               "user_id=? and ( status=? or status=?) "
+                               "and queue ISNULL",
+                               [user_id,
+                                constants.QUEUED_ACTIVE,
+                                constants.UNDETERMINED]).next()[0]
+    except Exception, e:
       cursor.close()
       connection.close()
-      return count
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+
+    cursor.close()
+    connection.close()
+    return count
 
 
   def jobs_to_delete_and_kill(self, user_id):
@@ -2329,30 +2920,29 @@ class WorkflowDatabaseServer( object ):
     @returns: job with status constants.DELETE_PENDING
     '''
     self.logger.debug("=> jobs_to_delete_and_kill")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      job_to_delete_ids = []
-      job_to_kill_ids = []
-      try:
-        for row in cursor.execute("SELECT id FROM jobs "
-                                  "WHERE user_id=? AND status=?",
-                                  [user_id, constants.DELETE_PENDING]):
-          jid = row[0]
-          job_to_delete_ids.append(jid)
-        for row in cursor.execute("SELECT id FROM jobs "
-                                  "WHERE user_id=? AND status=?",
-                                  [user_id, constants.KILL_PENDING]):
-          jid = row[0]
-          job_to_kill_ids.append(jid)
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    job_to_delete_ids = []
+    job_to_kill_ids = []
+    try:
+      for row in cursor.execute("SELECT id FROM jobs "
+                                "WHERE user_id=? AND status=?",
+                                [user_id, constants.DELETE_PENDING]):
+        jid = row[0]
+        job_to_delete_ids.append(jid)
+      for row in cursor.execute("SELECT id FROM jobs "
+                                "WHERE user_id=? AND status=?",
+                                [user_id, constants.KILL_PENDING]):
+        jid = row[0]
+        job_to_kill_ids.append(jid)
+    except Exception, e:
       cursor.close()
       connection.close()
-      return (job_to_delete_ids, job_to_kill_ids)
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+
+    cursor.close()
+    connection.close()
+    return (job_to_delete_ids, job_to_kill_ids)
 
 
 
@@ -2388,27 +2978,26 @@ class WorkflowDatabaseServer( object ):
       request = request + ")"
       argument = transfer_ids
 
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      result = {}
-      try:
-        for row in cursor.execute(request,argument):
-          engine_file, client_file_path, expiration_date, client_paths = row
-          engine_file = self._string_conversion(engine_file)
-          if client_paths:
-            client_paths = self._string_conversion(client_paths).split(file_separator)
-          else:
-            client_paths = None
-          result[engine_file] = (self._string_conversion(client_file_path),
-                                self._str_to_date_conversion(expiration_date),
-                                client_paths)
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    result = {}
+    try:
+      for row in cursor.execute(request,argument):
+        engine_file, client_file_path, expiration_date, client_paths = row
+        engine_file = self._string_conversion(engine_file)
+        if client_paths:
+          client_paths = self._string_conversion(client_paths).split(file_separator)
+        else:
+          client_paths = None
+        result[engine_file] = (self._string_conversion(client_file_path),
+                              self._str_to_date_conversion(expiration_date),
+                              client_paths)
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
     return result
 
 
@@ -2439,23 +3028,22 @@ class WorkflowDatabaseServer( object ):
       request = request + ")"
       argument = transfer_ids
 
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      result = {}
-      try:
-        for row in cursor.execute(request,argument):
-          temp_path_id, engine_file, expiration_date = row
-          if engine_file:
-            engine_file = self._string_conversion(engine_file)
-          result[temp_path_id] = (self._string_conversion(engine_file),
-                                self._str_to_date_conversion(expiration_date))
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    result = {}
+    try:
+      for row in cursor.execute(request,argument):
+        temp_path_id, engine_file, expiration_date = row
+        if engine_file:
+          engine_file = self._string_conversion(engine_file)
+        result[temp_path_id] = (self._string_conversion(engine_file),
+                              self._str_to_date_conversion(expiration_date))
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
     return result
 
 
@@ -2481,30 +3069,29 @@ class WorkflowDatabaseServer( object ):
 
   def is_valid_workflow(self, wf_id, user_id):
     self.logger.debug("=> is_valid_workflow")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      last_status_update = None
-      try:
-        count = cursor.execute('''SELECT count(*)
-                                  FROM workflows
-                                  WHERE id=? and
-                                        user_id=?''',
-                                  [wf_id, user_id]).next()[0]
-
-        if count != 0:
-          last_status_update = cursor.execute('''SELECT
-                                                 last_status_update
-                                                 FROM workflows
-                                                 WHERE id=?''',
-                                                 [wf_id]).next()[0]
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    last_status_update = None
+    try:
+      count = cursor.execute('''SELECT count(*)
+                                FROM workflows
+                                WHERE id=? and
+                                      user_id=?''',
+                                [wf_id, user_id]).next()[0]
+
+      if count != 0:
+        last_status_update = cursor.execute('''SELECT
+                                               last_status_update
+                                               FROM workflows
+                                               WHERE id=?''',
+                                               [wf_id]).next()[0]
+    except Exception, e:
       cursor.close()
       connection.close()
-      last_status_update = self._str_to_date_conversion(last_status_update)
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
+    last_status_update = self._str_to_date_conversion(last_status_update)
     return (count != 0, last_status_update)
 
 
@@ -2530,22 +3117,21 @@ class WorkflowDatabaseServer( object ):
       request = request + ")"
       argument = workflow_ids
 
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      result = {}
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    result = {}
 
-      try:
-        for row in cursor.execute(request, argument):
-          wf_id, name, expiration_date = row
-          result[wf_id] = (self._string_conversion(name),
-                          self._str_to_date_conversion(expiration_date))
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
+    try:
+      for row in cursor.execute(request, argument):
+        wf_id, name, expiration_date = row
+        result[wf_id] = (self._string_conversion(name),
+                        self._str_to_date_conversion(expiration_date))
+    except Exception, e:
       cursor.close()
       connection.close()
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+    cursor.close()
+    connection.close()
     return result
 
 
@@ -2558,30 +3144,29 @@ class WorkflowDatabaseServer( object ):
     @returns: workflows with status constants.DELETE_PENDING
     '''
     self.logger.debug("=> workflows_to_delete_and_kill")
-    with self._lock:
-      connection = self._connect()
-      cursor = connection.cursor()
-      wf_to_delete_ids = []
-      wf_to_kill_ids = []
-      try:
-        for row in cursor.execute("SELECT id FROM workflows "
-                                  "WHERE user_id=? AND status=?",
-                                  [user_id, constants.DELETE_PENDING]):
-          wf_id = row[0]
-          wf_to_delete_ids.append(wf_id)
-        for row in cursor.execute("SELECT id FROM workflows "
-                                  "WHERE user_id=? AND status=?",
-                                  [user_id, constants.KILL_PENDING]):
-          wf_id = row[0]
-          wf_to_kill_ids.append(wf_id)
-      except Exception, e:
-        cursor.close()
-        connection.close()
-        raise DatabaseError('%s: %s \n' %(type(e), e))
-
+    connection = self._connect(read_only=True)
+    cursor = connection.cursor()
+    wf_to_delete_ids = []
+    wf_to_kill_ids = []
+    try:
+      for row in cursor.execute("SELECT id FROM workflows "
+                                "WHERE user_id=? AND status=?",
+                                [user_id, constants.DELETE_PENDING]):
+        wf_id = row[0]
+        wf_to_delete_ids.append(wf_id)
+      for row in cursor.execute("SELECT id FROM workflows "
+                                "WHERE user_id=? AND status=?",
+                                [user_id, constants.KILL_PENDING]):
+        wf_id = row[0]
+        wf_to_kill_ids.append(wf_id)
+    except Exception, e:
       cursor.close()
       connection.close()
-      return (wf_to_delete_ids, wf_to_kill_ids)
+      raise DatabaseError('%s: %s \n' %(type(e), e))
+
+    cursor.close()
+    connection.close()
+    return (wf_to_delete_ids, wf_to_kill_ids)
 
 
   #######################################################################
@@ -24,6 +24,7 @@ import logging
 import stat, hashlib, operator
 import itertools
 import atexit
+import Queue
 
 #import cProfile
 #import traceback
@@ -34,15 +35,26 @@ from soma_workflow.client import WorkflowController
 from soma_workflow.errors import JobError, UnknownObjectError, EngineError, DRMError
 from soma_workflow.transfer import RemoteFileController
 from soma_workflow.configuration import Configuration
+from soma_workflow.scheduler import Scheduler
 
 #-----------------------------------------------------------------------------
 # Globals and constants
 #-----------------------------------------------------------------------------
 
+# the engine loop is woken up as soon as something happens (job status 
+# change notified by the scheduler, submission, deletion, end of transfer...).
+# The interval is only a fallback heartbeat.
 refreshment_interval = 1 #seconds
 # if the last status update is older than the refreshment_timeout 
 # the status is changed into WARNING
 refreshment_timeout = 60 #seconds
+# Only the job and workflow status which changed are written to the database.
+# The others are written again every status_heartbeat_interval seconds so 
+# that their last status update does not get out of date.
+status_heartbeat_interval = refreshment_timeout / 3 #seconds
+# The requests to the DRMS (job submissions and kills) are sent by a pool of
+# threads so that a slow DRMS does not hold the engine loop.
+drms_worker_nb = 4
 
 def _out_to_date(last_status_update):
   '''
@@ -108,6 +120,18 @@ class WorkflowEngineLoop(object):
   # jobs that couldn't be submitted. 
   # Dictionary queue name (str) => pending jobs (list) 
   _pending_queues = None
+  # Number of jobs of the engine queued on the DRMS (status QUEUED_ACTIVE or
+  # UNDETERMINED) in each queue, updated on each status change of the jobs.
+  # Dictionary queue name (str) => int
+  _nb_queued_jobs = None
+  # Queue in which each queued job is counted.
+  # Dictionary job_id => queue name (str)
+  _queued_jobs = None
+  # Number of jobs of the user queued in each queue which are not managed 
+  # by the engine, counted on the database server when the loop starts and 
+  # when a workflow is restarted.
+  # Dictionary queue name (str) => int
+  _nb_other_queued_jobs = None
   # boolean
   _running = None
   # boolean
@@ -115,8 +139,44 @@ class WorkflowEngineLoop(object):
 
   _lock = None
 
+  # threading.Event
+  # set to wake up the loop before the end of the time interval
+  _wakeup_event = None
+
+  # threading.Condition notified at the end of each iteration of the loop, 
+  # once the job and workflow status changes were written to the database 
+  # server
+  _iteration_ended = None
+
+  # number of iterations processed by the loop, guarded by _iteration_ended
+  _iteration_count = None
+
+  # date of the last time all the job and workflow status were written to 
+  # the database server
+  _last_status_heartbeat = None
+
+  # requests to the DRMS processed by the DRMS worker threads, the kills 
+  # first.
+  # Queue.PriorityQueue of tuple (priority, order, request)
+  # request: tuple (_SUBMIT, list of EngineJob) or (_KILL, scheduler job id),
+  # None to stop a worker
+  _drms_requests = None
+
+  _drms_request_order = None
+
+  # results of the job submissions done by the DRMS worker threads, 
+  # processed by the loop.
+  # Queue.Queue of tuple (list of EngineJob, dictionary job_id -> scheduler 
+  # job id, dictionary job_id -> DRMError)
+  _submission_results = None
+
+  _drms_workers = None
+
   logger = None
 
+  _KILL = 0
+  _SUBMIT = 1
+
   def __init__(self, 
                database_server, 
                scheduler, 
@@ -140,6 +200,10 @@ class WorkflowEngineLoop(object):
 
     self._pending_queues = {} 
 
+    self._nb_queued_jobs = {}
+    self._queued_jobs = {}
+    self._nb_other_queued_jobs = {}
+
     # The running flag is set to True at the beginning, not in start_loop(),
     # to overcome race conditions which may occur in this situation:
     # * intantiate a WorkflowEngineThread (wet)
@@ -167,6 +231,123 @@ class WorkflowEngineLoop(object):
 
     self._lock = threading.RLock()
 
+    self._wakeup_event = threading.Event()
+
+    self._iteration_ended = threading.Condition(threading.Lock())
+    self._iteration_count = 0
+
+    self._last_status_heartbeat = datetime.now()
+
+    self._drms_requests = Queue.PriorityQueue()
+    self._drms_request_order = itertools.count()
+    self._submission_results = Queue.Queue()
+    self._drms_workers = []
+    for i in range(drms_worker_nb):
+      worker = threading.Thread(name="drms_worker_%d" % i,
+                                target=self._drms_worker)
+      worker.setDaemon(True)
+      worker.start()
+      self._drms_workers.append(worker)
+
+    self._scheduler.addObserver(self, 
+                                "update_from_scheduler",
+                                [Scheduler.JOB_STATUS_CHANGED])
+
+  def wake_up(self):
+    '''
+    Makes the loop process a new iteration without waiting for the end of 
+    the time interval.
+    '''
+    self._wakeup_event.set()
+
+  def iteration_count(self):
+    '''
+    Number of iterations processed by the loop. The job and workflow status 
+    changes are written to the database server before the end of each 
+    iteration.
+    '''
+    with self._iteration_ended:
+      return self._iteration_count
+
+  def wait_iteration(self, iteration, timeout):
+    '''
+    Blocks until the loop ended an iteration following the iteration 
+    *iteration* (see iteration_count) or until timeout seconds elapsed.
+    '''
+    end_time = time.time() + timeout
+    with self._iteration_ended:
+      while self._iteration_count <= iteration:
+        remaining = end_time - time.time()
+        if remaining <= 0:
+          break
+        self._iteration_ended.wait(remaining)
+
+  def update_from_scheduler(self, observable, event, msg):
+    if event == Scheduler.JOB_STATUS_CHANGED:
+      self.wake_up()
+
+  def _update_queued_jobs(self, job):
+    '''
+    Updates the queue occupancy after a status change of the job.
+    '''
+    if job.job_id in self._queued_jobs:
+      queue_name = self._queued_jobs.pop(job.job_id)
+      self._nb_queued_jobs[queue_name] = self._nb_queued_jobs[queue_name] - 1
+    if job.status == constants.QUEUED_ACTIVE or \
+        job.status == constants.UNDETERMINED:
+      self._queued_jobs[job.job_id] = job.queue
+      self._nb_queued_jobs[job.queue] = \
+                                  self._nb_queued_jobs.get(job.queue, 0) + 1
+
+  def _count_other_queued_jobs(self):
+    '''
+    Counts the queued jobs of the user which are not managed by the engine 
+    on the database server.
+    '''
+    with self._lock:
+      for queue_name in self._queue_limits:
+        nb_queued_jobs = self._database_server.nb_queued_jobs(self._user_id, 
+                                                              queue_name)
+        self._nb_other_queued_jobs[queue_name] = max(0, 
+               nb_queued_jobs - self._nb_queued_jobs.get(queue_name, 0))
+
+  def _drms_worker(self):
+    '''
+    Sends the requests of _drms_requests to the scheduler, without holding 
+    the engine lock. Run by each DRMS worker thread.
+    '''
+    while True:
+      request = self._drms_requests.get()[2]
+      if request == None:
+        break
+      action, argument = request
+      if action == WorkflowEngineLoop._KILL:
+        try:
+          self._scheduler.kill_job(argument)
+        except Exception, e:
+          # the worker must survive: the other requests still have to be 
+          # processed
+          #TBI how to communicate the error
+          self.logger.error("!!!ERROR!!! job kill %s:%s" %(type(e), e))
+      else:
+        jobs = argument
+        try:
+          (scheduler_job_ids, 
+           errors) = self._scheduler.jobs_submission(jobs)
+        except Exception, e:
+          # the jobs must not stay submitted forever
+          self.logger.error("!!!ERROR!!! job submission %s:%s" %(type(e), e))
+          scheduler_job_ids = {}
+          errors = dict((job.job_id, DRMError("%s: %s" %(type(e), e)))
+                        for job in jobs)
+        self._submission_results.put((jobs, scheduler_job_ids, errors))
+        self.wake_up()
+
+  def _send_drms_request(self, action, argument):
+    self._drms_requests.put((action, 
+                             self._drms_request_order.next(), 
+                             (action, argument)))
+
   def are_jobs_and_workflow_done(self):
     with self._lock:
       ended = len(self._jobs) == 0 and len(self._workflows) == 0
@@ -175,6 +356,8 @@ class WorkflowEngineLoop(object):
   def start_loop(self, time_interval):
     '''
     Start the workflow engine loop. The loop will run until stop() is called.
+    An iteration is processed each time the loop is woken up (see wake_up) 
+    and at least every time_interval seconds.
     '''
     #one_wf_processed = False
     # Modif: don't set the running flag here, because the loop may be already
@@ -183,6 +366,7 @@ class WorkflowEngineLoop(object):
     #self._running = True
     drms_error_jobs = {}
     idle_cmpt = 0
+    self._count_other_queued_jobs()
     while True:
       if not self._running:
         break
@@ -251,6 +435,49 @@ class WorkflowEngineLoop(object):
               wf_to_inspect.add(wf_id)
         
         # --- 2. Update job status from the scheduler -------------------------------
+        # get back the results of the submissions done by the DRMS workers
+        drmaa_id_for_db_up = {}
+        while True:
+          try:
+            (submitted_jobs,
+             scheduler_job_ids,
+             submission_errors) = self._submission_results.get_nowait()
+          except Queue.Empty:
+            break
+          for job in submitted_jobs:
+            if job.exit_status == constants.USER_KILLED:
+              # killed during its submission
+              if job.job_id in scheduler_job_ids:
+                self._send_drms_request(WorkflowEngineLoop._KILL,
+                                        scheduler_job_ids[job.job_id])
+            elif job.job_id in submission_errors or \
+                job.job_id not in scheduler_job_ids:
+              e = submission_errors.get(job.job_id,
+                             DRMError("No scheduler id for the job %s" 
+                                      %(repr(job.job_id))))
+              #Resubmission ?
+              #if job.queue in self._pending_queues:
+              #  self._pending_queues[job.queue].insert(0, job)
+              #else:
+              #  self._pending_queues[job.queue] = [job]
+              #job.status = constants.SUBMISSION_PENDING
+              self.logger.debug("job %s !!!ERROR!!! %s: %s" %(repr(job.command), type(e), e))
+              job.status = constants.FAILED
+              job.exit_status = constants.EXIT_ABORTED
+              self._update_queued_jobs(job)
+              stderr_file = open(job.stderr_file, "wa")
+              stderr_file.write("Error while submitting the job %s: %s\n" %(type(e),e))
+              stderr_file.close()
+              ended_jobs[job.job_id] = job
+              if job.workflow_id != -1: 
+                wf_to_inspect.add(job.workflow_id)
+            else:
+              job.drmaa_id = scheduler_job_ids[job.job_id]
+              drmaa_id_for_db_up[job.job_id] = job.drmaa_id
+        if drmaa_id_for_db_up:
+          self._database_server.set_submission_information(drmaa_id_for_db_up,
+                                                          datetime.now())  
+
         # get back the termination status and terminate the jobs which ended 
         
         wf_jobs = {}
@@ -261,52 +488,53 @@ class WorkflowEngineLoop(object):
           wf_jobs.update(wf.registered_jobs)
           wf_transfers.update(wf.registered_tr)
 
-        for job in itertools.chain(self._jobs.itervalues(), wf_jobs.itervalues()):
-          if job.exit_status == None and job.drmaa_id != None:
-            try:
-              job.status = self._scheduler.get_job_status(job.drmaa_id)
-            except DRMError, e:
-              self.logger.debug("!!!ERROR!!! get_job_status %s: %s" %(type(e), e))
-              job.status = constants.FAILED
-              job.exit_status = constants.EXIT_ABORTED
-              stderr_file = open(job.stderr_file, "wa")
-              stderr_file.write("Error while requesting the job status %s: %s \nWarning: the job may still be running.\n" %(type(e),e))
-              stderr_file.close()
-              drms_error_jobs[job.job_id] = job
-            self.logger.debug("job " + repr(job.job_id) + " : " + job.status)
-            if job.status == constants.DONE or job.status == constants.FAILED:
-              self.logger.debug("End of job %s, drmaaJobId = %s, status= %s", 
-                                job.job_id, job.drmaa_id, repr(job.status))
-              (job.exit_status, 
-              job.exit_value, 
-              job.terminating_signal, 
-              job.str_rusage) = self._scheduler.get_job_exit_info(job.drmaa_id)
-              
-              self.logger.debug("  after get_job_exit_info ")             
-              self.logger.debug("  => exit_status " + repr(job.exit_status))
-              self.logger.debug("  => exit_value " + repr(job.exit_value))
-              self.logger.debug("  => signal " + repr(job.terminating_signal))  
-              self.logger.debug("  => rusage "+repr(job.str_rusage))             
-
-  
-              if job.workflow_id != -1: 
-                wf_to_inspect.add(job.workflow_id)
-              if job.status == constants.DONE:
-                for ft in job.referenced_output_files:
-                  if isinstance(ft, FileTransfer):
-                    engine_path = job.transfer_mapping[ft].engine_path
-                    self._database_server.set_transfer_status(engine_path,
-                                                    constants.FILES_ON_CR)
-                  else:
-                    # TemporaryPath
-                    temp_path_id = job.transfer_mapping[ft].temp_path_id
-                    self._database_server.set_temporary_status(temp_path_id,
-                                                    constants.FILES_ON_CR)
-
-              ended_jobs[job.job_id] = job
-              self.logger.debug("  => exit_status " + repr(job.exit_status))
-              self.logger.debug("  => exit_value " + repr(job.exit_value))
-              self.logger.debug("  => signal " + repr(job.terminating_signal))
+        # the status of all the submitted jobs which did not end is requested 
+        # at once 
+        submitted_jobs = [job for job in itertools.chain(
+                                                    self._jobs.itervalues(),
+                                                    wf_jobs.itervalues())
+                          if job.exit_status == None and job.drmaa_id != None]
+        (scheduler_status, 
+         scheduler_errors) = self._scheduler.get_jobs_status(
+                                [job.drmaa_id for job in submitted_jobs])
+        for job in submitted_jobs:
+          if job.drmaa_id in scheduler_errors:
+            e = scheduler_errors[job.drmaa_id]
+            self.logger.debug("!!!ERROR!!! get_job_status %s: %s" %(type(e), e))
+            job.status = constants.FAILED
+            job.exit_status = constants.EXIT_ABORTED
+            stderr_file = open(job.stderr_file, "wa")
+            stderr_file.write("Error while requesting the job status %s: %s \nWarning: the job may still be running.\n" %(type(e),e))
+            stderr_file.close()
+            drms_error_jobs[job.job_id] = job
+          else:
+            job.status = scheduler_status.get(job.drmaa_id, job.status)
+          self._update_queued_jobs(job)
+          self.logger.debug("job " + repr(job.job_id) + " : " + job.status)
+          if job.status == constants.DONE or job.status == constants.FAILED:
+            self.logger.debug("End of job %s, drmaaJobId = %s, status= %s", 
+                              job.job_id, job.drmaa_id, repr(job.status))
+            (job.exit_status, 
+            job.exit_value, 
+            job.terminating_signal, 
+            job.str_rusage) = self._scheduler.get_job_exit_info(job.drmaa_id)
+            
+            self.logger.debug("  after get_job_exit_info ")             
+            self.logger.debug("  => exit_status " + repr(job.exit_status))
+            self.logger.debug("  => exit_value " + repr(job.exit_value))
+            self.logger.debug("  => signal " + repr(job.terminating_signal))  
+            self.logger.debug("  => rusage "+repr(job.str_rusage))             
+
+
+            if job.workflow_id != -1: 
+              wf_to_inspect.add(job.workflow_id)
+            if job.status == constants.DONE:
+              self._output_files_on_cr(job)
+
+            ended_jobs[job.job_id] = job
+            self.logger.debug("  => exit_status " + repr(job.exit_status))
+            self.logger.debug("  => exit_value " + repr(job.exit_value))
+            self.logger.debug("  => signal " + repr(job.terminating_signal))
 
 
         # --- 3. Get back transfered status ----------------------------------
@@ -322,15 +550,24 @@ class WorkflowEngineLoop(object):
 
         # --- 4. Inspect workflows -------------------------------------------
         self.logger.debug("wf_to_inspect " + repr(wf_to_inspect))
+        wf_ended_jobs = {}
+        for job in ended_jobs.itervalues():
+          if job.workflow_id != -1:
+            wf_ended_jobs.setdefault(job.workflow_id, []).append(job)
         for wf_id in wf_to_inspect:
           (to_run, 
           aborted_jobs, 
-          status) = self._workflows[wf_id].find_out_jobs_to_process()
+          status) = self._workflows[wf_id].find_out_jobs_to_process(
+                                            wf_ended_jobs.get(wf_id, []))
           self.logger.debug("to_run=" + repr(to_run)+" aborted_jobs="+repr(aborted_jobs))
           self._workflows[wf_id].status = status
           self.logger.debug("NEW status wf " + repr(wf_id) + " " + repr(status))
           #jobs_to_run.extend(to_run)
           ended_jobs.update(aborted_jobs)
+          for job in aborted_jobs.itervalues():
+            if job.status == constants.DONE:
+              # barrier job
+              self._output_files_on_cr(job)
           for job in to_run:
             self._pend_for_submission(job)
 
@@ -341,40 +578,34 @@ class WorkflowEngineLoop(object):
         self.logger.debug("len(jobs_to_run)="+repr(len(jobs_to_run)))
      
         # --- 6. Submit jobs -------------------------------------------------
-        drmaa_id_for_db_up = {}
-        for job in jobs_to_run:
-            try:
-              job.drmaa_id = self._scheduler.job_submission(job)
-            except DRMError, e:
-              #Resubmission ?
-              #if job.queue in self._pending_queues:
-              #  self._pending_queues[job.queue].insert(0, job)
-              #else:
-              #  self._pending_queues[job.queue] = [job]
-              #job.status = constants.SUBMISSION_PENDING
-              self.logger.debug("job %s !!!ERROR!!! %s: %s" %(repr(job.command), type(e), e))
-              job.status = constants.FAILED
-              job.exit_status = constants.EXIT_ABORTED
-              stderr_file = open(job.stderr_file, "wa")
-              stderr_file.write("Error while submitting the job %s: %s\n" %(type(e),e))
-              stderr_file.close()
-              drms_error_jobs[job.job_id] = job
-            else:
-              drmaa_id_for_db_up[job.job_id] = job.drmaa_id
-              job.status = constants.UNDETERMINED
-
-        if drmaa_id_for_db_up:
-          self._database_server.set_submission_information(drmaa_id_for_db_up,
-                                                          datetime.now())  
+        # the jobs are sent to the DRMS workers, split so that the workers
+        # share them. The results are processed by the next iterations.
+        if jobs_to_run:
+          chunk_size = -(-len(jobs_to_run) // len(self._drms_workers))
+          for i in range(0, len(jobs_to_run), chunk_size):
+            self._send_drms_request(WorkflowEngineLoop._SUBMIT,
+                                    jobs_to_run[i:i + chunk_size])
+          for job in jobs_to_run:
+            job.status = constants.UNDETERMINED
+            self._update_queued_jobs(job)
    
         # --- 7. Update the workflow and jobs status to the database_server -
+        # only the status which changed are written, except for the heartbeat
         ended_job_ids = []
         ended_wf_ids = []
         self.logger.debug("update job and wf status ~~~~~~~~~~~~~~~ ")
+        heartbeat = datetime.now() - self._last_status_heartbeat > \
+                      timedelta(seconds=status_heartbeat_interval)
+        if heartbeat:
+          self._last_status_heartbeat = datetime.now()
         job_status_for_db_up = {}
+        dirty_jobs = []
         for job_id, job in itertools.chain(self._jobs.iteritems(),
                                           wf_jobs.iteritems()):
-          job_status_for_db_up[job_id] = job.status
+          if heartbeat or job.is_dirty():
+            job_status_for_db_up[job_id] = job.status
+            dirty_jobs.append(job)
+            self.logger.debug("job " + repr(job_id) + " " + repr(job.status))
           self._j_wf_ended = self._j_wf_ended and \
                                     (job.status == constants.DONE or \
                                     job.status == constants.FAILED)
@@ -382,16 +613,19 @@ class WorkflowEngineLoop(object):
               (job.status == constants.DONE or \
                 job.status == constants.FAILED):
             ended_job_ids.append(job_id)
-          self.logger.debug("job " + repr(job_id) + " " + repr(job.status))
        
         if job_status_for_db_up:
           self._database_server.set_jobs_status(job_status_for_db_up)
+          for job in dirty_jobs:
+            job.mark_stored()
 
         if len(ended_jobs):
           self._database_server.set_jobs_exit_info(ended_jobs)
 
         for wf_id, workflow in self._workflows.iteritems():
-          self._database_server.set_workflow_status(wf_id, workflow.status)
+          if heartbeat or workflow.is_dirty():
+            self._database_server.set_workflow_status(wf_id, workflow.status)
+            workflow.mark_stored()
           if workflow.status == constants.WORKFLOW_DONE:
             ended_wf_ids.append(wf_id)
           self.logger.debug("wf " + repr(wf_id) + " " + repr(workflow.status))
@@ -400,24 +634,38 @@ class WorkflowEngineLoop(object):
         for job_id in ended_job_ids: del self._jobs[job_id]
         for wf_id in ended_wf_ids: del self._workflows[wf_id]
 
+      # the status changes are on the database server: wake up the threads
+      # waiting for them (see WorkflowEngine.wait_job for example)
+      with self._iteration_ended:
+        self._iteration_count = self._iteration_count + 1
+        self._iteration_ended.notifyAll()
+
       #if len(self._workflows) == 0 and one_wf_processed: 
       #  break
-      time.sleep(time_interval)
+      self._wakeup_event.wait(time_interval)
+      self._wakeup_event.clear()
 
     
   def stop_loop(self):
     with self._lock:
         self._running = False
+    self.wake_up()
+    for worker in self._drms_workers:
+      self._drms_requests.put((WorkflowEngineLoop._SUBMIT + 1, 0, None))
 
   def set_queue_limits(self, queue_limits):
     with self._lock:
       self._queue_limits = queue_limits
+    self._count_other_queued_jobs()
+    self.wake_up()
 
   def add_job(self, client_job, queue):
     # register
+    parallel_info = self._scheduler.parallel_job_submission_info
     engine_job = EngineJob(client_job=client_job, 
                            queue=queue, 
-                           path_translation=self._path_translation)
+                           path_translation=self._path_translation,
+                           parallel_job_submission_info=parallel_info)
                           
 
     engine_job = self._database_server.add_job(self._user_id, engine_job)
@@ -454,10 +702,38 @@ class WorkflowEngineLoop(object):
     # add to the engine managed job list
     with self._lock:
       self._jobs[engine_job.job_id] = engine_job
+    self.wake_up()
 
     return engine_job
 
 
+  def _output_files_on_cr(self, job):
+    '''
+    The output files of a job which ended with success are on the computing
+    resource.
+    '''
+    for ft in job.referenced_output_files:
+      if isinstance(ft, FileTransfer):
+        engine_path = job.transfer_mapping[ft].engine_path
+        self._database_server.set_transfer_status(engine_path,
+                                                  constants.FILES_ON_CR)
+      else:
+        # TemporaryPath
+        temp_path_id = job.transfer_mapping[ft].temp_path_id
+        self._database_server.set_temporary_status(temp_path_id,
+                                                   constants.FILES_ON_CR)
+
+  def _end_barriers(self, workflow):
+    '''
+    Writes the end of the barrier jobs which ended while the workflow was 
+    started or restarted. (The job status are written by the loop.)
+    '''
+    ended_barriers = workflow.pop_ended_barriers()
+    for job in ended_barriers.itervalues():
+      self._output_files_on_cr(job)
+    if ended_barriers:
+      self._database_server.set_jobs_exit_info(ended_barriers)
+
   def _pend_for_submission(self, engine_job):
     '''
     All the job submission are actually done in the loop (start_loop method).
@@ -482,8 +758,8 @@ class WorkflowEngineLoop(object):
     to_run = []
     for queue_name, jobs in self._pending_queues.iteritems():
       if jobs and queue_name in self._queue_limits:
-        nb_queued_jobs = self._database_server.nb_queued_jobs(self._user_id, 
-                                                              queue_name)
+        nb_queued_jobs = self._nb_queued_jobs.get(queue_name, 0) + \
+                         self._nb_other_queued_jobs.get(queue_name, 0)
         nb_jobs_to_run = self._queue_limits[queue_name] - nb_queued_jobs
         self.logger.debug("queue " + repr(queue_name) + " nb_queued_jobs " + repr(nb_queued_jobs) + " nb_jobs_to_run " + repr(nb_jobs_to_run))
         while nb_jobs_to_run > 0 and \
@@ -510,7 +786,8 @@ class WorkflowEngineLoop(object):
                                      self._path_translation,
                                      queue,
                                      expiration_date,
-                                     name)
+                                     name,
+                                     self._scheduler.parallel_job_submission_info)
    
     engine_workflow = self._database_server.add_workflow(self._user_id, engine_workflow)
 
@@ -546,11 +823,13 @@ class WorkflowEngineLoop(object):
     # submit independant jobs
     (jobs_to_run, 
      engine_workflow.status) = engine_workflow.find_out_independant_jobs()
+    self._end_barriers(engine_workflow)
     for job in jobs_to_run:
       self._pend_for_submission(job)
     # add to the engine managed workflow list
     with self._lock:
       self._workflows[engine_workflow.wf_id] = engine_workflow
+    self.wake_up()
 
     return engine_workflow.wf_id
 
@@ -561,11 +840,7 @@ class WorkflowEngineLoop(object):
       with self._lock:
         if job.drmaa_id:
           self.logger.debug("Kill job " + repr(job_id) + " drmaa id: " + repr(job.drmaa_id) + " status " + repr(job.status))
-          try:
-            self._scheduler.kill_job(job.drmaa_id)
-          except DRMError, e:
-            #TBI how to communicate the error
-            self.logger.error("!!!ERROR!!! %s:%s" %(type(e), e))
+          self._send_drms_request(WorkflowEngineLoop._KILL, job.drmaa_id)
         elif job.queue in self._pending_queues and \
             job in self._pending_queues[job.queue]:
           self._pending_queues[job.queue].remove(job)
@@ -574,6 +849,7 @@ class WorkflowEngineLoop(object):
         job.exit_value = None
         job.terminating_signal = None
         job.str_rusage = None
+        self._update_queued_jobs(job)
 
         return True
     
@@ -597,27 +873,46 @@ class WorkflowEngineLoop(object):
       workflow.queue = queue
       (jobs_to_run, 
        workflow.status) = workflow.restart(self._database_server, queue)
+      self._end_barriers(workflow)
+      # the job status and queues were read again from the database server
+      with self._lock:
+        for job in workflow.registered_jobs.itervalues():
+          self._update_queued_jobs(job)
+      self._count_other_queued_jobs()
       for job in jobs_to_run:
         self._pend_for_submission(job)
+      self.wake_up()
     else:
-      workflow = self._database_server.get_engine_workflow(wf_id, self._user_id)
+      # the jobs which ended with success are not loaded
+      workflow = self._database_server.get_engine_workflow(
+                                                  wf_id,
+                                                  self._user_id,
+                                                  undone_jobs_only=True)
       workflow.status = status
       (jobs_to_run, workflow.status) = workflow.restart(self._database_server, queue)
+      self._end_barriers(workflow)
       for job in jobs_to_run:
         self._pend_for_submission(job)
       # add to the engine managed workflow list
       with self._lock:
         self._workflows[wf_id] = workflow
+        for job in workflow.registered_jobs.itervalues():
+          self._update_queued_jobs(job)
+      self._count_other_queued_jobs()
+      self.wake_up()
 
   def force_stop(self, wf_id):
     if wf_id in self._workflows:
       pass
     else:
-      workflow = self._database_server.get_engine_workflow(wf_id,
-                                                           self._user_id)
+      workflow = self._database_server.get_engine_workflow(
+                                                  wf_id,
+                                                  self._user_id,
+                                                  undone_jobs_only=True)
       workflow.force_stop(self._database_server)
       with self._lock:
         self._workflows[wf_id] = workflow
+      self.wake_up()
       
 
 
@@ -630,6 +925,7 @@ class WorkflowEngineLoop(object):
       # add to the engine managed job list
       with self._lock:
         self._jobs[job.job_id] = job
+      self.wake_up()
     else:
       
       pass
@@ -659,7 +955,8 @@ class WorkflowEngine(RemoteFileController):
            L{soma_workflow.database_server.WorkflowDatabaseServer}
     @type  engine_loop: L{WorkflowEngineLoop}
     '''
-    
+    super(WorkflowEngine, self).__init__()
+
     self.logger = logging.getLogger('engine.WorkflowEngine')
     
     self._database_server= database_server
@@ -745,6 +1042,7 @@ class WorkflowEngine(RemoteFileController):
     '''
     if workflow_id != -1:
       self._database_server.add_workflow_ended_transfer(workflow_id, engine_path)
+      self.engine_loop.wake_up()
     
 
   ########## JOB SUBMISSION ##################################################
@@ -773,6 +1071,7 @@ class WorkflowEngine(RemoteFileController):
       return True
     else:
       self._database_server.set_job_status(job_id, constants.DELETE_PENDING)
+      self.engine_loop.wake_up()
       if force and not self._wait_for_job_deletion(job_id):
         self.logger.critical("!! The job may not be properly deleted !!")
         self._database_server.delete_job(job_id)
@@ -814,6 +1113,7 @@ class WorkflowEngine(RemoteFileController):
       
       self._database_server.set_workflow_status(workflow_id, 
                                                 constants.DELETE_PENDING)
+      self.engine_loop.wake_up()
       if force and not self._wait_for_wf_deletion(workflow_id):
         self.logger.critical("The workflow may not be properly deleted.")
         self._database_server.delete_workflow(workflow_id)
@@ -833,6 +1133,7 @@ class WorkflowEngine(RemoteFileController):
       else:
         self._database_server.set_workflow_status(workflow_id, 
                                                   constants.KILL_PENDING)
+        self.engine_loop.wake_up()
         self._wait_wf_status_update(workflow_id, 
                                     expected_status = constants.WORKFLOW_DONE)
 
@@ -928,6 +1229,23 @@ class WorkflowEngine(RemoteFileController):
       return constants.WARNING
 
     return status
+
+
+  def workflows_status(self, workflow_ids):
+    '''
+    Implementation of soma_workflow.client.WorkflowController API
+    '''
+    workflows_status = {}
+    for wf_id, (status, 
+                last_status_update) in self._database_server.get_workflows_status(
+                                              workflow_ids, 
+                                              self._user_id).iteritems():
+      if status and \
+         not status == constants.WORKFLOW_DONE and \
+         _out_to_date(last_status_update):
+        status = constants.WARNING
+      workflows_status[wf_id] = status
+    return workflows_status
     
   
   def workflow_elements_status(self, wf_id, groupe = None):
@@ -945,6 +1263,26 @@ class WorkflowEngine(RemoteFileController):
       wf_status = (wf_status[0], wf_status[1], constants.WARNING, wf_status[3], wf_status[4])
     
     return wf_status
+
+
+  def workflow_elements_status_changes(self, wf_id, since_version=None):
+    '''
+    Implementation of soma_workflow.client.WorkflowController API
+    '''
+    (status, 
+     last_status_update) = self._database_server.get_workflow_status(wf_id,
+                                                                  self._user_id)
+    
+    (version, 
+     wf_status) = self._database_server.get_workflow_status_changes(
+                                                                wf_id, 
+                                                                since_version)
+    if status and \
+       not status == constants.WORKFLOW_DONE and \
+       _out_to_date(last_status_update):
+      wf_status = (wf_status[0], wf_status[1], constants.WARNING, wf_status[3], wf_status[4])
+    
+    return (version, wf_status)
         
         
   def transfer_status(self, engine_path):
@@ -980,17 +1318,20 @@ class WorkflowEngine(RemoteFileController):
     '''    
     self.logger.debug("        waiting...")
     
-    waitForever = timeout < 0
-    startTime = datetime.now()
+    end_time = None
+    if timeout >= 0:
+      end_time = time.time() + timeout
     for jid in job_ids:
+      iteration = self.engine_loop.iteration_count()
       (status, 
        last_status_update) = self._database_server.get_job_status(jid, 
                                                                   self._user_id)
       if status:
         self.logger.debug("wait        job %s status: %s", jid, status)
-        delta = datetime.now()-startTime
-        while status and not status == constants.DONE and not status == constants.FAILED and (waitForever or delta < timedelta(seconds=timeout)):
-          time.sleep(refreshment_interval)
+        while status and not status == constants.DONE and not status == constants.FAILED:
+          if not self._wait_loop_iteration(iteration, end_time):
+            break
+          iteration = self.engine_loop.iteration_count()
           (status, last_status_update) = self._database_server.get_job_status(jid, self._user_id) 
           self.logger.debug("wait        job %s status: %s last update %s," 
                             " now %s", 
@@ -998,11 +1339,40 @@ class WorkflowEngine(RemoteFileController):
                             status, 
                             repr(last_status_update), 
                             repr(datetime.now()))
-          delta = datetime.now() - startTime
           if last_status_update and _out_to_date(last_status_update):
             raise EngineError("wait_job: Could not wait for job %s. " 
                               "The process updating its status failed." %(jid))
-       
+
+
+  def wait_workflow(self, workflow_id, timeout=-1):
+    '''
+    Implementation of soma_workflow.client.WorkflowController API
+    '''
+    end_time = None
+    if timeout >= 0:
+      end_time = time.time() + timeout
+    iteration = self.engine_loop.iteration_count()
+    (status, 
+     last_status_update) = self._database_server.get_workflow_status(
+                                                                workflow_id,
+                                                                self._user_id)
+    try:
+      while status != None and status != constants.WORKFLOW_DONE:
+        if _out_to_date(last_status_update):
+          raise EngineError("wait_workflow: Could not wait for workflow %s. " 
+                            "The process updating its status failed." 
+                            %(workflow_id))
+        if not self._wait_loop_iteration(iteration, end_time):
+          break
+        iteration = self.engine_loop.iteration_count()
+        (status, 
+         last_status_update) = self._database_server.get_workflow_status(
+                                                                workflow_id,
+                                                                self._user_id)
+    except UnknownObjectError, e:
+      # deleted while waiting
+      pass
+
  
   def restart_job( self, job_id ):
     '''
@@ -1036,21 +1406,45 @@ class WorkflowEngine(RemoteFileController):
       else:
         self._database_server.set_job_status(job_id, 
                                              constants.KILL_PENDING)
+        self.engine_loop.wake_up()
       
       self._wait_job_status_update(job_id)
 
 
 
+  def _wait_loop_iteration(self, iteration, end_time=None):
+    '''
+    Waits until the engine loop ended an iteration following the iteration 
+    *iteration*, that is until the latest status changes were written to the 
+    database server.
+    The wait lasts status_heartbeat_interval seconds at most so that the 
+    callers can find out whether the status are out of date.
+
+    * end_time *float* or None: limit of the wait (see time.time()).
+
+    * returns: *boolean* False if end_time was reached.
+    '''
+    timeout = status_heartbeat_interval
+    if end_time != None:
+      timeout = min(timeout, end_time - time.time())
+      if timeout <= 0:
+        return False
+    self.engine_loop.wait_iteration(iteration, timeout)
+    return True
+
+
   def _wait_job_status_update(self, job_id):
     self.logger.debug(">> _wait_job_status_update")
     try:
+      iteration = self.engine_loop.iteration_count()
       (status, 
       last_status_update) = self._database_server.get_job_status(job_id,
                                                                  self._user_id)
       while status and not status == constants.DONE and \
             not status == constants.FAILED and \
             not _out_to_date(last_status_update):
-        time.sleep(refreshment_interval)
+        self._wait_loop_iteration(iteration)
+        iteration = self.engine_loop.iteration_count()
         (status, 
         last_status_update) = self._database_server.get_job_status(job_id,
                                                                   self._user_id) 
@@ -1061,11 +1455,13 @@ class WorkflowEngine(RemoteFileController):
 
   def _wait_for_job_deletion(self, job_id):
     self.logger.debug(">> _wait_for_job_deletion")
+    iteration = self.engine_loop.iteration_count()
     (is_valid_job, 
      last_status_update) = self._database_server.is_valid_job(job_id, 
                                                               self._user_id)
     while is_valid_job and not _out_to_date(last_status_update):
-      time.sleep(refreshment_interval)
+      self._wait_loop_iteration(iteration)
+      iteration = self.engine_loop.iteration_count()
       (is_valid_job, 
        last_status_update) = self._database_server.is_valid_job(job_id, 
                                                                 self._user_id)
@@ -1078,27 +1474,23 @@ class WorkflowEngine(RemoteFileController):
   def _wait_wf_status_update(self, wf_id, expected_status):  
     self.logger.debug(">> _wait_wf_status_update")
     try:
+      first_iteration = self.engine_loop.iteration_count()
+      iteration = first_iteration
       (status, 
       last_status_update) = self._database_server.get_workflow_status(wf_id,
                                                                  self._user_id)
-      if status != None and status != expected_status:
-        time.sleep(refreshment_interval)
+      # the status WORKFLOW_DONE ends the wait only if it is still the status 
+      # of the workflow after two iterations of the engine loop.
+      while status != None and \
+            status != expected_status and \
+            not (status == constants.WORKFLOW_DONE and \
+                 iteration - first_iteration >= 2) and \
+            not _out_to_date(last_status_update):
+        self._wait_loop_iteration(iteration)
+        iteration = self.engine_loop.iteration_count()
         (status, 
         last_status_update) = self._database_server.get_workflow_status(wf_id,
                                                                   self._user_id) 
-        if status != None and status != expected_status:
-          time.sleep(refreshment_interval)
-          (status, 
-          last_status_update) = self._database_server.get_workflow_status(wf_id,
-                                                                    self._user_id)
-          while status != None and \
-                status != expected_status and \
-                status != constants.WORKFLOW_DONE and \
-                not _out_to_date(last_status_update):
-            time.sleep(refreshment_interval)
-            (status, 
-            last_status_update) = self._database_server.get_workflow_status(wf_id,
-                                                                      self._user_id) 
     except UnknownObjectError, e:
       pass
     self.logger.debug("<< _wait_wf_status_update")
@@ -1106,12 +1498,14 @@ class WorkflowEngine(RemoteFileController):
 
   def _wait_for_wf_deletion(self, wf_id):
     self.logger.debug(">> _wait_for_wf_deletion")
+    iteration = self.engine_loop.iteration_count()
     (is_valid_wf, 
     last_status_update) = self._database_server.is_valid_workflow(wf_id, 
                                                                 self._user_id)
     while is_valid_wf and \
           not _out_to_date(last_status_update):
-      time.sleep(refreshment_interval)
+      self._wait_loop_iteration(iteration)
+      iteration = self.engine_loop.iteration_count()
       (is_valid_wf, 
       last_status_update) = self._database_server.is_valid_workflow(wf_id, 
                                                               self._user_id)     
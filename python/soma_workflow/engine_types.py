@@ -23,6 +23,7 @@ import os
 import logging
 import tempfile
 import weakref
+import collections
 
 from soma_workflow.errors import JobError, WorkflowError
 import soma_workflow.constants as constants
@@ -44,6 +45,8 @@ class EngineJob(Job):
   queue = None
   # job status as defined in constants.JOB_STATUS. string
   status = None
+  # last status written to the database server (dirty state tracking)
+  _stored_status = None
   # last status update date
   last_status_update = None
   # exit status string as defined in constants. JOB_EXIT_STATUS
@@ -93,7 +96,8 @@ class EngineJob(Job):
                                     client_job.working_directory ,
                                     client_job.parallel_job_info,
                                     client_job.priority,
-                                    client_job.native_specification)
+                                    client_job.native_specification,
+                                    memory=client_job.memory)
 
     self.job_id = -1
 
@@ -137,7 +141,7 @@ class EngineJob(Job):
                        " current resource. A parallel job can not be submitted")
       if parallel_config_name not in parallel_job_submission_info:
         raise JobError("The parallel job can not be submitted because the "
-                        "parallel configuration %s is missing." %(configuration_name))
+                        "parallel configuration %s is missing." %(parallel_config_name))
 
 
     if self.stdin:
@@ -417,6 +421,32 @@ class EngineJob(Job):
     return self.working_directory
 
 
+  def own_transfer_mapping(self):
+    '''
+    Part of the transfer_mapping concerning the special paths referenced by
+    the job. (The jobs of a workflow share the transfer_mapping of the
+    workflow.)
+
+    returns: dictionary: SpecialPath -> EngineTransfer or EngineTemporaryPath
+    '''
+    special_paths = list(self.referenced_input_files) + \
+                    list(self.referenced_output_files)
+    for command_el in self.command:
+      if isinstance(command_el, list):
+        elements = command_el
+      else:
+        elements = [command_el]
+      for element in elements:
+        if isinstance(element, tuple):
+          element = element[0]
+        if isinstance(element, SpecialPath):
+          special_paths.append(element)
+    own_mapping = {}
+    for special_path in special_paths:
+      if special_path in self.transfer_mapping:
+        own_mapping[special_path] = self.transfer_mapping[special_path]
+    return own_mapping
+
   def is_running(self):
     running = self.status != constants.NOT_SUBMITTED and \
               self.status != constants.FAILED and \
@@ -441,6 +471,15 @@ class EngineJob(Job):
               self.terminating_signal == None
     return success
 
+  def is_dirty(self):
+    '''
+    Tells if the status changed since it was written to the database server.
+    '''
+    return self.status != self._stored_status
+
+  def mark_stored(self):
+    self._stored_status = self.status
+
 
 
 class EngineWorkflow(Workflow):
@@ -455,6 +494,8 @@ class EngineWorkflow(Workflow):
   _path_translation = None
   # workflow status as defined in constants.WORKFLOW_STATUS
   status = None
+  # last status written to the database server (dirty state tracking)
+  _stored_status = None
   # expidation date
   expiration_date = None
   # name of the queue to be used to submit jobs, str
@@ -479,9 +520,32 @@ class EngineWorkflow(Workflow):
   # dictonary: tr_id -> EngineTransfer
   registered_tr = None
 
-  # for each job: list of all the jobs which have to end before a job can start
-  #dictionary: job_id -> list of job id
-  _dependency_dict = None
+  # Dependency index, built once from the dependencies and updated each time
+  # jobs end, so that the workflow inspection only costs time proportional 
+  # to the jobs which changed.
+  # for each job: list of the jobs which have to end before the job can start
+  # dictionary: EngineJob -> list of EngineJob
+  _predecessors = None
+  # for each job: list of the jobs which depend on it
+  # dictionary: EngineJob -> list of EngineJob
+  _successors = None
+  # for each job: number of predecessors which did not end with success yet
+  # dictionary: EngineJob -> int
+  _nb_remaining_deps = None
+  # jobs whose end was taken into account (including the aborted jobs)
+  # set of EngineJob
+  _ended_jobs = None
+  # jobs submitted or about to be submitted which did not end yet
+  # set of EngineJob
+  _active_jobs = None
+  # jobs whose dependencies are satisfied but whose input files are not 
+  # on the computing resource yet
+  # set of EngineJob
+  _waiting_jobs = None
+  # barrier jobs which ended since the last call to pop_ended_barriers. The
+  # barrier jobs are not submitted: they end as soon as they are ready.
+  # dictionary: job_id -> EngineJob
+  _ended_barriers = None
 
   logger = None
   
@@ -490,7 +554,8 @@ class EngineWorkflow(Workflow):
                path_translation, 
                queue, 
                expiration_date, 
-               name):
+               name,
+               parallel_job_submission_info=None):
  
     super(EngineWorkflow, self).__init__(client_workflow.jobs,
                                          client_workflow.dependencies,
@@ -508,22 +573,70 @@ class EngineWorkflow(Workflow):
 
     self.job_mapping = {}
     self.transfer_mapping = {}
-    self._map()
+    self._map(parallel_job_submission_info)
 
     self.registered_tr = {}
     self.registered_jobs = {}
 
-    self._dependency_dict = {}
-    for dep in self.dependencies:
-      if dep[1] in self._dependency_dict:
-        self._dependency_dict[dep[1]].append(dep[0])
-      else:
-        self._dependency_dict[dep[1]] = [dep[0]] 
+    self._build_dependency_index()
+
+  @classmethod
+  def from_registered_jobs(cls,
+                           wf_id,
+                           jobs,
+                           dependencies,
+                           root_group,
+                           queue,
+                           expiration_date,
+                           name,
+                           status,
+                           user_storage=None):
+    '''
+    Builds back a workflow from jobs registered on the database server
+    (see WorkflowDatabaseServer.get_engine_workflow). The EngineJob objects
+    stand for their own client jobs. The workflow may hold only a part of the
+    registered jobs: the dependencies must only involve these jobs.
 
+    * jobs *sequence of EngineJob*
+      The job_id of the jobs must be set.
 
+    * dependencies *sequence of tuple (EngineJob, EngineJob)*
 
+    * root_group *sequence of EngineJob and/or Group*
+      If None, the jobs are displayed at the root level.
+    '''
+    workflow = cls.__new__(cls)
+    super(EngineWorkflow, workflow).__init__(jobs,
+                                             dependencies,
+                                             root_group,
+                                             user_storage=user_storage,
+                                             name=name)
+    workflow.wf_id = wf_id
+    workflow.status = status
+    workflow.queue = queue
+    workflow.expiration_date = expiration_date
+    workflow.user_storage = user_storage
+
+    workflow.job_mapping = {}
+    workflow.transfer_mapping = {}
+    workflow.registered_jobs = {}
+    workflow.registered_tr = {}
+    for job in jobs:
+      workflow.job_mapping[job] = job
+      workflow.registered_jobs[job.job_id] = job
+      # the jobs were stored separately: the transfers they share are
+      # merged back
+      for special_path, transfer in job.transfer_mapping.items():
+        transfer = workflow.registered_tr.setdefault(transfer.get_id(),
+                                                     transfer)
+        job.transfer_mapping[special_path] = transfer
+        workflow.transfer_mapping[special_path] = transfer
+
+    workflow._build_dependency_index()
+    return workflow
 
-  def _map(self):
+
+  def _map(self, parallel_job_submission_info):
     '''
     Fill the job_mapping attributes.
     + type checking
@@ -537,7 +650,9 @@ class EngineWorkflow(Workflow):
         ejob = EngineJob(client_job=job,
                          queue=self.queue,
                          path_translation=self._path_translation,
-                         transfer_mapping=self.transfer_mapping)
+                         transfer_mapping=self.transfer_mapping,
+                         parallel_job_submission_info=
+                           parallel_job_submission_info)
         self.transfer_mapping.update(ejob.transfer_mapping)
         self.job_mapping[job]=ejob
 
@@ -555,7 +670,9 @@ class EngineWorkflow(Workflow):
         ejob = EngineJob( client_job=dependency[0],
                           queue=self.queue,
                           path_translation=self._path_translation,
-                          transfer_mapping=self.transfer_mapping)
+                          transfer_mapping=self.transfer_mapping,
+                          parallel_job_submission_info=
+                            parallel_job_submission_info)
         self.transfer_mapping.update(ejob.transfer_mapping)
         self.job_mapping[dependency[0]]=ejob
 
@@ -564,7 +681,9 @@ class EngineWorkflow(Workflow):
         ejob = EngineJob( client_job=dependency[1],
                           queue=self.queue,
                           path_translation=self._path_translation,
-                          transfer_mapping=self.transfer_mapping)
+                          transfer_mapping=self.transfer_mapping,
+                          parallel_job_submission_info=
+                            parallel_job_submission_info)
         self.transfer_mapping.update(ejob.transfer_mapping)
         self.job_mapping[dependency[1]]=ejob
 
@@ -578,7 +697,9 @@ class EngineWorkflow(Workflow):
             ejob = EngineJob( client_job=elem,
                               queue=self.queue,
                               path_translation=self._path_translation,
-                              transfer_mapping=self.transfer_mapping)
+                              transfer_mapping=self.transfer_mapping,
+                              parallel_job_submission_info=
+                                parallel_job_submission_info)
             self.transfer_mapping.update(ejob.transfer_mapping)
             self.job_mapping[elem]=ejob
         elif not isinstance(elem, Group):
@@ -594,7 +715,9 @@ class EngineWorkflow(Workflow):
           ejob = EngineJob( client_job=elem,
                             queue=self.queue,
                             path_translation=self._path_translation,
-                            transfer_mapping=self.transfer_mapping)
+                            transfer_mapping=self.transfer_mapping,
+                            parallel_job_submission_info=
+                              parallel_job_submission_info)
           self.transfer_mapping.update(ejob.transfer_mapping)
           self.job_mapping[elem]=ejob
       elif not isinstance(elem, Group):
@@ -603,128 +726,212 @@ class EngineWorkflow(Workflow):
                             (repr(elem)))
 
 
+  def _build_dependency_index(self):
+    '''
+    Builds the successor/predecessor adjacency and the remaining dependency 
+    counters from the dependencies and the current state of the jobs.
+    '''
+    self._predecessors = {}
+    self._successors = {}
+    self._nb_remaining_deps = {}
+    self._ended_jobs = set()
+    self._active_jobs = set()
+    self._waiting_jobs = set()
+    self._ended_barriers = {}
+    for job in self.job_mapping.itervalues():
+      self._predecessors[job] = []
+      self._successors[job] = []
+      self._nb_remaining_deps[job] = 0
+      if job.is_done():
+        self._ended_jobs.add(job)
+      elif job.is_running():
+        self._active_jobs.add(job)
+    for dep in self.dependencies:
+      job_a = self.job_mapping[dep[0]]
+      job_b = self.job_mapping[dep[1]]
+      self._predecessors[job_b].append(job_a)
+      self._successors[job_a].append(job_b)
+      if not job_a.ended_with_success():
+        self._nb_remaining_deps[job_b] = self._nb_remaining_deps[job_b] + 1
+
+  def _input_files_on_server(self, job):
+    for ft in job.referenced_input_files:
+      eft = self.transfer_mapping[ft]
+      if not eft.files_exist_on_server():
+        if eft.status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
+          #TBI stop the transfer
+          pass 
+        return False
+    return True
+
+  def _ready_jobs(self, candidates):
+    '''
+    Sorts the not submitted jobs whose dependencies are satisfied into jobs
+    to run and jobs waiting for their input files.
+    The ready barrier jobs end at once (see pop_ended_barriers) and their 
+    successors are inspected in turn, so that a chain of barriers is 
+    crossed in one call.
+
+    @rtype: list of EngineJob
+    @return: jobs to run
+    '''
+    to_run = []
+    candidates = collections.deque(candidates)
+    while candidates:
+      job = candidates.popleft()
+      if job.status != constants.NOT_SUBMITTED:
+        continue
+      if not self._input_files_on_server(job):
+        self._waiting_jobs.add(job)
+      elif job.is_barrier:
+        self._waiting_jobs.discard(job)
+        job.status = constants.DONE
+        job.exit_status = constants.FINISHED_REGULARLY
+        job.exit_value = 0
+        job.terminating_signal = None
+        job.str_rusage = None
+        self._ended_jobs.add(job)
+        self._ended_barriers[job.job_id] = job
+        for successor in self._successors[job]:
+          self._nb_remaining_deps[successor] \
+            = self._nb_remaining_deps[successor] - 1
+          if self._nb_remaining_deps[successor] == 0:
+            candidates.append(successor)
+      else:
+        self._waiting_jobs.discard(job)
+        self._active_jobs.add(job)
+        to_run.append(job)
+    return to_run
+
+  def pop_ended_barriers(self):
+    '''
+    @rtype: dictionary job_id -> EngineJob
+    @return: the barrier jobs which ended since the last call. Their status
+    and exit information have to be written to the database server.
+    '''
+    ended_barriers = self._ended_barriers
+    self._ended_barriers = {}
+    return ended_barriers
+
+  def is_dirty(self):
+    '''
+    Tells if the status changed since it was written to the database server.
+    '''
+    return self.status != self._stored_status
+
+  def mark_stored(self):
+    self._stored_status = self.status
+
+  def _current_status(self):
+    if self._active_jobs:
+      status = constants.WORKFLOW_IN_PROGRESS
+    elif len(self._ended_jobs) == len(self.job_mapping): 
+      status = constants.WORKFLOW_DONE
+    elif self._ended_jobs:
+      status = constants.WORKFLOW_IN_PROGRESS
+      # !!!! the workflow may be stuck !!!!
+      # TBI
+      self.logger.debug("!!!! The workflow may be stuck !!!!")
+    else:
+      status = constants.WORKFLOW_NOT_STARTED
+    return status
+
   def find_out_independant_jobs(self):
-    independant_jobs = []
-    for job in self.jobs:
-      to_run=True
-      for ft in job.referenced_input_files:
-        if not self.transfer_mapping[ft].files_exist_on_server():
-          if self.transfer_mapping[ft].status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
-              #TBI stop the transfer
-              pass 
-          to_run = False
-          break 
-      if to_run:
-        for dep in self.dependencies:
-          if dep[1] == job:
-            to_run = False
-            break
-      if to_run:
-        independant_jobs.append(self.job_mapping[job])
+    independant_jobs = self._ready_jobs(
+                          [job for job, nb_deps 
+                           in self._nb_remaining_deps.iteritems() 
+                           if nb_deps == 0])
     if independant_jobs:
       status = constants.WORKFLOW_IN_PROGRESS
+    elif self._ended_barriers:
+      status = self._current_status()
     else:
       status = self.status
     return (independant_jobs, status)
 
-  def find_out_jobs_to_process(self):
+  def find_out_jobs_to_process(self, ended_jobs):
     '''
     Workflow exploration to find out new node to process.
+    Only the successors of the jobs which ended since the last call and the 
+    jobs waiting for their input files are inspected.
 
+    @type  ended_jobs: sequence of EngineJob
+    @param ended_jobs: jobs of the workflow which ended since the last call
     @rtype: tuple (sequence of EngineJob,
                    sequence of EngineJob,
                    constanst.WORKFLOW_STATUS)
     @return: (jobs to run,
-              ended jobs
+              ended jobs (aborted jobs and barrier jobs) by job id,
               workflow status)
     '''
 
     self.logger = logging.getLogger('engine.EngineWorkflow') 
-    self.logger.debug("self.jobs="+repr(self.jobs))
-    to_run = []
+    candidates = list(self._waiting_jobs)
     to_abort = set([])
-    done = []
-    running = []
-    for client_job in self.jobs:
-      self.logger.debug("client_job="+repr(client_job))
-      job = self.job_mapping[client_job]
-      if job.is_done():
-        done.append(job)
-      elif job.is_running():
-        running.append(job)
-      elif job.status == constants.NOT_SUBMITTED:
-        job_to_run = True
-        job_to_abort = False
-        for ft in job.referenced_input_files:
-          eft = job.transfer_mapping[ft]
-          if not eft.files_exist_on_server():
-            if eft.status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
-              #TBI stop the transfer
-              pass 
-            job_to_run = False
-            break
-        if client_job in self._dependency_dict:
-          for dep_client_job in self._dependency_dict[client_job]:
-            dep_job = self.job_mapping[dep_client_job]
-            if not dep_job.ended_with_success():
-              job_to_run = False
-              if dep_job.failed():
-                job_to_abort = True
-                break
-            # TO DO to abort
-        if job_to_run:
-          to_run.append(job)
-        if job_to_abort:
-          to_abort.add(job)
+    for job in ended_jobs:
+      if job in self._ended_jobs:
+        continue
+      self.logger.debug("ended job=" + repr(job.name))
+      self._ended_jobs.add(job)
+      self._active_jobs.discard(job)
+      self._waiting_jobs.discard(job)
+      if job.ended_with_success():
+        for successor in self._successors[job]:
+          self._nb_remaining_deps[successor] \
+            = self._nb_remaining_deps[successor] - 1
+          if self._nb_remaining_deps[successor] == 0:
+            candidates.append(successor)
+      elif job.failed():
+        for successor in self._successors[job]:
+          if successor.status == constants.NOT_SUBMITTED:
+            to_abort.add(successor)
     # if a job fails the whole workflow branch has to be stopped
-    # look for the node in the branch to abort
-    previous_size = 0
-    while previous_size != len(to_abort):
-      previous_size = len(to_abort)
-      for dep in self.dependencies:
-        job_a = self.job_mapping[dep[0]]
-        job_b = self.job_mapping[dep[1]]
-        if job_a in to_abort and not job_b in to_abort:
-          to_abort.add(job_b)
-          break
+    # look for the node in the branch to abort: breadth first traversal of
+    # the successors, each job and dependency is visited once.
+    to_visit = collections.deque(to_abort)
+    while to_visit:
+      job = to_visit.popleft()
+      for successor in self._successors[job]:
+        if successor not in to_abort:
+          to_abort.add(successor)
+          to_visit.append(successor)
+
+    to_run = self._ready_jobs([job for job in candidates 
+                               if job not in to_abort])
 
     # stop the whole branch
-    ended_jobs = {}
+    aborted_jobs = {}
     for job in to_abort:
       if job.job_id and job.status != constants.FAILED:
         self.logger.debug("  ---- Failure: job to abort " + job.name)
         assert(job.status == constants.NOT_SUBMITTED)
-        ended_jobs[job.job_id] = job
+        aborted_jobs[job.job_id] = job
         job.status = constants.FAILED
         job.exit_status = constants.EXIT_ABORTED
+      self._ended_jobs.add(job)
+      self._waiting_jobs.discard(job)
+    aborted_jobs.update(self.pop_ended_barriers())
 
+    status = self._current_status()
 
-    if len(running) + len(to_run) > 0:
-      status = constants.WORKFLOW_IN_PROGRESS
-    elif len(done) + len(to_abort) == len(self.jobs): 
-      status = constants.WORKFLOW_DONE
-    elif len(done) > 0:
-      status = constants.WORKFLOW_IN_PROGRESS
-      # !!!! the workflow may be stuck !!!!
-      # TBI
-      self.logger.debug("!!!! The workflow may be stuck !!!!")
-    else:
-      status = constants.WORKFLOW_NOT_STARTED
-
-    return (to_run, ended_jobs, status)
+    return (to_run, aborted_jobs, status)
 
   
   def _update_state_from_database_server(self, database_server):
     wf_status = database_server.get_detailed_workflow_status(self.wf_id)
 
+    # the workflow may hold only a part of the registered jobs and transfers
     for job_info in wf_status[0]:
       job_id, status, queue, exit_info, date_info = job_info
-      self.registered_jobs[job_id].status = status
+      job = self.registered_jobs.get(job_id)
+      if job is None:
+        continue
+      job.status = status
       exit_status, exit_value, term_signal, resource_usage = exit_info
-      self.registered_jobs[job_id].exit_status = exit_status
-      self.registered_jobs[job_id].exit_value = exit_value
-      self.registered_jobs[job_id].str_rusage = resource_usage
-      self.registered_jobs[job_id].terminating_signal = term_signal
+      job.exit_status = exit_status
+      job.exit_value = exit_value
+      job.str_rusage = resource_usage
+      job.terminating_signal = term_signal
    
     for ft_info in wf_status[1]:
       (engine_path, 
@@ -732,7 +939,8 @@ class EngineWorkflow(Workflow):
        client_paths,
        status, 
        transfer_type) = ft_info 
-      self.registered_tr[engine_path].status = status
+      if engine_path in self.registered_tr:
+        self.registered_tr[engine_path].status = status
 
     self.queue = wf_status[3]
 
@@ -805,30 +1013,14 @@ class EngineWorkflow(Workflow):
     database_server.set_jobs_status(new_status)
     database_server.set_queue(self.queue, jobs_queue_changed, self.wf_id)
 
+    # the job states changed: the dependency index is built again
+    self._build_dependency_index()
+
     to_run = []
     if undone_jobs:
-      # look for jobs to run
-      for job in undone_jobs:
-        job_to_run = True # a node is run when all its dependencies succeed
-        for ft in job.referenced_input_files:
-          eft = self.transfer_mapping[ft]
-          if not eft.files_exist_on_server():
-            if eft.status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
-              #TBI stop the transfer
-              pass 
-            job_to_run = False
-            break 
-        if job_to_run:
-          for dep in self.dependencies:
-            job_a = self.job_mapping[dep[0]]
-            job_b = self.job_mapping[dep[1]]
-
-            if job_b == job and not job_a.ended_with_success():
-              job_to_run = False
-              break
-
-        if job_to_run: 
-          to_run.append(job)
+      # look for jobs to run: a node is run when all its dependencies succeed
+      to_run = self._ready_jobs([job for job in undone_jobs
+                                 if self._nb_remaining_deps[job] == 0])
 
     if to_run:
       status = constants.WORKFLOW_IN_PROGRESS
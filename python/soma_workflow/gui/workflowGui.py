@@ -23,6 +23,10 @@ from datetime import datetime
 from datetime import timedelta
 import socket
 import weakref
+import shlex
+import subprocess
+import math
+import distutils.spawn
 #import cProfile
 #import traceback
 #import pdb
@@ -93,6 +97,9 @@ except ImportError, e:
   print "Could not use Matplotlib: %s %s" %(type(e), e)
   MATPLOTLIB = False
 
+# the workflow graph is laid out by graphviz
+GRAPHVIZ = distutils.spawn.find_executable("dot") != None
+
 try:
   from Pyro.errors import ConnectionClosedError
 except ImportError:
@@ -1888,15 +1895,15 @@ class MainWindow(QtGui.QMainWindow):
     wfInfoLayout.addWidget(self.workflowInfoWidget)
     self.ui.widget_wf_info.setLayout(wfInfoLayout)
     
-    #self.graphWidget = WorkflowGraphView(self)
-    #graphWidgetLayout = QtGui.QVBoxLayout()
-    #graphWidgetLayout.setContentsMargins(2,2,2,2)
-    #graphWidgetLayout.addWidget(self.graphWidget)
-    #self.ui.dockWidgetContents_graph.setLayout(graphWidgetLayout)
+    self.graphWidget = WorkflowGraphView(self.model, self)
+    graphWidgetLayout = QtGui.QVBoxLayout()
+    graphWidgetLayout.setContentsMargins(2,2,2,2)
+    graphWidgetLayout.addWidget(self.graphWidget)
+    self.ui.dockWidgetContents_graph.setLayout(graphWidgetLayout)
 
-    # no graph for now
-    self.ui.dock_graph.hide()
-    self.ui.dock_graph.toggleViewAction().setVisible(False)
+    if not GRAPHVIZ:
+      self.ui.dock_graph.hide()
+      self.ui.dock_graph.toggleViewAction().setVisible(False)
     
     self.workflowPlotWidget = WorkflowPlot(self.model, parent=self)
     plotLayout = QtGui.QVBoxLayout()
@@ -2852,15 +2859,188 @@ class PlotView(QtGui.QWidget):
     self.update()
  
 
+class WorkflowGraphLayout(object):
+  '''
+  Position of the jobs and dependencies of a workflow computed by graphviz 
+  (dot -Tplain). The layout only depends on the structure of the workflow: 
+  it is computed once and the jobs are only coloured according to their 
+  status when the graph is drawn (see WorkflowGraphView).
+  The coordinates are in points, from the top left corner.
+  '''
+
+  # graphviz units (inches) -> points
+  DPI = 72
+
+  # dictionary: job key -> (x, y, width, height, label) 
+  nodes = None
+
+  # sequence of sequence of (x, y): control points of the dependency 
+  # B-splines
+  edges = None
+
+  width = None
+  height = None
+
+  def __init__(self, jobs, dependencies):
+    '''
+    * jobs *sequence of (key, name)*
+    * dependencies *sequence of (key, key)*
+    '''
+    names = {}
+    lines = ["digraph G {", "node [shape=box];"]
+    for key, name in jobs:
+      names[key] = "node%d" % len(names)
+      if not isinstance(name, unicode):
+        name = str(name).decode("utf-8", "replace")
+      label = name.replace("\\", "\\\\").replace("\"", "\\\"")
+      lines.append("%s [label=\"%s\"];" % (names[key], label))
+    for key_a, key_b in dependencies:
+      lines.append("%s -> %s;" % (names[key_a], names[key_b]))
+    lines.append("}")
+    dot_process = subprocess.Popen(["dot", "-Tplain"],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+    (output, 
+     errors) = dot_process.communicate("\n".join(lines).encode("utf-8"))
+    if dot_process.returncode != 0:
+      raise RuntimeError("dot failed with the exit status %d"
+                         % dot_process.returncode)
+
+    keys = dict((name, key) for key, name in names.iteritems())
+    self.nodes = {}
+    self.edges = []
+    self.width = 0
+    self.height = 0
+    for line in output.splitlines():
+      fields = shlex.split(line)
+      if not fields:
+        continue
+      if fields[0] == "graph":
+        self.width = float(fields[2]) * self.DPI
+        self.height = float(fields[3]) * self.DPI
+      elif fields[0] == "node":
+        width = float(fields[4]) * self.DPI
+        height = float(fields[5]) * self.DPI
+        x = float(fields[2]) * self.DPI - width / 2
+        y = self.height - float(fields[3]) * self.DPI - height / 2
+        self.nodes[keys[fields[1]]] = (x, y, width, height, 
+                                       fields[6].decode("utf-8"))
+      elif fields[0] == "edge":
+        nb_points = int(fields[3])
+        self.edges.append([(float(fields[4 + 2 * i]) * self.DPI,
+                            self.height - 
+                            float(fields[5 + 2 * i]) * self.DPI)
+                           for i in range(nb_points)])
+
+
+class WorkflowGraphRendering(QtCore.QThread):
+  '''
+  Draws the graph of a workflow in a QImage, out of the GUI thread. The 
+  layout is computed first if it is not known yet.
+  '''
+
+  # length of the arrow heads drawn by dot (points)
+  ARROW_LENGTH = 10
+
+  def __init__(self, layout, jobs, dependencies, colors, parent=None):
+    '''
+    * layout *WorkflowGraphLayout* or None to compute it.
+    * jobs, dependencies: see WorkflowGraphLayout (used to compute the 
+      layout).
+    * colors *dictionary: job key -> color name or None*
+    '''
+    super(WorkflowGraphRendering, self).__init__(parent)
+    self.layout = layout
+    self.jobs = jobs
+    self.dependencies = dependencies
+    self.colors = colors
+    self.image = None
+    self.error = None
+
+  def run(self):
+    try:
+      if self.layout == None:
+        self.layout = WorkflowGraphLayout(self.jobs, self.dependencies)
+      self.image = self.draw(self.layout, self.colors)
+    except Exception, e:
+      self.error = e
+
+  @staticmethod
+  def draw(layout, colors):
+    image = QtGui.QImage(max(1, int(layout.width) + 1), 
+                         max(1, int(layout.height) + 1),
+                         QtGui.QImage.Format_ARGB32)
+    image.fill(QtGui.QColor("white").rgb())
+    painter = QtGui.QPainter(image)
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    for points in layout.edges:
+      path = QtGui.QPainterPath(QtCore.QPointF(*points[0]))
+      for i in range(1, len(points) - 2, 3):
+        path.cubicTo(QtCore.QPointF(*points[i]),
+                     QtCore.QPointF(*points[i + 1]),
+                     QtCore.QPointF(*points[i + 2]))
+      painter.setBrush(QtCore.Qt.NoBrush)
+      painter.drawPath(path)
+      # arrow head: the splines end where the arrow head begins
+      (x1, y1) = points[-2]
+      (x2, y2) = points[-1]
+      length = math.hypot(x2 - x1, y2 - y1)
+      if length > 0:
+        (dx, dy) = ((x2 - x1) / length, (y2 - y1) / length)
+        arrow_length = WorkflowGraphRendering.ARROW_LENGTH
+        painter.setBrush(QtGui.QColor("black"))
+        painter.drawPolygon(QtGui.QPolygonF([
+                 QtCore.QPointF(x2 + dx * arrow_length, y2 + dy * arrow_length),
+                 QtCore.QPointF(x2 - dy * arrow_length / 3, 
+                                y2 + dx * arrow_length / 3),
+                 QtCore.QPointF(x2 + dy * arrow_length / 3, 
+                                y2 - dx * arrow_length / 3)]))
+    for key, (x, y, width, height, label) in layout.nodes.iteritems():
+      rect = QtCore.QRectF(x, y, width, height)
+      color = colors.get(key)
+      if color:
+        painter.setBrush(QtGui.QColor(color))
+      else:
+        painter.setBrush(QtCore.Qt.NoBrush)
+      painter.drawRect(rect)
+      painter.drawText(rect, QtCore.Qt.AlignCenter, label)
+    painter.end()
+    return image
+
+
 class WorkflowGraphView(QtGui.QWidget):
+
+  GRAY = "#C8C8B4"
+  RED = "#FF6432"
+  GREEN = "#9BFF32"
+  LIGHT_BLUE = "#C8FFFF"
+
+  # layouts computed for the workflows displayed
+  # weakref.WeakKeyDictionary: GuiWorkflow -> WorkflowGraphLayout
+  _layouts = None
+
+  # errors of the layout computations which failed: they are not computed 
+  # again (dot would be run at each update)
+  # weakref.WeakKeyDictionary: GuiWorkflow -> Exception
+  _layout_errors = None
+
+  # WorkflowGraphRendering running, or None
+  _rendering = None
+
+  # boolean: the graph changed during the current rendering
+  _rendering_pending = None
   
-  def __init__(self, connection, parent = None):
+  def __init__(self, model, parent = None):
     super(WorkflowGraphView, self).__init__(parent)
     self.ui = Ui_GraphWidget()
     self.ui.setupUi(self)
     
+    self.model = model
     self.workflow = None
-    self.connection = None
+    self._layouts = weakref.WeakKeyDictionary()
+    self._layout_errors = weakref.WeakKeyDictionary()
+    self._rendering = None
+    self._rendering_pending = False
     
     self.image_label = QtGui.QLabel(self)
     self.image_label.setBackgroundRole(QtGui.QPalette.Base)
@@ -2878,12 +3058,24 @@ class WorkflowGraphView(QtGui.QWidget):
     
     self.ui.adjust_size_checkBox.stateChanged.connect(self.adjustSizeChanged)
     self.ui.button_refresh.clicked.connect(self.refresh)
-                                        
-  def setWorkflow(self, workflow, connection):
+
+    self.connect(self.model, QtCore.SIGNAL('current_connection_changed()'), self.clear)
+    self.connect(self.model, QtCore.SIGNAL('current_workflow_about_to_change()'), self.clear)
+    self.connect(self.model, QtCore.SIGNAL('current_workflow_changed()'), self.current_workflow_changed)
+    self.connect(self.model, QtCore.SIGNAL('workflow_state_changed()'), self.dataChanged)
+
+  @QtCore.Slot()
+  def current_workflow_changed(self):
+    self.setWorkflow(self.model.current_workflow())
+
+  def setWorkflow(self, workflow):
+    '''
+    * workflow *GuiWorkflow*
+    '''
     self.workflow = workflow
-    self.connection = connection
-    self.dataChanged()
+    self.dataChanged(force = True)
     
+  @QtCore.Slot()
   def clear(self):
     self.workflow = None
     self.dataChanged()
@@ -2891,7 +3083,7 @@ class WorkflowGraphView(QtGui.QWidget):
   @QtCore.Slot(int)
   def zoomChanged(self, percentage):
     self.scale_factor = percentage / 100.0
-    if self.workflow:
+    if self.image_label.pixmap():
       self.image_label.resize(self.image_label.pixmap().size()*self.scale_factor)
     
   @QtCore.Slot(int)
@@ -2907,80 +3099,79 @@ class WorkflowGraphView(QtGui.QWidget):
   @QtCore.Slot()
   def dataChanged(self, force = False):
     if self.workflow and (force or self.ui.checkbox_auto_update.isChecked()):
-      image_file_path = self.printWorkflow()
-      image = QtGui.QImage(image_file_path)
-      pixmap = QtGui.QPixmap.fromImage(image)
-      self.image_label.setPixmap(pixmap)
-      self.ui.scrollArea.setWidget(self.image_label)
-      self.image_label.resize(self.image_label.pixmap().size()*self.scale_factor)
-    else:
+      if self._rendering != None:
+        # the graph will be drawn again at the end of the current rendering
+        self._rendering_pending = True
+        return
+      if self.workflow in self._layout_errors:
+        return
+      gui_jobs = [item for item in self.workflow.items.itervalues() 
+                  if isinstance(item, GuiJob)]
+      job_items = dict((gui_job.data, gui_job.it_id) for gui_job in gui_jobs)
+      colors = dict((gui_job.it_id, self.jobColor(gui_job)) 
+                    for gui_job in gui_jobs)
+      layout = self._layouts.get(self.workflow)
+      jobs = None
+      dependencies = None
+      if layout == None:
+        jobs = [(gui_job.it_id, gui_job.name) for gui_job in gui_jobs]
+        dependencies = [(job_items[job_a], job_items[job_b]) 
+                        for job_a, job_b 
+                        in self.workflow.server_workflow.dependencies
+                        if job_a in job_items and job_b in job_items]
+      self._rendering = WorkflowGraphRendering(layout, 
+                                               jobs, 
+                                               dependencies, 
+                                               colors)
+      self._rendering.workflow = self.workflow
+      self.connect(self._rendering, QtCore.SIGNAL('finished()'), 
+                   self.renderingFinished)
+      self._rendering.start(QtCore.QThread.LowPriority)
+    elif not self.workflow:
       self.ui.scrollArea.takeWidget()
 
-  
-  def printWorkflow(self):
-      
-    output_dir = "/tmp/"
-    
-    GRAY="\"#C8C8B4\""
-    BLUE="\"#00C8FF\""
-    RED="\"#FF6432\""
-    GREEN="\"#9BFF32\""
-    LIGHT_BLUE="\"#C8FFFF\""
-    
-    names = dict()
-    current_id = 0
-    
-    dot_file_path = output_dir + "tmp.dot"
-    graph_file_path = output_dir + "tmp.png"
-    if dot_file_path and os.path.isfile(dot_file_path):
-      os.remove(dot_file_path)
-    file = open(dot_file_path, "w")
-    print >> file, "digraph G {"
-    for node in self.workflow.jobs:
-      current_id = current_id + 1
-      names[node] = ("node" + repr(current_id), "\""+node.name+"\"")
-    for ar in self.workflow.dependencies:
-      print >> file, names[ar[0]][0] + " -> " + names[ar[1]][0] 
-    for node in self.workflow.jobs:
-      if isinstance(node, Job):
-        if node.job_id == NOT_SUBMITTED_JOB_ID:
-          print >> file, names[node][0] + "[shape=box label="+ names[node][1] +"];"
-        else:
-          status = self.connection.job_status(node.job_id)
-          if status == constants.NOT_SUBMITTED:
-            print >> file, names[node][0] + "[shape=box label="+ names[node][1] +", style=filled, color=" + GRAY +"];"
-          elif status == constants.DONE:
-            exit_status, exit_value, term_signal, resource_usage = self.connection.job_termination_status(node.job_id)
-            if exit_status == constants.FINISHED_REGULARLY and exit_value == 0:
-              print >> file, names[node][0] + "[shape=box label="+ names[node][1] +", style=filled, color=" + LIGHT_BLUE +"];"
-            else: 
-              print >> file, names[node][0] + "[shape=box label="+ names[node][1] +", style=filled, color=" + RED +"];"
-          elif status == constants.FAILED:
-            print >> file, names[node][0] + "[shape=box label="+ names[node][1] +", style=filled, color=" + RED +"];"
-          else:
-            print >> file, names[node][0] + "[shape=box label="+ names[node][1] +", style=filled, color=" + GREEN +"];"
-      if isinstance(node, FileTransfer):
-        if not node.engine_path:
-          print >> file, names[node][0] + "[label="+ names[node][1] +"];"
-        else:
-          status = self.connection.transfer_status(node.engine_path)[0]
-          if status == constants.FILES_DONT_EXIST:
-            print >> file, names[node][0] + "[label="+ names[node][1] +", style=filled, color=" + GRAY +"];"
-          elif status == constants.FILES_ON_CR or status == constants.FILES_ON_CLIENT_AND_CR or status == constants.FILES_ON_CLIENT:
-            print >> file, names[node][0] + "[label="+ names[node][1] +", style=filled, color=" + BLUE +"];"
-          elif status == constants.TRANSFERING_FROM_CLIENT_TO_CR or status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
-            print >> file, names[node][0] + "[label="+ names[node][1] +", style=filled, color=" + GREEN +"];"
-          elif status == constants.FILES_UNDER_EDITION:
-            print >> file, names[node][0] + "[label="+ names[node][1] +", style=filled, color=" + LIGHT_BLUE +"];"
-          
-    print >> file, "}"
-    file.close()
-    
-    command = "dot -Tpng " + dot_file_path + " -o " + graph_file_path
-    #print command
-    #dot_process = subprocess.Popen(command, shell = True)
-    commands.getstatusoutput(command)
-    return graph_file_path
+  @QtCore.Slot()
+  def renderingFinished(self):
+    rendering = self._rendering
+    # finished() can be emitted before the end of the thread: it must not 
+    # be destroyed while running
+    rendering.wait()
+    self._rendering = None
+    if rendering.error != None:
+      print "Could not draw the workflow graph: %s %s" % (type(rendering.error), 
+                                                          rendering.error)
+      if rendering.layout == None:
+        self._layout_errors[rendering.workflow] = rendering.error
+    else:
+      self._layouts[rendering.workflow] = rendering.layout
+      if rendering.workflow is self.workflow:
+        pixmap = QtGui.QPixmap.fromImage(rendering.image)
+        self.image_label.setPixmap(pixmap)
+        if self.ui.scrollArea.widget() is not self.image_label:
+          self.ui.scrollArea.setWidget(self.image_label)
+        self.image_label.resize(self.image_label.pixmap().size()*self.scale_factor)
+    if self._rendering_pending:
+      self._rendering_pending = False
+      self.dataChanged(force = True)
+
+  def jobColor(self, gui_job):
+    '''
+    Color of the job in the graph according to its status (None: no color).
+    '''
+    if gui_job.job_id == NOT_SUBMITTED_JOB_ID:
+      return None
+    if gui_job.status == constants.NOT_SUBMITTED:
+      return self.GRAY
+    elif gui_job.status == constants.DONE:
+      exit_status, exit_value, term_signal, resource_usage = gui_job.exit_info
+      if exit_status == constants.FINISHED_REGULARLY and exit_value == 0:
+        return self.LIGHT_BLUE
+      else: 
+        return self.RED
+    elif gui_job.status == constants.FAILED:
+      return self.RED
+    else:
+      return self.GREEN
 
       
 ########################################################
@@ -3316,6 +3507,25 @@ class ApplicationModel(QtCore.QObject):
 
     def run(self):
       self.application_model.update()
+
+  class CallThread(QtCore.QThread):
+    '''
+    Thread calling func(*args, **kwargs) (see connection_timeout).
+    '''
+
+    def __init__(self, func, args, kwargs, default):
+      super(ApplicationModel.CallThread, self).__init__(parent=None)
+      self.func = func
+      self.args = args
+      self.kwargs = kwargs
+      self.result = default
+      self.exception = None
+
+    def run(self):
+      try:
+        self.result = self.func(*self.args, **self.kwargs)
+      except Exception, e:
+        self.exception = e
   
 
   def __init__(self, resource_pool=None, parent=None):
@@ -3404,9 +3614,12 @@ class ApplicationModel(QtCore.QObject):
               #begining = datetime.now()
 
               #wf_complete_status = self.current_connection.workflow_elements_status(self.current_wf_id)
-              wf_complete_status = self.connection_timeout(
-                                WorkflowController.workflow_elements_status, 
-                                args=(self.current_connection, self.current_wf_id), 
+              (wf_version,
+               wf_complete_status) = self.connection_timeout(
+                                WorkflowController.workflow_elements_status_changes, 
+                                args=(self.current_connection, 
+                                      self.current_wf_id,
+                                      self._current_workflow.version), 
                                 timeout_duration=self._timeout_duration[self.current_resource_id])
               wf_status = wf_complete_status[2]
               #end = datetime.now() - begining
@@ -3426,7 +3639,8 @@ class ApplicationModel(QtCore.QObject):
             return
           else: 
             if self._current_workflow and self.current_wf_id != NOT_SUBMITTED_WF_ID:    
-              if self._current_workflow.updateState(wf_complete_status): 
+              if self._current_workflow.updateState(wf_complete_status,
+                                                    wf_version): 
                 self.emit(QtCore.SIGNAL('workflow_state_changed()'))
             if self.current_wf_id != NOT_SUBMITTED_WF_ID and self.workflow_status != wf_status:
               self.workflow_status = wf_status
@@ -3434,31 +3648,33 @@ class ApplicationModel(QtCore.QObject):
               self.emit(QtCore.SIGNAL('workflow_state_changed()'))
               self.emit(QtCore.SIGNAL('global_workflow_state_changed()'))
         if True:
-          #update the status of every workflow
+          #update the status of every workflow: one call per resource, the
+          #resources being queried in parallel
           global_wf_state_changed = False
+          calls = {}
           for rid in self.resource_pool.resource_ids():
             if not self._hold[rid]:
-              for wfid in self._workflows[rid].keys():
-                if wfid != self.current_wf_id:
-                  try:
-                    connection = self.resource_pool.connection(rid)
-                    wf_status = self.connection_timeout(WorkflowController.workflow_status, 
-                                                        args=(connection, wfid), 
-                                                        timeout_duration=self._timeout_duration[self.current_resource_id])
-
-                    #wf_status = self.resource_pool.connection(rid).workflow_status(wfid)
-                  except ConnectionClosedError, e:
-                    #print e
-                    self.emit(QtCore.SIGNAL('connection_closed_error'), rid)
-                    self._hold[rid] = True
-                    break
-                  except UnknownObjectError, e:
-                    self.delete_workflow(wfid)
-                    continue
-                  else:
-                    if wf_status != self._workflow_statuses[rid][wfid]:
-                      global_wf_state_changed = True
-                      self._workflow_statuses[rid][wfid] = wf_status
+              wf_ids = [wfid for wfid in self._workflows[rid].keys()
+                        if wfid != self.current_wf_id]
+              if wf_ids:
+                calls[rid] = (WorkflowController.workflows_status,
+                              (self.resource_pool.connection(rid), wf_ids),
+                              self._timeout_duration[rid])
+          results = self.connections_timeout(calls)
+          for rid, wfs_status in results.iteritems():
+            if isinstance(wfs_status, ConnectionClosedError):
+              self.emit(QtCore.SIGNAL('connection_closed_error'), rid)
+              self._hold[rid] = True
+              continue
+            elif isinstance(wfs_status, Exception):
+              raise wfs_status
+            for wfid in calls[rid][1][1]:
+              if wfid not in wfs_status:
+                # not valid anymore
+                self.delete_workflow(wfid)
+              elif wfs_status[wfid] != self._workflow_statuses[rid][wfid]:
+                global_wf_state_changed = True
+                self._workflow_statuses[rid][wfid] = wfs_status[wfid]
           if global_wf_state_changed:
             self.emit(QtCore.SIGNAL('global_workflow_state_changed()'))
 
@@ -3473,17 +3689,7 @@ class ApplicationModel(QtCore.QObject):
     using the args, kwargs and return the given default value if the
     timeout_duration is exceeded.
     """
-    class InterruptableThread(QtCore.QThread):
-      def __init__(self):
-        super(InterruptableThread, self).__init__(parent = None)
-        self.result = default
-        self.exception = None
-      def run(self):
-        try:
-          self.result = func(*args, **kwargs)
-        except Exception, e:
-          self.exception = e
-    it = InterruptableThread()
+    it = ApplicationModel.CallThread(func, args, kwargs, default)
     it.start()
     it.wait(msecs=timeout_duration*1000)
     if it.isRunning():
@@ -3494,6 +3700,33 @@ class ApplicationModel(QtCore.QObject):
         raise it.exception
       return it.result
 
+  def connections_timeout(self, calls, default=None):
+    """Same as connection_timeout for several calls run in parallel.
+
+    * calls: dictionary key -> (func, args, timeout_duration)
+
+    * returns: dictionary key -> result of the call, or exception raised 
+      by the call (ConnectionClosedError if the call timed out)
+    """
+    threads = {}
+    for key, (func, args, timeout_duration) in calls.iteritems():
+      threads[key] = ApplicationModel.CallThread(func, args, {}, default)
+      threads[key].start()
+    results = {}
+    start = time.time()
+    for key, it in threads.iteritems():
+      timeout_duration = calls[key][2]
+      remaining = max(0, timeout_duration - (time.time() - start))
+      it.wait(msecs=int(remaining*1000))
+      if it.isRunning():
+        it.terminate()
+        results[key] = ConnectionClosedError("Connection time out")
+      elif it.exception != None:
+        results[key] = it.exception
+      else:
+        results[key] = it.result
+    return results
+
   def list_workflow_names(self, resource_id):
     return self._workflow_names[resource_id].values()
 
@@ -3643,12 +3876,13 @@ class ApplicationModel(QtCore.QObject):
         self._workflow_statuses[self.current_resource_id][workflow_id] = workflow_status
         if self._current_workflow != None:
           try:
-            wf_status = self.current_connection.workflow_elements_status(workflow_id)
+            (wf_version, 
+             wf_status) = self.current_connection.workflow_elements_status_changes(workflow_id)
           except ConnectionClosedError, e:
             #print e
             self.emit(QtCore.SIGNAL('connection_closed_error'))
           else: 
-            self._current_workflow.updateState(wf_status)
+            self._current_workflow.updateState(wf_status, wf_version)
       self.emit(QtCore.SIGNAL('current_workflow_changed()'))
       self.emit(QtCore.SIGNAL('global_workflow_state_changed()'))
 
@@ -3672,13 +3906,14 @@ class ApplicationModel(QtCore.QObject):
         try:
           self._current_workflow = GuiWorkflow(workflow, self.tmp_stderrout_dir)
           self._workflows[self.current_resource_id][self._current_workflow.wf_id] = self._current_workflow
-          wf_status = self.current_connection.workflow_elements_status(self.current_wf_id)
+          (wf_version,
+           wf_status) = self.current_connection.workflow_elements_status_changes(self.current_wf_id)
         except ConnectionClosedError, e:
           #print e
           QtGui.QApplication.restoreOverrideCursor()
           self.emit(QtCore.SIGNAL('connection_closed_error'))
         else: 
-          self._current_workflow.updateState(wf_status)
+          self._current_workflow.updateState(wf_status, wf_version)
 
     return self._current_workflow
 
@@ -3770,6 +4005,11 @@ class GuiWorkflow(object):
   server_jobs = None
 
   queue = None
+
+  # version of the workflow on the server at the last update (see 
+  # WorkflowController.workflow_elements_status_changes). None to get back 
+  # the status of all the elements.
+  version = None
   
   
   def __init__(self, workflow, tmp_stderrout_dir):
@@ -3786,6 +4026,7 @@ class GuiWorkflow(object):
       self.queue = None
 
     self.wf_status = None
+    self.version = None
     
     ids = {} # workflow element => sequence of ids
     self.items = {} # id => WorkflowItem
@@ -3956,10 +4197,17 @@ class GuiWorkflow(object):
     #raw_input()
     ###########################################
     
-  def updateState(self, wf_status):
+  def updateState(self, wf_status, version=None):
+    '''
+    * wf_status: status of the workflow elements, all of them or only the 
+      ones which changed since self.version.
+    * version: version of the workflow on the server corresponding to 
+      wf_status.
+    '''
     if self.wf_id == NOT_SUBMITTED_WF_ID: 
       return False
     data_changed = False
+    self.version = version
 
     self.queue = wf_status[3]
     
@@ -4006,6 +4254,7 @@ class GuiWorkflow(object):
     return data_changed
 
   def restart(self):
+    self.version = None
     for item in self.items.itervalues():
       if isinstance(item, GuiJob):
         item.stdout = ""
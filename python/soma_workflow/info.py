@@ -51,4 +51,4 @@ EXTRA_REQUIRES = {"doc": ["sphinx>="+SPHINX_MIN_VERSION]}
 # Globals and constants
 #-----------------------------------------------------------------------------
 
-DB_VERSION = '1.1'
+DB_VERSION = '1.4'
@@ -13,6 +13,7 @@ from __future__ import with_statement
 
 import subprocess
 import threading
+import errno
 import time
 import logging
 import os
@@ -22,10 +23,20 @@ import ctypes
 import atexit
 import os.path
 import socket
+import heapq
+import itertools
+import collections
+import tempfile
+import shutil
+import pipes
 
 import soma_workflow.constants as constants
+import soma_workflow.observer as observer
 from soma_workflow.errors import DRMError
-from soma_workflow.configuration import LocalSchedulerCfg, Configuration
+from soma_workflow.configuration import LocalSchedulerCfg, Configuration, \
+                                        PARALLEL_CONFIGURATIONS, \
+                                        PARALLEL_DRMAA_ATTRIBUTES, \
+                                        PARALLEL_JOB_ENV
 from soma_workflow.utils import DetectFindLib
 
 _drmaa_lib_env_name = 'DRMAA_LIBRARY_PATH'
@@ -42,9 +53,13 @@ if DRMAA_LIB_FOUND == True:
     from somadrmaa.const import JobControlAction
 
 
-class Scheduler(object):
+class Scheduler(observer.Observable):
   '''
   Allow to submit, kill and get the status of jobs.
+
+  The schedulers able to detect job status changes by themselves notify
+  their observers with the JOB_STATUS_CHANGED event, so that the engine loop
+  does not have to wait for its next iteration to process them.
   '''
   parallel_job_submission_info = None
   
@@ -52,7 +67,10 @@ class Scheduler(object):
 
   is_sleeping = None
 
+  JOB_STATUS_CHANGED = 0
+
   def __init__(self):
+    super(Scheduler, self).__init__()
     self.parallel_job_submission_info = None
     self.is_sleeping = False
 
@@ -73,6 +91,26 @@ class Scheduler(object):
     '''
     raise Exception("Scheduler is an abstract class!")
 
+  def jobs_submission(self, jobs):
+    '''
+    Submission of several jobs at once. The default implementation calls
+    job_submission for each job: the schedulers able to submit jobs in bulk
+    should override it.
+
+    * jobs *sequence of EngineJob*
+    * return: *tuple (dictionary, dictionary)*
+        * job_id -> job id for the scheduling system
+        * job_id -> DRMError, for the jobs which could not be submitted
+    '''
+    scheduler_job_ids = {}
+    errors = {}
+    for job in jobs:
+      try:
+        scheduler_job_ids[job.job_id] = self.job_submission(job)
+      except DRMError, e:
+        errors[job.job_id] = e
+    return (scheduler_job_ids, errors)
+
   def get_job_status(self, scheduler_job_id):
     '''
     * scheduler_job_id *string*
@@ -82,6 +120,28 @@ class Scheduler(object):
     '''
     raise Exception("Scheduler is an abstract class!")
 
+  def get_jobs_status(self, scheduler_job_ids):
+    '''
+    Status of several jobs at once. The default implementation calls 
+    get_job_status for each job: the schedulers able to get the status of the
+    jobs in bulk should override it.
+
+    * scheduler_job_ids *sequence of string*
+        Job ids for the scheduling system (DRMAA for example)
+    * return: *tuple (dictionary, dictionary)*
+        * scheduler_job_id -> job status as defined in constants.JOB_STATUS
+        * scheduler_job_id -> DRMError, for the jobs whose status could not 
+          be retrieved
+    '''
+    status = {}
+    errors = {}
+    for scheduler_job_id in scheduler_job_ids:
+      try:
+        status[scheduler_job_id] = self.get_job_status(scheduler_job_id)
+      except DRMError, e:
+        errors[scheduler_job_id] = e
+    return (status, errors)
+
   def get_job_exit_info(self, scheduler_job_id):
     '''
     * scheduler_job_id *string*
@@ -126,6 +186,46 @@ if DRMAA_LIB_FOUND==True:
   
         is_sleeping = False
         FAKE_JOB = -167
+
+        # exit information of the jobs harvested by _reap_ended_jobs, until 
+        # it is retrieved with get_job_exit_info.
+        # dictionary: scheduler_job_id -> (exit_status, exit_value, term_sig,
+        #                                  resource_usage)
+        _reaped_jobs = None
+
+        # status of the jobs which did not end, cached between the calls to
+        # get_jobs_status (one call per iteration of the engine loop).
+        # dictionary: scheduler_job_id -> status
+        _status_cache = None
+
+        # ids of the jobs of _status_cache, the least recently requested 
+        # first. collections.deque of scheduler_job_id
+        _status_order = None
+
+        # The ended jobs are reaped in bulk at each call to get_jobs_status.
+        # The status of the other jobs (queued, running...) is requested 
+        # again to the DRMS at the next call, for max_status_requests jobs at
+        # most: the least recently requested ones. When more jobs are 
+        # followed, the cached status of the others is used during a few more
+        # calls. The jobs which were not submitted in the current DRMAA 
+        # session (and which can not be reaped) are seen ending this way.
+        max_status_requests = 200
+
+        # minimum number of jobs sharing a job template to submit them as a 
+        # job array (see jobs_submission)
+        job_array_min_size = 2
+
+        # tasks of the job arrays which did not end, for each job array 
+        # directory.
+        # dictionary: directory -> set of scheduler_job_id
+        _job_arrays = None
+
+        # job array directory of the tasks which did not end
+        # dictionary: scheduler_job_id -> directory
+        _job_array_tasks = None
+
+        # the jobs may be submitted and reaped by different threads
+        _job_array_lock = None
   
           
         def __init__(self, 
@@ -135,8 +235,17 @@ if DRMAA_LIB_FOUND==True:
                      configured_native_spec=None):
   
           import somadrmaa
+
+          super(DrmaaCTypes, self).__init__()
   
           self.logger = logging.getLogger('ljp.drmaajs')
+
+          self._reaped_jobs = {}
+          self._status_cache = {}
+          self._status_order = collections.deque()
+          self._job_arrays = {}
+          self._job_array_tasks = {}
+          self._job_array_lock = threading.Lock()
           
           self.wake()
    
@@ -250,7 +359,7 @@ if DRMAA_LIB_FOUND==True:
           self.logger.debug(">> _setDrmaaParallelJob")
           cluster_specific_cfg_name = self.parallel_job_submission_info[configuration_name]
           
-          for drmaa_attribute in constants.PARALLEL_DRMAA_ATTRIBUTES:
+          for drmaa_attribute in PARALLEL_DRMAA_ATTRIBUTES:
             value = self.parallel_job_submission_info.get(drmaa_attribute)
             if value: 
               value = value.replace("{config_name}", cluster_specific_cfg_name)
@@ -264,7 +373,7 @@ if DRMAA_LIB_FOUND==True:
       
       
           job_env = []
-          for parallel_env_v in constants.PARALLEL_JOB_ENV:
+          for parallel_env_v in PARALLEL_JOB_ENV:
             value = self.parallel_job_submission_info.get(parallel_env_v)
             if value: job_env.append((parallel_env_v,value.rstrip()))
   
@@ -276,6 +385,47 @@ if DRMAA_LIB_FOUND==True:
           return drmaa_job_template_id
      
      
+        def _set_template_resources(self, jobTemplateId, job):
+          '''
+          Sets the DRMAA job template attributes which do not depend on the
+          command and files of the job: native specification, queue,
+          parallel job information and environment.
+          '''
+          self.logger.debug("JOB NATIVE_SPEC " + repr(job.native_specification))
+          self.logger.debug("CONFIGURED NATIVE SPEC " + repr(self._configured_native_spec))
+          native_spec = None
+
+          if job.native_specification:
+            native_spec = job.native_specification
+          elif self._configured_native_spec:
+            native_spec = self._configured_native_spec
+          
+          if job.queue and native_spec:
+            jobTemplateId.nativeSpecification="-q " + str(job.queue) + " " + str(native_spec)
+            self.logger.debug("NATIVE specification " + "-q " + str(job.queue) + " " + str(native_spec))
+          elif job.queue:
+            jobTemplateId.nativeSpecification="-q " + str(job.queue)
+            self.logger.debug("NATIVE specification " + "-q " + str(job.queue))
+          elif native_spec:
+            jobTemplateId.nativeSpecification=str(native_spec)
+            self.logger.debug("NATIVE specification " + str(native_spec))
+      
+          
+          if job.parallel_job_info :
+            parallel_config_name, max_node_number = job.parallel_job_info
+            jobTemplateId=self._setDrmaaParallelJob(jobTemplateId, 
+                                      parallel_config_name, 
+                                      max_node_number)
+           
+          if self._drmaa_implementation == "PBS": 
+            job_env = []
+            for var_name in os.environ.keys():
+              #job_env.append(var_name+"="+os.environ[var_name])
+              job_env.append((var_name,os.environ[var_name]))
+            jobTemplateId.jobEnvironment=dict(job_env)
+
+          return jobTemplateId
+
         def job_submission(self, job):
           '''
           @type  job: soma_workflow.client.Job
@@ -346,38 +496,7 @@ if DRMAA_LIB_FOUND==True:
             if working_directory:
               jobTemplateId.workingDirectory=working_directory
   
-            self.logger.debug("JOB NATIVE_SPEC " + repr(job.native_specification))
-            self.logger.debug("CONFIGURED NATIVE SPEC " + repr(self._configured_native_spec))
-            native_spec = None
-  
-            if job.native_specification:
-              native_spec = job.native_specification
-            elif self._configured_native_spec:
-              native_spec = self._configured_native_spec
-            
-            if job.queue and native_spec:
-              jobTemplateId.nativeSpecification="-q " + str(job.queue) + " " + str(native_spec)
-              self.logger.debug("NATIVE specification " + "-q " + str(job.queue) + " " + str(native_spec))
-            elif job.queue:
-              jobTemplateId.nativeSpecification="-q " + str(job.queue)
-              self.logger.debug("NATIVE specification " + "-q " + str(job.queue))
-            elif native_spec:
-              jobTemplateId.nativeSpecification=str(native_spec)
-              self.logger.debug("NATIVE specification " + str(native_spec))
-        
-            
-            if job.parallel_job_info :
-              parallel_config_name, max_node_number = job.parallel_job_info
-              jobTemplateId=self._setDrmaaParallelJob(jobTemplateId, 
-                                        parallel_config_name, 
-                                        max_node_number)
-             
-            if self._drmaa_implementation == "PBS": 
-              job_env = []
-              for var_name in os.environ.keys():
-                #job_env.append(var_name+"="+os.environ[var_name])
-                job_env.append((var_name,os.environ[var_name]))
-              jobTemplateId.jobEnvironment=dict(job_env)
+            jobTemplateId = self._set_template_resources(jobTemplateId, job)
   
             self.logger.debug("before submit command: " + repr(command))
             self.logger.debug("before submit job.name=" + repr(job.name)) 
@@ -395,6 +514,170 @@ if DRMAA_LIB_FOUND==True:
             raise DRMError("Job submission error: %s" %(e))
        
           return drmaaSubmittedJobId
+
+        def jobs_submission(self, jobs):
+          '''
+          The jobs which can share a DRMAA job template (same queue, native
+          specification, parallel job information and output files 
+          settings) are submitted together as job arrays (runBulkJobs) 
+          when they are at least job_array_min_size. If the job array can
+          not be submitted the jobs are submitted one by one.
+          The jobs without working directory are submitted one by one: they
+          run in the default DRMAA working directory, and the tasks of a job
+          array run in their own directory.
+          '''
+          if self.is_sleeping: self.wake()
+          scheduler_job_ids = {}
+          errors = {}
+          job_sets = {}
+          job_set_keys = [] # in the order of the jobs
+          for job in jobs:
+            if job.is_barrier or not job.plain_working_directory():
+              key = None
+            else:
+              # the parallel_job_info of a workflow loaded from a JSON file
+              # is a list
+              if job.parallel_job_info:
+                parallel_job_info = tuple(job.parallel_job_info)
+              else:
+                parallel_job_info = None
+              key = (job.queue,
+                     job.native_specification,
+                     parallel_job_info,
+                     job.join_stderrout,
+                     job.plain_stderr() != None,
+                     job.plain_stdin() != None)
+            if key not in job_sets:
+              job_sets[key] = []
+              job_set_keys.append(key)
+            job_sets[key].append(job)
+
+          for key in job_set_keys:
+            job_set = job_sets[key]
+            if key != None and len(job_set) >= self.job_array_min_size:
+              try:
+                scheduler_job_ids.update(self._job_array_submission(job_set))
+                continue
+              except DRMError, e:
+                self.logger.warning("The jobs are submitted one by one: %s" 
+                                    %(e))
+            for job in job_set:
+              try:
+                scheduler_job_ids[job.job_id] = self.job_submission(job)
+              except DRMError, e:
+                errors[job.job_id] = e
+          return (scheduler_job_ids, errors)
+
+        def _job_array_submission(self, jobs):
+          '''
+          Submits the jobs as one job array. DRMAA only replaces the task 
+          index (JobTemplate.PARAMETRIC_INDEX) in the paths of the job 
+          template: each task runs in a directory of its own, named after its
+          index, which holds a shell script running the command of the job
+          and links to its standard files.
+
+          * jobs *sequence of EngineJob*
+            The jobs must share their job template attributes and have a 
+            working directory.
+          * return: *dictionary*
+            job_id -> drmaa job id
+          '''
+          import somadrmaa
+          index = somadrmaa.JobTemplate.PARAMETRIC_INDEX
+
+          array_dir = None
+          try:
+            array_dir = tempfile.mkdtemp(prefix="soma-workflow-job-array-",
+                                         dir=self.tmp_file_path)
+            for task_index, job in enumerate(jobs):
+              task_dir = os.path.join(array_dir, str(task_index + 1))
+              os.mkdir(task_dir)
+              script = open(os.path.join(task_dir, "job.sh"), "w")
+              script.write("cd %s || exit 1\n" % DrmaaCTypes._shell_quote(
+                                              job.plain_working_directory()))
+              script.write("exec %s\n" % " ".join(
+                                    DrmaaCTypes._shell_quote(command_el)
+                                    for command_el in job.plain_command()))
+              script.close()
+              os.symlink(job.plain_stdout(), 
+                         os.path.join(task_dir, "stdout"))
+              if job.plain_stderr():
+                os.symlink(job.plain_stderr(), 
+                           os.path.join(task_dir, "stderr"))
+              if job.plain_stdin():
+                os.symlink(job.plain_stdin(), 
+                           os.path.join(task_dir, "stdin"))
+          except (IOError, OSError), e:
+            if array_dir:
+              shutil.rmtree(array_dir, ignore_errors=True)
+            self.logger.error("Error in job array creation: %s" %(e))
+            raise DRMError("Job array creation error: %s" %(e))
+
+          task_dir = os.path.join(array_dir, index)
+          job = jobs[0]
+          try:
+            jobTemplateId = self._drmaa.createJobTemplate()
+            jobTemplateId.remoteCommand = "/bin/sh"
+            jobTemplateId.args = ["job.sh"]
+            jobTemplateId.workingDirectory = task_dir
+            jobTemplateId.outputPath = "%s:%s" %(self.hostname, 
+                                         os.path.join(task_dir, "stdout"))
+            if job.join_stderrout:
+              jobTemplateId.joinFiles = "y" 
+            elif job.plain_stderr():
+              jobTemplateId.errorPath = "%s:%s" %(self.hostname, 
+                                          os.path.join(task_dir, "stderr"))
+            if job.plain_stdin():
+              jobTemplateId.inputPath = os.path.join(task_dir, "stdin")
+            jobTemplateId = self._set_template_resources(jobTemplateId, job)
+
+            self.logger.debug("submit a job array of %d jobs in %s" 
+                              %(len(jobs), array_dir))
+            # the tasks must be registered before they are reaped
+            with self._job_array_lock:
+              drmaa_ids = self._drmaa.runBulkJobs(jobTemplateId, 
+                                                  1, len(jobs), 1)
+              self._job_arrays[array_dir] = set(drmaa_ids)
+              for drmaa_id in drmaa_ids:
+                self._job_array_tasks[drmaa_id] = array_dir
+            self._drmaa.deleteJobTemplate(jobTemplateId)
+          except DrmaaException, e:
+            shutil.rmtree(array_dir, ignore_errors=True)
+            self.logger.error("Error in job array submission: %s" %(e))
+            raise DRMError("Job array submission error: %s" %(e))
+
+          scheduler_job_ids = {}
+          for job, drmaa_id in zip(jobs, drmaa_ids):
+            scheduler_job_ids[job.job_id] = drmaa_id
+          return scheduler_job_ids
+
+        @staticmethod
+        def _shell_quote(arg):
+          '''
+          Quotes a command element for the shell scripts of the job arrays.
+          The unicode strings are encoded in UTF-8, the other elements (
+          numbers for example) are converted to strings.
+          '''
+          if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+          else:
+            arg = str(arg)
+          return pipes.quote(arg)
+
+        def _job_array_task_ended(self, scheduler_job_id):
+          '''
+          The directory of a job array is removed once all its tasks ended.
+          '''
+          with self._job_array_lock:
+            array_dir = self._job_array_tasks.pop(scheduler_job_id, None)
+            if array_dir == None:
+              return
+            tasks = self._job_arrays[array_dir]
+            tasks.discard(scheduler_job_id)
+            if tasks:
+              return
+            del self._job_arrays[array_dir]
+          shutil.rmtree(array_dir, ignore_errors=True)
   
         def kill_job(self, scheduler_job_id):
           if self.is_sleeping: self.wake()
@@ -405,12 +688,16 @@ if DRMAA_LIB_FOUND==True:
           except DrmaaException, e:
             self.logger.critical("%s" %e)
             raise e
+          self._job_array_task_ended(scheduler_job_id)
 
         def get_job_status(self, scheduler_job_id):
           if self.is_sleeping: self.wake()
           if scheduler_job_id == self.FAKE_JOB:
             # a barrier job is done as soon as it is started.
             return constants.DONE
+          if scheduler_job_id in self._reaped_jobs:
+            # the DRMS may have forgotten the job once it was reaped
+            return self._reaped_job_status(scheduler_job_id)
           try:
             status = self._drmaa.jobStatus(scheduler_job_id)
           except DrmaaException, e:
@@ -418,6 +705,98 @@ if DRMAA_LIB_FOUND==True:
             raise DRMError("%s" %(e))
           return status
 
+        def get_jobs_status(self, scheduler_job_ids):
+          '''
+          The jobs which ended are reaped in bulk. The status of the other 
+          jobs is requested for the new jobs and for max_status_requests jobs
+          at most among the others, which status was requested the least 
+          recently: the cache is used for the remaining jobs.
+          '''
+          if self.is_sleeping: self.wake()
+          newly_reaped = self._reap_ended_jobs()
+          self._reaped_jobs.update(newly_reaped)
+          scheduler_job_ids = set(scheduler_job_ids)
+
+          # the jobs which ended or which are not followed any more are 
+          # removed from the cache
+          for scheduler_job_id in self._status_cache.keys():
+            if scheduler_job_id not in scheduler_job_ids or \
+                scheduler_job_id in self._reaped_jobs:
+              del self._status_cache[scheduler_job_id]
+          self._status_order = collections.deque(
+                                  scheduler_job_id 
+                                  for scheduler_job_id in self._status_order
+                                  if scheduler_job_id in self._status_cache)
+          requested = [scheduler_job_id 
+                       for scheduler_job_id in scheduler_job_ids 
+                       if scheduler_job_id not in self._status_cache]
+          for i in range(min(self.max_status_requests, 
+                             len(self._status_order))):
+            requested.append(self._status_order.popleft())
+
+          status = {}
+          errors = {}
+          for scheduler_job_id in requested:
+            self._status_cache.pop(scheduler_job_id, None)
+            try:
+              job_status = self.get_job_status(scheduler_job_id)
+            except DRMError, e:
+              errors[scheduler_job_id] = e
+              continue
+            status[scheduler_job_id] = job_status
+            if job_status != constants.DONE and \
+                job_status != constants.FAILED:
+              # most recently requested: at the end
+              self._status_cache[scheduler_job_id] = job_status
+              self._status_order.append(scheduler_job_id)
+          for scheduler_job_id in scheduler_job_ids:
+            if scheduler_job_id not in status and \
+                scheduler_job_id not in errors:
+              status[scheduler_job_id] = self._status_cache[scheduler_job_id]
+
+          # the reaped jobs which are not followed any more (the killed jobs 
+          # for example) are forgotten
+          for scheduler_job_id in self._reaped_jobs.keys():
+            if scheduler_job_id not in scheduler_job_ids and \
+                scheduler_job_id not in newly_reaped:
+              del self._reaped_jobs[scheduler_job_id]
+          return (status, errors)
+
+        def _reap_ended_jobs(self):
+          '''
+          Harvests all the jobs of the session which ended, without waiting.
+
+          * returns: *dictionary*
+            scheduler_job_id -> (exit_status, exit_value, term_sig, 
+                                 resource_usage)
+          '''
+          reaped_jobs = {}
+          while True:
+            try:
+              job_info = self._drmaa.wait(self._drmaa.JOB_IDS_SESSION_ANY, 
+                                          self._drmaa.TIMEOUT_NO_WAIT)
+            except ExitTimeoutException:
+              # no other job ended
+              break
+            except InvalidJobException:
+              # no job left in the session
+              break
+            except DrmaaException, e:
+              self.logger.error("Error while reaping the ended jobs: %s" %(e))
+              break
+            scheduler_job_id = job_info[0]
+            self.logger.debug("  ==> reaped job %s" %(scheduler_job_id))
+            reaped_jobs[scheduler_job_id] = self._exit_info(job_info)
+            # DRMAA may leave files in ~/.drmaa
+            self.cleanup_drmaa_files(scheduler_job_id)
+            self._job_array_task_ended(scheduler_job_id)
+          return reaped_jobs
+
+        def _reaped_job_status(self, scheduler_job_id):
+          if self._reaped_jobs[scheduler_job_id][0] == constants.EXIT_ABORTED:
+            return constants.FAILED
+          return constants.DONE
+
         def get_job_exit_info(self, scheduler_job_id):
           if self.is_sleeping: self.wake()
   
@@ -429,6 +808,12 @@ if DRMAA_LIB_FOUND==True:
             return (res_status, res_exitValue, res_termSignal,
               res_resourceUsage)
 
+          # its id is removed from _status_order at the next call to
+          # get_jobs_status
+          self._status_cache.pop(scheduler_job_id, None)
+          if scheduler_job_id in self._reaped_jobs:
+            return self._reaped_jobs.pop(scheduler_job_id)
+
           res_resourceUsage=[]
           res_status = constants.EXIT_UNDETERMINED
           res_exitValue = 0
@@ -436,45 +821,63 @@ if DRMAA_LIB_FOUND==True:
   
           try:
             self.logger.debug("  ==> Start to find info of job %s"%(scheduler_job_id)) 
-            jid_out, exit_value, signaled, term_sig, coredumped, aborted,exit_status,resource_usage=self._drmaa.wait(scheduler_job_id, self._drmaa.TIMEOUT_NO_WAIT)
-            
-            self.logger.debug("  ==> jid_out="+repr(jid_out))
-            self.logger.debug("  ==> exit_value="+repr(exit_value))
-            self.logger.debug("  ==> signaled="+repr(signaled))
-            self.logger.debug("  ==> term_sig="+repr(term_sig))
-            self.logger.debug("  ==> coredumped="+repr(coredumped))
-            self.logger.debug("  ==> aborted="+repr(aborted))
-            self.logger.debug("  ==> exit_status="+repr(exit_status))
-            self.logger.debug("  ==> resource_usage="+repr(resource_usage))
-    
-            if aborted == 1:
-              res_status=constants.EXIT_ABORTED
-            else:
-              if exit_value == 1:
-                res_status=constants.FINISHED_REGULARLY
-                res_exitValue=exit_status
-              else :
-                if signaled == 1:
-                  res_status=constants.FINISHED_TERM_SIG
-                  res_termSignal=term_sig
-                else:
-                  res_status=constants.FINISHED_UNCLEAR_CONDITIONS
-    
-  
-            res_resourceUsage = ''
-            for k,v in resource_usage.iteritems():
-              res_resourceUsage = res_resourceUsage + k + '=' + v + ' '
-  
-  
+            job_info = self._drmaa.wait(scheduler_job_id, 
+                                        self._drmaa.TIMEOUT_NO_WAIT)
+            (res_status, 
+             res_exitValue, 
+             res_termSignal, 
+             res_resourceUsage) = self._exit_info(job_info)
           except ExitTimeoutException:
             res_status = constants.EXIT_UNDETERMINED
             self.logger.debug("  ==> self._drmaa.wait time out")
 
           # DRMAA may leave files in ~/.drmaa
           self.cleanup_drmaa_files(scheduler_job_id)
+          self._job_array_task_ended(scheduler_job_id)
 
           return (res_status,res_exitValue , res_termSignal, res_resourceUsage)
 
+        def _exit_info(self, job_info):
+          '''
+          Converts the information returned by the DRMAA wait function.
+
+          * returns: *tuple*
+            exit_status, exit_value, term_sig, resource_usage
+          '''
+          res_status = constants.EXIT_UNDETERMINED
+          res_exitValue = 0
+          res_termSignal = None        
+
+          jid_out, exit_value, signaled, term_sig, coredumped, aborted,exit_status,resource_usage=job_info
+            
+          self.logger.debug("  ==> jid_out="+repr(jid_out))
+          self.logger.debug("  ==> exit_value="+repr(exit_value))
+          self.logger.debug("  ==> signaled="+repr(signaled))
+          self.logger.debug("  ==> term_sig="+repr(term_sig))
+          self.logger.debug("  ==> coredumped="+repr(coredumped))
+          self.logger.debug("  ==> aborted="+repr(aborted))
+          self.logger.debug("  ==> exit_status="+repr(exit_status))
+          self.logger.debug("  ==> resource_usage="+repr(resource_usage))
+    
+          if aborted == 1:
+            res_status=constants.EXIT_ABORTED
+          else:
+            if exit_value == 1:
+              res_status=constants.FINISHED_REGULARLY
+              res_exitValue=exit_status
+            else :
+              if signaled == 1:
+                res_status=constants.FINISHED_TERM_SIG
+                res_termSignal=term_sig
+              else:
+                res_status=constants.FINISHED_UNCLEAR_CONDITIONS
+    
+          res_resourceUsage = ''
+          for k,v in resource_usage.iteritems():
+            res_resourceUsage = res_resourceUsage + k + '=' + v + ' '
+
+          return (res_status, res_exitValue, res_termSignal, res_resourceUsage)
+
         def cleanup_drmaa_files(self, scheduler_job_id):
           filename = os.path.join(Configuration.get_home_dir(),
             '.drmaa', str(scheduler_job_id))
@@ -493,9 +896,32 @@ class LocalScheduler(Scheduler):
   Allow to submit, kill and get the status of jobs.
   Run on one machine without dependencies.
 
+  The end of each process is waited for by a thread of its own, which 
+  reaps the process and wakes the scheduler loop up so that the next job
+  starts at once. (Reaping any child of the process with os.wait would 
+  steal the children of the application using the scheduler.)
+
+  Each job takes as many CPU slots as the number of CPU declared in its
+  parallel_job_info (one slot for a serial job), and optionally a memory 
+  budget. A job starts only if the free slots and memory are enough. When 
+  the first job of the queue does not fit, smaller jobs further in the 
+  queue are started in the free slots (backfilling). A waiting job can be 
+  overtaken by at most _proc_nb jobs: then nothing starts before it.
+
   * _proc_nb *int*
+    Number of CPU slots.
 
-  * _queue *list of scheduler jobs ids*
+  * _max_memory *int or None*
+    Memory available to the jobs in MB. None: the memory is not accounted.
+
+  * _job_memory *int or None*
+    Memory budget in MB of the jobs which do not declare their memory.
+
+  * _queue *heap of tuple (-priority, submission order, scheduler job id)*
+    The jobs killed while they are queued stay in the heap but are no 
+    longer in _jobs.
+  
+  * _queue_order *itertools.count*
   
   * _jobs *dictionary job_id -> soma_workflow.engine_types.EngineJob*
   
@@ -505,11 +931,22 @@ class LocalScheduler(Scheduler):
 
   * _exit_info * dictionay job_id -> exit info*
 
+  * _ended_jobs *list of job_id*
+    Jobs reaped since the last iteration of the scheduler loop.
+
+  * _overtaken *dictionary job_id -> int*
+    Number of jobs started before each queued job by backfilling.
+
   * _loop *thread*
 
   * _interval *int*
+    Maximum delay between two iterations of the scheduler loop. The loop 
+    is woken up on job submission and on process end, so this delay only
+    matters if a wake up is missed.
 
   * _look *threading.RLock*
+
+  * _wakeup_event *threading.Event*
   '''
   parallel_job_submission_info = None
   
@@ -517,8 +954,14 @@ class LocalScheduler(Scheduler):
 
   _proc_nb = None
 
+  _max_memory = None
+
+  _job_memory = None
+
   _queue = None
 
+  _queue_order = None
+
   _jobs = None 
   
   _processes = None
@@ -527,34 +970,61 @@ class LocalScheduler(Scheduler):
 
   _exit_info = None
 
+  _ended_jobs = None
+
+  _overtaken = None
+
   _loop = None
 
   _interval = None
 
   _lock = None
 
-  def __init__(self, proc_nb=1, interval=1):
+  _wakeup_event = None
+
+  # number of queued jobs looked at past the jobs which do not fit in the 
+  # free slots and memory
+  backfill_depth = 100
+
+  # return code of the processes reaped by someone else: their exit status
+  # is lost
+  LOST_RETURN_CODE = object()
+
+  def __init__(self, proc_nb=1, interval=1, max_memory=None, job_memory=None):
     super(LocalScheduler, self).__init__()
   
-    self.parallel_job_submission_info = None
+    # the parallel jobs run on the local machine: any configuration is
+    # accepted, the parallel_job_info only tells the number of CPU slots
+    self.parallel_job_submission_info = dict((configuration, None) 
+                            for configuration in PARALLEL_CONFIGURATIONS)
 
     self._proc_nb = proc_nb
+    self._max_memory = max_memory
+    self._job_memory = job_memory
     self._interval = interval
     self._queue = []
+    self._queue_order = itertools.count()
     self._jobs = {}
     self._processes = {}
     self._status = {}
     self._exit_info = {}
+    self._ended_jobs = []
+    self._overtaken = {}
 
     self._lock = threading.RLock()
 
+    # set on job submission and on process end to start the jobs without 
+    # waiting for the end of the interval
+    self._wakeup_event = threading.Event()
+
     self.stop_thread_loop = False
 
     def loop(self):
       while not self.stop_thread_loop:
         with self._lock:
           self._iterate()
-        time.sleep(self._interval)
+        self._wakeup_event.wait(self._interval)
+        self._wakeup_event.clear()
 
     self._loop = threading.Thread(name="scheduler_loop",
                                   target=loop,
@@ -567,6 +1037,13 @@ class LocalScheduler(Scheduler):
   def change_proc_nb(self, proc_nb):
     with self._lock:
       self._proc_nb = proc_nb
+    self._wakeup_event.set()
+
+  def change_memory(self, max_memory, job_memory):
+    with self._lock:
+      self._max_memory = max_memory
+      self._job_memory = job_memory
+    self._wakeup_event.set()
 
   def change_interval(self, interval):
     with self._lock:
@@ -575,58 +1052,182 @@ class LocalScheduler(Scheduler):
   def end_scheduler_thread(self):
     with self._lock:
       self.stop_thread_loop = True
+      self._wakeup_event.set()
       self._loop.join()
       #print "Soma scheduler thread ended nicely."
 
+  def _job_slots(self, job):
+    '''
+    Number of CPU slots taken by the job. A job declaring more CPU than
+    the scheduler has takes all the slots: it runs alone.
+    '''
+    if job.is_barrier:
+      return 0
+    if job.parallel_job_info:
+      return max(1, min(job.parallel_job_info[1], self._proc_nb))
+    return 1
+
+  def _job_memory_budget(self, job):
+    '''
+    Memory taken by the job in MB: the memory declared by the job, or 
+    _job_memory. A job needing more memory than the scheduler has takes all
+    the memory: it runs alone.
+    '''
+    if job.is_barrier or not self._max_memory:
+      return 0
+    memory = job.memory
+    if not memory:
+      memory = self._job_memory
+    if not memory:
+      return 0
+    return min(memory, self._max_memory)
+
   def _iterate(self):
-    # Nothing to do if the queue is empty and nothing is running
-    if not self._queue and not self._processes:
-      return
-    #print "#############################"
-    # Control the running jobs
-    ended_jobs = []
-    for job_id, process in self._processes.iteritems():
-      ret_value = process.poll()
-      #print "job_id " + repr(job_id) + " ret_value " + repr(ret_value)
-      if ret_value != None:
-        ended_jobs.append(job_id) 
-        self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
-                                     ret_value,
-                                     None,
-                                     None)
-
-    # update for the ended job
-    for job_id in ended_jobs:
-      #print "updated job_id " + repr(job_id) + " status DONE"
-      self._status[job_id] = constants.DONE
-      del self._processes[job_id]
+    ended_jobs = self._ended_jobs
+    self._ended_jobs = []
+
+    free_slots = self._proc_nb
+    free_memory = self._max_memory
+    for job_id in self._processes:
+      job = self._jobs[job_id]
+      free_slots -= self._job_slots(job)
+      if self._max_memory:
+        free_memory -= self._job_memory_budget(job)
 
     # run new jobs
-    while (self._queue and
-           len(self._processes) < self._proc_nb):
-      job_id = self._queue.pop(0)
+    started_jobs = False
+    # queue entries of the jobs which do not fit yet
+    blocked = []
+    # the loop goes on when all the slots are taken: the barrier jobs take
+    # no slot
+    while self._queue and len(blocked) <= self.backfill_depth:
+      entry = heapq.heappop(self._queue)
+      job_id = entry[2]
+      if job_id not in self._jobs:
+        # killed while queued
+        continue
       job = self._jobs[job_id]
-      #print "new job " + repr(job.job_id)
-      if job.is_barrier:
-        # barrier jobs are not actually run using Popen:
-        # they succeed immediately.
-        self._exit_info[job.job_id] = (constants.FINISHED_REGULARLY,
-                                  0,
+      slots = self._job_slots(job)
+      memory = self._job_memory_budget(job)
+      if slots > free_slots or (self._max_memory and memory > free_memory):
+        blocked.append(entry)
+        if self._overtaken.get(job_id, 0) >= self._proc_nb:
+          # the job waited long enough: the slots are kept for it
+          break
+        continue
+      if slots:
+        for blocked_entry in blocked:
+          blocked_job_id = blocked_entry[2]
+          self._overtaken[blocked_job_id] = \
+                                  self._overtaken.get(blocked_job_id, 0) + 1
+      self._overtaken.pop(job_id, None)
+      free_slots -= slots
+      if self._max_memory:
+        free_memory -= memory
+      started_jobs = True
+      self._start_job(job)
+    for entry in blocked:
+      heapq.heappush(self._queue, entry)
+
+    if ended_jobs or started_jobs:
+      self.notifyObservers(Scheduler.JOB_STATUS_CHANGED)
+
+  def _start_job(self, job):
+    #print "new job " + repr(job.job_id)
+    if job.is_barrier:
+      # barrier jobs are not actually run using Popen:
+      # they succeed immediately.
+      self._exit_info[job.job_id] = (constants.FINISHED_REGULARLY,
+                                0,
+                                None,
+                                None)
+      self._status[job.job_id] = constants.DONE
+    else:
+      process = LocalScheduler.create_process(job)
+      if process == None:
+        self._exit_info[job.job_id] = (constants.EXIT_ABORTED,
+                                  None,
                                   None,
                                   None)
-        self._status[job.job_id] = constants.DONE
+        self._status[job.job_id] = constants.FAILED
       else:
-        process = LocalScheduler.create_process(job)
-        if process == None:
-          self._exit_info[job.job_id] = (constants.EXIT_ABORTED,
-                                    None,
-                                    None,
-                                    None)
-          self._status[job.job_id] = constants.FAILED
-        else:
-          self._processes[job.job_id] = process
-          self._status[job.job_id] = constants.RUNNING
+        self._processes[job.job_id] = process
+        self._status[job.job_id] = constants.RUNNING
+        reaper = threading.Thread(name="job_%s_reaper" % job.job_id,
+                                  target=self._reap_process,
+                                  args=[job.job_id, process, time.time()])
+        reaper.setDaemon(True)
+        reaper.start()
+
+  def _reap_process(self, job_id, process, start_time):
+    '''
+    Waits for the end of the process of the job and reaps it.
+    Run in a thread of its own.
 
+    The resource usage is recorded in the format of the DRMAA schedulers:
+    "key=value " items for the wall clock time, user and system CPU times
+    (seconds) and maximum resident set size (KB on Linux). It is not
+    available on Windows.
+    '''
+    (ret_value, rusage) = LocalScheduler._wait_process(process)
+    resource_usage = None
+    if rusage != None:
+      resource_usage = "ru_wallclock=%.3f ru_utime=%.3f ru_stime=%.3f " \
+                       "ru_maxrss=%d " % (time.time() - start_time,
+                                          rusage.ru_utime,
+                                          rusage.ru_stime,
+                                          rusage.ru_maxrss)
+    with self._lock:
+      if self._processes.get(job_id) is not process:
+        # the job was killed
+        return
+      del self._processes[job_id]
+      if ret_value is LocalScheduler.LOST_RETURN_CODE:
+        self._exit_info[job_id] = (constants.FINISHED_UNCLEAR_CONDITIONS,
+                                   None,
+                                   None,
+                                   resource_usage)
+        self._status[job_id] = constants.FAILED
+      else:
+        self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
+                                   ret_value,
+                                   None,
+                                   resource_usage)
+        self._status[job_id] = constants.DONE
+      self._ended_jobs.append(job_id)
+    # a process slot was released
+    self._wakeup_event.set()
+
+  @staticmethod
+  def _wait_process(process):
+    '''
+    Waits for the end of the process and reaps it with os.wait4 to get its
+    resource usage.
+
+    * returns: *tuple*
+      return code (as subprocess.Popen.returncode, LOST_RETURN_CODE if 
+      the process was reaped by someone else), resource usage 
+      (resource.struct_rusage or None)
+    '''
+    if not hasattr(os, "wait4"):
+      return (process.wait(), None)
+    while True:
+      try:
+        (pid, status, rusage) = os.wait4(process.pid, 0)
+        break
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.ECHILD:
+          # the process was reaped by someone else
+          process.returncode = LocalScheduler.LOST_RETURN_CODE
+          return (process.returncode, None)
+        raise
+    if os.WIFSIGNALED(status):
+      process.returncode = -os.WTERMSIG(status)
+    else:
+      process.returncode = os.WEXITSTATUS(status)
+    return (process.returncode, rusage)
 
   @staticmethod
   def create_process(engine_job):
@@ -708,11 +1309,13 @@ class LocalScheduler(Scheduler):
       raise LocalSchedulerError("Invalid job: no id")
     with self._lock:
       #print "job submission " + repr(job.job_id)
-      self._queue.append(job.job_id)
+      # highest priority first, then submission order
+      heapq.heappush(self._queue, (-job.priority, 
+                                   self._queue_order.next(), 
+                                   job.job_id))
       self._jobs[job.job_id] = job
       self._status[job.job_id] = constants.QUEUED_ACTIVE
-      self._queue.sort(key=lambda job_id: self._jobs[job_id].priority, 
-                       reverse=True)
+    self._wakeup_event.set()
     return job.job_id
 
 
@@ -755,19 +1358,9 @@ class LocalScheduler(Scheduler):
       if scheduler_job_id in self._processes:
         #print "    => kill the process "
         process = self._processes[scheduler_job_id]
-        if sys.version_info < (2, 6):
-          if sys.platform == 'win32':
-            PROCESS_TERMINATE = 1
-            handle = ctypes.windll.kernel32.OpenProcess(PROCESS_TERMINATE, 
-                                               False, 
-                                               process.pid)
-            ctypes.windll.kernel32.TerminateProcess(handle, -1)
-            ctypes.windll.kernel32.CloseHandle(handle)
-          else:
-            os.kill(process.pid, signal.SIGKILL)
-            os.wait()
-        else:
-          process.kill()
+        if not LocalScheduler._kill_process(process):
+          # the process ended: its reaper thread records it
+          return
 
         del self._processes[scheduler_job_id]
         self._status[scheduler_job_id] = constants.FAILED
@@ -775,10 +1368,14 @@ class LocalScheduler(Scheduler):
                                               None,
                                               None,
                                               None)
-      elif scheduler_job_id in self._queue:
+        # a process slot was released
+        self._wakeup_event.set()
+      elif scheduler_job_id in self._jobs and \
+          self._status[scheduler_job_id] == constants.QUEUED_ACTIVE:
         #print "    => removed from queue "
-        self._queue.remove(scheduler_job_id)
+        # the job is skipped when it comes out of the queue
         del self._jobs[scheduler_job_id]
+        self._overtaken.pop(scheduler_job_id, None)
         self._status[scheduler_job_id] = constants.FAILED
         self._exit_info[scheduler_job_id] = (constants.EXIT_ABORTED,
                                               None,
@@ -786,6 +1383,39 @@ class LocalScheduler(Scheduler):
                                               None)
 
 
+  @staticmethod
+  def _kill_process(process):
+    '''
+    Kills the process, unless it was already reaped by its reaper thread:
+    its pid may then be used by another process.
+
+    * returns: *boolean*
+      False if the process was already reaped.
+    '''
+    if process.returncode is not None:
+      return False
+    try:
+      if sys.version_info < (2, 6):
+        if sys.platform == 'win32':
+          PROCESS_TERMINATE = 1
+          handle = ctypes.windll.kernel32.OpenProcess(PROCESS_TERMINATE, 
+                                             False, 
+                                             process.pid)
+          ctypes.windll.kernel32.TerminateProcess(handle, -1)
+          ctypes.windll.kernel32.CloseHandle(handle)
+        else:
+          # reaped by the reaper thread
+          os.kill(process.pid, signal.SIGKILL)
+      else:
+        process.kill()
+    except OSError, e:
+      if e.errno != errno.ESRCH:
+        raise
+      # reaped by the reaper thread in the meantime
+      return False
+    return True
+
+
 class ConfiguredLocalScheduler(LocalScheduler):
   '''
   Local scheduler synchronized with a configuration object.
@@ -798,19 +1428,26 @@ class ConfiguredLocalScheduler(LocalScheduler):
     * config *LocalSchedulerCfg*
     '''
     super(ConfiguredLocalScheduler, self).__init__(config.get_proc_nb(), 
-                                           config.get_interval())
+                                           config.get_interval(),
+                                           config.get_max_memory(),
+                                           config.get_job_memory())
     self._config = config
 
     self._config.addObserver(self,
                              "update_from_config", 
-                             [LocalSchedulerCfg.PROC_NB_CHANGED, LocalSchedulerCfg.INTERVAL_CHANGED])
+                             [LocalSchedulerCfg.PROC_NB_CHANGED, 
+                              LocalSchedulerCfg.INTERVAL_CHANGED,
+                              LocalSchedulerCfg.MEMORY_CHANGED])
 
 
   def update_from_config(self, observable, event, msg):
     if event == LocalSchedulerCfg.PROC_NB_CHANGED:
       self.change_proc_nb(self._config.get_proc_nb())
-    if event == LocalSchedulerCfg.PROC_NB_CHANGED:
+    if event == LocalSchedulerCfg.INTERVAL_CHANGED:
       self.change_interval(self._config.get_interval())
+    if event == LocalSchedulerCfg.MEMORY_CHANGED:
+      self.change_memory(self._config.get_max_memory(),
+                         self._config.get_job_memory())
     self._config.save_to_file()
     
 
@@ -132,4 +132,7 @@ if __name__ == '__main__':
 
   ########################
   # Request loop
-  daemon.requestLoop()
+  try:
+    daemon.requestLoop()
+  finally:
+    server.close_connections()
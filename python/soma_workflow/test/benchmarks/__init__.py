@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+'''
+Performance benchmarks of the workflow engine.
+
+The benchmarks are not unit tests: they print measures and are meant to be
+run by hand on the revisions to compare, for example:
+
+  python -m soma_workflow.test.benchmarks.bench_linear_chain
+'''
+import os
+import shutil
+import tempfile
+
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine import WorkflowEngine
+
+
+class BenchEnvironment(object):
+    '''
+    Temporary directory holding the database and the transfered files of a
+    benchmark, and the database server and engine started on it. clean()
+    stops them and removes the directory:
+
+      bench = BenchEnvironment()
+      try:
+          engine = bench.start_engine(LocalScheduler())
+          ...
+      finally:
+          bench.clean()
+    '''
+
+    def __init__(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="swf_bench_")
+        self.database_file = os.path.join(self.tmp_dir, "soma_workflow.db")
+        self.transfer_dir = os.path.join(self.tmp_dir, "transfered_files")
+        os.mkdir(self.transfer_dir)
+        self.database_server = None
+        self.scheduler = None
+        self.engine = None
+
+    def start_database_server(self):
+        if self.database_server == None:
+            self.database_server = WorkflowDatabaseServer(self.database_file,
+                                                          self.transfer_dir)
+        return self.database_server
+
+    def start_engine(self, scheduler):
+        self.scheduler = scheduler
+        self.engine = WorkflowEngine(self.start_database_server(), scheduler)
+        return self.engine
+
+    def clean(self):
+        try:
+            if self.engine != None:
+                self.engine.engine_loop_thread.stop()
+            if self.scheduler != None:
+                self.scheduler.end_scheduler_thread()
+        finally:
+            shutil.rmtree(self.tmp_dir)
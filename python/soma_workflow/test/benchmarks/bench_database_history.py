@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of the frequent database requests of the engine when the database
+holds a long history: 1M ended job rows by default, spread over workflows
+of 1000 jobs, with one file transfer per 10 jobs.
+The rows are inserted directly in the database to keep the set up short.
+Use --drop-indexes to measure the requests without the secondary indexes
+(as with the database version 1.1).
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_database_history \\
+    [--nb-jobs 1000000] [--repeat 100] [--drop-indexes]
+'''
+import sys
+import time
+import getpass
+import sqlite3
+import optparse
+from datetime import datetime, timedelta
+
+from soma_workflow.test.benchmarks import BenchEnvironment
+import soma_workflow.constants as constants
+
+WORKFLOW_SIZE = 1000
+
+
+def insert_history(database_file, user_id, nb_jobs, drop_indexes):
+    connection = sqlite3.connect(database_file)
+    if drop_indexes:
+        for row in connection.execute(
+                '''SELECT name FROM sqlite_master
+                   WHERE type='index' AND sql IS NOT NULL''').fetchall():
+            connection.execute('DROP INDEX %s' % row[0])
+    now = datetime.now()
+    expiration_date = now + timedelta(days=7)
+    nb_workflows = max(1, nb_jobs // WORKFLOW_SIZE)
+    for wf_index in range(nb_workflows):
+        cursor = connection.execute(
+            '''INSERT INTO workflows (user_id, expiration_date, status,
+                                      last_status_update)
+               VALUES (?, ?, ?, ?)''',
+            (user_id, expiration_date, constants.WORKFLOW_DONE, now))
+        wf_id = cursor.lastrowid
+        status = constants.DONE
+        if wf_index == nb_workflows - 1:
+            # the workflow in progress
+            status = constants.RUNNING
+        connection.executemany(
+            '''INSERT INTO jobs (user_id, expiration_date, status,
+                                 last_status_update, workflow_id,
+                                 join_errout, stdout_file, custom_submission,
+                                 queue)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(user_id, expiration_date, status, now, wf_id, False,
+              "/dev/null", False, None) for i in range(WORKFLOW_SIZE)])
+        last_job_id = connection.execute(
+            'SELECT max(id) FROM jobs').fetchone()[0]
+        job_ids = range(last_job_id - WORKFLOW_SIZE + 1, last_job_id + 1)
+        transfers = [("wf%d_file%d" % (wf_id, i), expiration_date, user_id,
+                      wf_id, constants.FILES_ON_CLIENT)
+                     for i in range(WORKFLOW_SIZE // 10)]
+        connection.executemany(
+            '''INSERT INTO transfers (engine_file_path, expiration_date,
+                                      user_id, workflow_id, status)
+               VALUES (?, ?, ?, ?, ?)''', transfers)
+        connection.executemany(
+            '''INSERT INTO ios (job_id, engine_file_path, is_input)
+               VALUES (?, ?, ?)''',
+            [(job_ids[i * 10], transfer[0], True)
+             for i, transfer in enumerate(transfers)])
+    connection.commit()
+    connection.close()
+    return wf_id
+
+
+def timed(function, repeat, *args):
+    start = time.time()
+    for i in range(repeat):
+        function(*args)
+    return (time.time() - start) / repeat
+
+
+def run(nb_jobs, repeat, drop_indexes):
+    bench = BenchEnvironment()
+    try:
+        database_server = bench.start_database_server()
+        user_id = database_server.register_user(getpass.getuser())
+        start = time.time()
+        wf_id = insert_history(bench.database_file, user_id, nb_jobs,
+                               drop_indexes)
+        setup_time = time.time() - start
+
+        results = [
+            ("jobs_to_delete_and_kill",
+             timed(database_server.jobs_to_delete_and_kill, repeat,
+                   user_id)),
+            ("nb_queued_jobs",
+             timed(database_server.nb_queued_jobs, repeat, user_id, None)),
+            ("get_detailed_workflow_status",
+             timed(database_server.get_detailed_workflow_status, repeat,
+                   wf_id)),
+        ]
+    finally:
+        bench.clean()
+    return (setup_time, results)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int",
+                      default=1000000)
+    parser.add_option("--repeat", dest="repeat", type="int", default=100)
+    parser.add_option("--drop-indexes", dest="drop_indexes",
+                      action="store_true", default=False)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (setup_time, results) = run(options.nb_jobs,
+                                options.repeat,
+                                options.drop_indexes)
+    sys.stdout.write("database of %d job rows (%.0f s to fill)%s\n"
+                     % (options.nb_jobs, setup_time,
+                        options.drop_indexes and ", no index" or ""))
+    for name, duration in results:
+        sys.stdout.write("%-30s %8.2f ms\n" % (name, duration * 1000))
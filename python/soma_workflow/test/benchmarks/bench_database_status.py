@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Throughput (rows per second) of the bulk status methods of
+WorkflowDatabaseServer: set_jobs_status and set_jobs_exit_info, with
+batches of 10k jobs by default.
+The job rows are inserted directly in the database to keep the set up
+short.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_database_status \\
+    [--nb-jobs 10000] [--repeat 5]
+'''
+import sys
+import time
+import getpass
+import sqlite3
+import optparse
+from datetime import datetime, timedelta
+
+from soma_workflow.test.benchmarks import BenchEnvironment
+import soma_workflow.constants as constants
+
+
+class ExitInfo(object):
+
+    def __init__(self, exit_value):
+        self.exit_status = constants.FINISHED_REGULARLY
+        self.exit_value = exit_value
+        self.terminating_signal = None
+        self.str_rusage = "cpu=1.0 mem=10.0"
+
+
+def insert_jobs(database_file, user_id, nb_jobs):
+    connection = sqlite3.connect(database_file)
+    now = datetime.now()
+    connection.executemany(
+        '''INSERT INTO jobs (user_id, expiration_date, status,
+                             last_status_update, join_errout, stdout_file,
+                             custom_submission)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        [(user_id, now + timedelta(days=7), constants.NOT_SUBMITTED, now,
+          False, "/dev/null", False) for i in range(nb_jobs)])
+    connection.commit()
+    job_ids = [row[0] for row in connection.execute(
+        'SELECT id FROM jobs WHERE user_id=?', [user_id])]
+    connection.close()
+    return job_ids
+
+
+def run(nb_jobs, repeat):
+    bench = BenchEnvironment()
+    try:
+        database_server = bench.start_database_server()
+        user_id = database_server.register_user(getpass.getuser())
+        job_ids = insert_jobs(bench.database_file, user_id, nb_jobs)
+
+        statuses = [constants.QUEUED_ACTIVE, constants.RUNNING,
+                    constants.DONE]
+        status_time = 0
+        exit_info_time = 0
+        for i in range(repeat):
+            job_status = dict((job_id, statuses[i % len(statuses)])
+                              for job_id in job_ids)
+            start = time.time()
+            database_server.set_jobs_status(job_status)
+            status_time += time.time() - start
+
+            exit_info = dict((job_id, ExitInfo(i)) for job_id in job_ids)
+            start = time.time()
+            database_server.set_jobs_exit_info(exit_info)
+            exit_info_time += time.time() - start
+    finally:
+        bench.clean()
+    nb_rows = nb_jobs * repeat
+    return (nb_rows / status_time, nb_rows / exit_info_time)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=10000)
+    parser.add_option("--repeat", dest="repeat", type="int", default=5)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (status_rate, exit_info_rate) = run(options.nb_jobs, options.repeat)
+    sys.stdout.write("batches of %d jobs\n" % options.nb_jobs)
+    sys.stdout.write("set_jobs_status:    %.0f rows/s\n" % status_rate)
+    sys.stdout.write("set_jobs_exit_info: %.0f rows/s\n" % exit_info_rate)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of the monitoring of a big workflow on the database server: the status
+of a few jobs changes between two polls. Measures the time of a poll and the
+size of its (pickled) result, with get_detailed_workflow_status and, when
+the database server provides it, get_workflow_status_changes.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_elements_status \\
+    [--nb-jobs 30000] [--nb-changes 10] [--nb-polls 10]
+'''
+import sys
+import time
+import pickle
+import getpass
+import optparse
+from datetime import datetime, timedelta
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow.test.benchmarks import BenchEnvironment
+import soma_workflow.constants as constants
+
+
+def independant_jobs_workflow(nb_jobs):
+    jobs = [Job(command=["echo", "job %d" % i], name="job %d" % i)
+            for i in range(nb_jobs)]
+    return Workflow(jobs=jobs)
+
+
+def run(nb_jobs, nb_changes, nb_polls):
+    bench = BenchEnvironment()
+    try:
+        database_server = bench.start_database_server()
+        user_id = database_server.register_user(getpass.getuser())
+        workflow = independant_jobs_workflow(nb_jobs)
+        engine_workflow = EngineWorkflow(workflow, None, None,
+                                         datetime.now() + timedelta(days=1),
+                                         "elements status")
+        engine_workflow = database_server.add_workflow(user_id,
+                                                       engine_workflow)
+        wf_id = engine_workflow.wf_id
+        job_ids = sorted(job.job_id
+                         for job in engine_workflow.job_mapping.itervalues())
+
+        polls = [("full status", None)]
+        if hasattr(database_server, "get_workflow_status_changes"):
+            polls.append(("changes", database_server.get_workflow_status_changes))
+        results = []
+        for name, get_changes in polls:
+            version = None
+            if get_changes:
+                version = get_changes(wf_id)[0]
+            duration = 0
+            size = 0
+            for poll in range(nb_polls):
+                changed = job_ids[poll * nb_changes:(poll + 1) * nb_changes]
+                # the same jobs change again in the second series of polls
+                status = constants.RUNNING
+                if name == "changes":
+                    status = constants.DONE
+                database_server.set_jobs_status(dict((job_id, status)
+                                                     for job_id in changed))
+                start = time.time()
+                if get_changes:
+                    (version, wf_status) = get_changes(wf_id, version)
+                else:
+                    wf_status = database_server.get_detailed_workflow_status(
+                                                                        wf_id)
+                duration += time.time() - start
+                size += len(pickle.dumps(wf_status, pickle.HIGHEST_PROTOCOL))
+            results.append((name, duration / nb_polls, size / nb_polls))
+    finally:
+        bench.clean()
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=30000)
+    parser.add_option("--nb-changes", dest="nb_changes", type="int",
+                      default=10)
+    parser.add_option("--nb-polls", dest="nb_polls", type="int", default=10)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    results = run(options.nb_jobs, options.nb_changes, options.nb_polls)
+    sys.stdout.write("workflow of %d jobs, %d status changes between two "
+                     "polls\n" % (options.nb_jobs, options.nb_changes))
+    for name, duration, size in results:
+        sys.stdout.write("%-12s %.4f s per poll, %d bytes\n"
+                         % (name + ":", duration, size))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of the failure propagation in EngineWorkflow.find_out_jobs_to_process.
+The workflow is made of a root job followed by several chains of jobs
+(fan-out/chain). The root job fails, so every other job of the workflow has
+to be aborted in a single inspection.
+No job is actually run: the benchmark only exercises the engine workflow.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_failure_propagation \\
+    [--nb-jobs 100000] [--fan-out 100]
+'''
+import sys
+import time
+import optparse
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+import soma_workflow.constants as constants
+
+
+def fan_out_chain_workflow(nb_jobs, fan_out):
+    root = Job(command=["true"], name="root")
+    jobs = [root]
+    dependencies = []
+    chain_length = max(1, (nb_jobs - 1) // fan_out)
+    for branch in range(fan_out):
+        previous = root
+        for i in range(chain_length):
+            job = Job(command=["true"], name="job %d %d" % (branch, i))
+            jobs.append(job)
+            dependencies.append((previous, job))
+            previous = job
+    return Workflow(jobs=jobs, dependencies=dependencies), root
+
+
+def run(nb_jobs, fan_out):
+    start = time.time()
+    (workflow, root) = fan_out_chain_workflow(nb_jobs, fan_out)
+    engine_workflow = EngineWorkflow(workflow, None, None, None,
+                                     "failure propagation")
+    for job_id, job in enumerate(engine_workflow.job_mapping.itervalues()):
+        job.job_id = job_id + 1
+    creation_time = time.time() - start
+
+    (to_run, status) = engine_workflow.find_out_independant_jobs()
+    engine_root = engine_workflow.job_mapping[root]
+    assert to_run == [engine_root]
+    engine_root.status = constants.FAILED
+    engine_root.exit_status = constants.FINISHED_REGULARLY
+    engine_root.exit_value = 1
+
+    start = time.time()
+    (to_run,
+     aborted_jobs,
+     status) = engine_workflow.find_out_jobs_to_process([engine_root])
+    propagation_time = time.time() - start
+
+    assert not to_run
+    assert len(aborted_jobs) == len(engine_workflow.job_mapping) - 1
+    assert status == constants.WORKFLOW_DONE
+    return (len(engine_workflow.job_mapping), creation_time, propagation_time)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=100000)
+    parser.add_option("--fan-out", dest="fan_out", type="int", default=100)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (nb_jobs, creation_time, propagation_time) = run(options.nb_jobs,
+                                                     options.fan_out)
+    sys.stdout.write("fan-out/chain workflow of %d jobs (%d branches)\n"
+                     % (nb_jobs, options.fan_out))
+    sys.stdout.write("workflow creation:   %.2f s\n" % creation_time)
+    sys.stdout.write("failure propagation: %.3f s\n" % propagation_time)
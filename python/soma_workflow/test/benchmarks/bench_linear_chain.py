@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+End-to-end makespan of a linear chain of short jobs run with the
+LocalScheduler. Each job only depends on the previous one, so the makespan
+is dominated by the latency between the end of a job and the submission of
+the next one.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_linear_chain [--nb-jobs 1000]
+'''
+import sys
+import time
+import optparse
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.scheduler import LocalScheduler
+from soma_workflow.test.benchmarks import BenchEnvironment
+import soma_workflow.constants as constants
+
+
+def linear_chain_workflow(nb_jobs):
+    jobs = [Job(command=["true"], name="job %d" % i) for i in range(nb_jobs)]
+    dependencies = [(jobs[i], jobs[i + 1]) for i in range(nb_jobs - 1)]
+    return Workflow(jobs=jobs, dependencies=dependencies,
+                    name="linear chain %d" % nb_jobs)
+
+
+def run(nb_jobs, proc_nb, interval):
+    bench = BenchEnvironment()
+    try:
+        engine = bench.start_engine(LocalScheduler(proc_nb=proc_nb,
+                                                   interval=interval))
+
+        workflow = linear_chain_workflow(nb_jobs)
+        start = time.time()
+        wf_id = engine.submit_workflow(workflow, None, None, None)
+        submitted = time.time()
+        while engine.workflow_status(wf_id) != constants.WORKFLOW_DONE:
+            time.sleep(0.05)
+        end = time.time()
+    finally:
+        bench.clean()
+    return (submitted - start, end - start)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=1000)
+    parser.add_option("--proc-nb", dest="proc_nb", type="int", default=1)
+    parser.add_option("--interval", dest="interval", type="float", default=1)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (submission_time, makespan) = run(options.nb_jobs,
+                                      options.proc_nb,
+                                      options.interval)
+    sys.stdout.write("linear chain of %d jobs\n" % options.nb_jobs)
+    sys.stdout.write("submission: %.2f s\n" % submission_time)
+    sys.stdout.write("makespan:   %.2f s (%.3f s per job)\n"
+                     % (makespan, makespan / options.nb_jobs))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Throughput of the LocalScheduler alone (without the engine) on many short
+independant jobs: time to submit the jobs and time until all of them
+ended.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_local_scheduler \\
+    [--nb-jobs 2000] [--proc-nb 8] [--interval 1]
+'''
+import sys
+import time
+import optparse
+
+from soma_workflow.client import Job
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import LocalScheduler
+import soma_workflow.constants as constants
+
+
+def short_jobs(nb_jobs):
+    jobs = []
+    for i in range(nb_jobs):
+        job = EngineJob(Job(command=["true"], name="job %d" % i,
+                            priority=i % 10),
+                        queue=None)
+        job.job_id = i + 1
+        jobs.append(job)
+    return jobs
+
+
+def run(nb_jobs, proc_nb, interval):
+    jobs = short_jobs(nb_jobs)
+    scheduler = LocalScheduler(proc_nb=proc_nb, interval=interval)
+    try:
+        start = time.time()
+        scheduler_job_ids = [scheduler.job_submission(job) for job in jobs]
+        submitted = time.time()
+        while scheduler_job_ids:
+            time.sleep(0.01)
+            (status, errors) = scheduler.get_jobs_status(scheduler_job_ids)
+            scheduler_job_ids = [scheduler_job_id
+                                 for scheduler_job_id in scheduler_job_ids
+                                 if status[scheduler_job_id] !=
+                                    constants.DONE]
+        end = time.time()
+    finally:
+        scheduler.end_scheduler_thread()
+    return (submitted - start, end - start)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=2000)
+    parser.add_option("--proc-nb", dest="proc_nb", type="int", default=8)
+    parser.add_option("--interval", dest="interval", type="float", default=1)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (submission_time, total_time) = run(options.nb_jobs, options.proc_nb,
+                                        options.interval)
+    sys.stdout.write("%d jobs, %d processes\n"
+                     % (options.nb_jobs, options.proc_nb))
+    sys.stdout.write("submission: %.2f s\n" % submission_time)
+    sys.stdout.write("all ended:  %.2f s (%.0f jobs/s)\n"
+                     % (total_time, options.nb_jobs / total_time))
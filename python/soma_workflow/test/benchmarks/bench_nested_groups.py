@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+End-to-end makespan of a chain of nested groups run with the
+LocalScheduler. Each group of the chain depends on the previous one and
+holds a single short job at the bottom of a hierarchy of sub-groups. The
+group dependencies are converted into barrier jobs (two per group level),
+so the makespan is dominated by the latency added by the barriers.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_nested_groups \\
+    [--nb-groups 100] [--depth 5]
+'''
+import sys
+import time
+import optparse
+
+from soma_workflow.client import Job, Workflow, Group
+from soma_workflow.scheduler import LocalScheduler
+from soma_workflow.test.benchmarks import BenchEnvironment
+import soma_workflow.constants as constants
+
+
+def nested_groups_workflow(nb_groups, depth):
+    jobs = []
+    top_groups = []
+    for i in range(nb_groups):
+        job = Job(command=["true"], name="job %d" % i)
+        jobs.append(job)
+        element = job
+        for level in range(depth):
+            element = Group(elements=[element],
+                            name="group %d level %d" % (i, level))
+        top_groups.append(element)
+    dependencies = [(top_groups[i], top_groups[i + 1])
+                    for i in range(nb_groups - 1)]
+    return Workflow(jobs=jobs, dependencies=dependencies,
+                    root_group=top_groups,
+                    name="nested groups %d x %d" % (nb_groups, depth))
+
+
+def run(nb_groups, depth, interval):
+    bench = BenchEnvironment()
+    try:
+        engine = bench.start_engine(LocalScheduler(proc_nb=1,
+                                                   interval=interval))
+
+        workflow = nested_groups_workflow(nb_groups, depth)
+        start = time.time()
+        wf_id = engine.submit_workflow(workflow, None, None, None)
+        while engine.workflow_status(wf_id) != constants.WORKFLOW_DONE:
+            time.sleep(0.05)
+        end = time.time()
+    finally:
+        bench.clean()
+    return (len(workflow.jobs), end - start)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-groups", dest="nb_groups", type="int",
+                      default=100)
+    parser.add_option("--depth", dest="depth", type="int", default=5)
+    parser.add_option("--interval", dest="interval", type="float", default=1)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (nb_jobs, makespan) = run(options.nb_groups,
+                              options.depth,
+                              options.interval)
+    sys.stdout.write("chain of %d groups nested %d levels deep "
+                     "(%d jobs with the barriers)\n"
+                     % (options.nb_groups, options.depth, nb_jobs))
+    sys.stdout.write("makespan: %.2f s (%.3f s per group)\n"
+                     % (makespan, makespan / options.nb_groups))
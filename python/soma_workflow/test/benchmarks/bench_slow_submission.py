@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Engine behaviour with a DRMS whose job submission is slow: a workflow of
+many independant short jobs is run with a LocalScheduler delaying each
+submission (like runJob on a loaded PBS/Torque head node). Measures the
+makespan and the time taken to submit and stop a second workflow while
+the jobs of the first one are being submitted.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_slow_submission \\
+    [--nb-jobs 200] [--submission-delay 0.1]
+'''
+import sys
+import time
+import optparse
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.scheduler import LocalScheduler
+from soma_workflow.test.benchmarks import BenchEnvironment
+import soma_workflow.constants as constants
+
+
+class SlowSubmissionScheduler(LocalScheduler):
+
+    submission_delay = None
+
+    def __init__(self, submission_delay, proc_nb=1, interval=1):
+        super(SlowSubmissionScheduler, self).__init__(proc_nb=proc_nb,
+                                                      interval=interval)
+        self.submission_delay = submission_delay
+
+    def job_submission(self, job):
+        time.sleep(self.submission_delay)
+        return super(SlowSubmissionScheduler, self).job_submission(job)
+
+
+def independant_jobs_workflow(nb_jobs):
+    jobs = [Job(command=["true"], name="job %d" % i) for i in range(nb_jobs)]
+    return Workflow(jobs=jobs, name="%d independant jobs" % nb_jobs)
+
+
+def run(nb_jobs, submission_delay):
+    bench = BenchEnvironment()
+    try:
+        engine = bench.start_engine(SlowSubmissionScheduler(submission_delay,
+                                                            proc_nb=8))
+
+        start = time.time()
+        wf_id = engine.submit_workflow(independant_jobs_workflow(nb_jobs),
+                                       None, None, None)
+        # let the engine start submitting the jobs
+        time.sleep(1)
+        kill_start = time.time()
+        other_wf_id = engine.submit_workflow(independant_jobs_workflow(1),
+                                             None, None, None)
+        engine.stop_workflow(other_wf_id)
+        while engine.workflow_status(other_wf_id) != \
+                constants.WORKFLOW_DONE:
+            time.sleep(0.01)
+        kill_time = time.time() - kill_start
+        while engine.workflow_status(wf_id) != constants.WORKFLOW_DONE:
+            time.sleep(0.05)
+        end = time.time()
+    finally:
+        bench.clean()
+    return (end - start, kill_time)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=200)
+    parser.add_option("--submission-delay", dest="submission_delay",
+                      type="float", default=0.1)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (makespan, kill_time) = run(options.nb_jobs, options.submission_delay)
+    sys.stdout.write("%d independant jobs, %.3f s per submission\n"
+                     % (options.nb_jobs, options.submission_delay))
+    sys.stdout.write("makespan:        %.2f s\n" % makespan)
+    sys.stdout.write("submit and stop: %.2f s\n" % kill_time)
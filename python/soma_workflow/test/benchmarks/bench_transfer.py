@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of the file transfers of PortableRemoteTransfer (used with a remote
+computing resource): a file is transfered to the "remote" side and back,
+through a RemoteFileController called in process with a simulated network
+latency. Measures the time of each transfer, the volume of data read from
+the disk (on both sides) and sent through the RemoteFileController, and the
+memory peak of the process. The transfers are done calling the remote side
+once at a time, then with several calls in progress at once when
+PortableRemoteTransfer supports it. They are then interrupted half way and
+restarted.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_transfer \\
+    [--file-size 256] [--latency 0.005]
+'''
+import os
+import sys
+import time
+import resource
+import optparse
+import filecmp
+import threading
+
+from soma_workflow.transfer import RemoteFileController, PortableRemoteTransfer
+from soma_workflow.test.benchmarks import BenchEnvironment
+
+
+def read_bytes():
+    '''
+    Volume of data read by the process since its start (Linux only).
+    '''
+    try:
+        for line in open("/proc/self/io"):
+            if line.startswith("rchar:"):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class Link(object):
+    '''
+    Simulated network link: counts the data sent and simulates a connection
+    loss once max_data bytes were sent.
+    '''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.data = 0
+        self.max_data = None
+        self.lock = threading.Lock()
+
+    def send(self, size):
+        self.lock.acquire()
+        try:
+            if self.max_data != None and self.data + size > self.max_data:
+                raise ConnectionLost()
+            self.data = self.data + size
+        finally:
+            self.lock.release()
+
+
+class BenchRemoteFileController(object):
+    '''
+    Calls the methods of a RemoteFileController through a Link, each call
+    waiting for the link latency like the round trip of a remote call. The
+    copies of the object (one per connection) share the link.
+    '''
+
+    def __init__(self, remote_file_controller, link):
+        self.remote_file_controller = remote_file_controller
+        self.link = link
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        method = getattr(self.remote_file_controller, name)
+
+        def call(*args):
+            time.sleep(self.link.latency)
+            if name in ["write", "write_chunk"]:
+                self.link.send(len(args[-1]))
+            result = method(*args)
+            if name in ["read", "read_chunk"]:
+                self.link.send(len(result))
+            return result
+        return call
+
+
+def run(file_size, latency):
+    bench = BenchEnvironment()
+    try:
+        path = os.path.join(bench.tmp_dir, "file")
+        remote_path = os.path.join(bench.tmp_dir, "remote", "file")
+        back_path = os.path.join(bench.tmp_dir, "back", "file")
+        f = open(path, 'wb')
+        block = os.urandom(1024 ** 2)
+        for i in range(file_size):
+            f.write(block)
+        f.close()
+
+        link = Link(latency)
+        remote_file_controller = BenchRemoteFileController(
+                                            RemoteFileController(), link)
+        transfers = [("", PortableRemoteTransfer(remote_file_controller))]
+        try:
+            transfers = [
+                (" (1 call)", PortableRemoteTransfer(remote_file_controller,
+                                                     window_size=1)),
+                (" (4 calls)", PortableRemoteTransfer(remote_file_controller,
+                                                      window_size=4))]
+        except TypeError:
+            pass
+        results = []
+        for calls, transfer in transfers:
+            for name, transfer_file, source, destination in [
+                    ("to remote", transfer.transfer_to_remote,
+                     path, remote_path),
+                    ("from remote", transfer.transfer_from_remote,
+                     remote_path, back_path)]:
+                if os.path.exists(destination):
+                    os.remove(destination)
+                link.data = 0
+                read = read_bytes()
+                start = time.time()
+                transfer_file(source, destination)
+                results.append((name + calls,
+                                time.time() - start,
+                                read_bytes() - read,
+                                link.data))
+                assert filecmp.cmp(path, destination, shallow=False)
+
+        transfer = transfers[-1][1]
+        for name, transfer_file, source, destination in [
+                ("to remote", transfer.transfer_to_remote, path, remote_path),
+                ("from remote", transfer.transfer_from_remote,
+                 remote_path, back_path)]:
+            os.remove(destination)
+            link.data = 0
+            link.max_data = file_size * 1024 ** 2 / 2
+            try:
+                transfer_file(source, destination)
+            except ConnectionLost:
+                pass
+            link.data = 0
+            link.max_data = None
+            read = read_bytes()
+            start = time.time()
+            transfer_file(source, destination)
+            results.append(("resumed " + name,
+                            time.time() - start,
+                            read_bytes() - read,
+                            link.data))
+            assert filecmp.cmp(path, destination, shallow=False)
+    finally:
+        bench.clean()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (results, max_rss)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--file-size", dest="file_size", type="int",
+                      default=256, help="size of the file in MB")
+    parser.add_option("--latency", dest="latency", type="float",
+                      default=0.005, help="round trip time of a call in s")
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    (results, max_rss) = run(options.file_size, options.latency)
+    sys.stdout.write("transfer of a file of %d MB, %.3f s latency\n"
+                     % (options.file_size, options.latency))
+    for name, duration, read, sent in results:
+        sys.stdout.write("%-24s %.2f s, %d MB read, %d MB sent\n"
+                         % (name + ":", duration, read / 1024 ** 2,
+                            sent / 1024 ** 2))
+    sys.stdout.write("memory peak: %d MB\n" % (max_rss / 1024))
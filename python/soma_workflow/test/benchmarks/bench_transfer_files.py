@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of WorkflowController.transfer_files on directories of small files (like
+DICOM series), with PortableRemoteTransfer and a simulated network latency
+(see bench_transfer). The engine of a light mode WorkflowController plays the
+remote computing resource. Several directories are transfered to the engine
+and back, one file at a time, then with several workers when transfer_files
+supports it, then with the small files bundled in tar archives (to the
+engine only) when PortableRemoteTransfer supports it.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_transfer_files \\
+    [--nb-dirs 4] [--nb-files 100] [--file-size 32] [--latency 0.005]
+'''
+import os
+import sys
+import time
+import shutil
+import optparse
+
+from soma_workflow.client import WorkflowController, FileTransfer
+from soma_workflow.transfer import PortableRemoteTransfer, TransferMonitoring
+from soma_workflow.test.benchmarks import BenchEnvironment
+from soma_workflow.test.benchmarks.bench_transfer import \
+    Link, BenchRemoteFileController
+
+
+def run(nb_dirs, nb_files, file_size, latency):
+    bench = BenchEnvironment()
+    try:
+        client_paths = []
+        for i in range(nb_dirs):
+            client_path = os.path.join(bench.tmp_dir, "dir_%d" % i)
+            os.mkdir(client_path)
+            for j in range(nb_files):
+                f = open(os.path.join(client_path, "file_%d" % j), 'wb')
+                f.write(os.urandom(file_size * 1024))
+                f.close()
+            client_paths.append(client_path)
+
+        wf_ctrl = WorkflowController()
+        link = Link(latency)
+        engine = BenchRemoteFileController(wf_ctrl._engine_proxy, link)
+        wf_ctrl._engine_proxy = engine
+        wf_ctrl._transfer_monitoring = TransferMonitoring(engine)
+
+        # (name, transfer_files arguments, PortableRemoteTransfer arguments)
+        runs = [("", {}, {})]
+        if "nb_workers" in \
+                WorkflowController.transfer_files.im_func.func_code.co_varnames:
+            runs = [(" (1 worker)", {"nb_workers": 1}, {}),
+                    (" (4 workers)", {"nb_workers": 4}, {})]
+        if "bundle_threshold" in \
+                PortableRemoteTransfer.__init__.im_func.func_code.co_varnames:
+            for name, kwargs, transfer_kwargs in runs:
+                transfer_kwargs["bundle_threshold"] = 0
+            runs.append((" (4 workers, bundles)", {"nb_workers": 4},
+                         {"bundle_threshold": 256 * 1024}))
+        results = []
+        for name, kwargs, transfer_kwargs in runs:
+            wf_ctrl._transfer = PortableRemoteTransfer(engine,
+                                                       **transfer_kwargs)
+            transfer_ids = [
+                wf_ctrl.register_transfer(
+                    FileTransfer(True, client_path)).engine_path
+                for client_path in client_paths]
+            for direction in ["to remote", "from remote"]:
+                if direction == "from remote":
+                    for client_path in client_paths:
+                        shutil.move(client_path, client_path + "_ref")
+                start = time.time()
+                wf_ctrl.transfer_files(transfer_ids, **kwargs)
+                results.append((direction + name, time.time() - start))
+            for client_path in client_paths:
+                for file_name in os.listdir(client_path + "_ref"):
+                    assert open(os.path.join(client_path, file_name),
+                                'rb').read() == \
+                        open(os.path.join(client_path + "_ref", file_name),
+                             'rb').read()
+                shutil.rmtree(client_path + "_ref")
+            for transfer_id in transfer_ids:
+                wf_ctrl.delete_transfer(transfer_id)
+    finally:
+        bench.clean()
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-dirs", dest="nb_dirs", type="int", default=4)
+    parser.add_option("--nb-files", dest="nb_files", type="int", default=100,
+                      help="number of files per directory")
+    parser.add_option("--file-size", dest="file_size", type="int",
+                      default=32, help="size of the files in KB")
+    parser.add_option("--latency", dest="latency", type="float",
+                      default=0.005, help="round trip time of a call in s")
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    results = run(options.nb_dirs, options.nb_files, options.file_size,
+                  options.latency)
+    sys.stdout.write("%d directories of %d files of %d KB, %.3f s latency\n"
+                     % (options.nb_dirs, options.nb_files, options.file_size,
+                        options.latency))
+    for name, duration in results:
+        sys.stdout.write("%-34s %.2f s\n" % (name + ":", duration))
+    sys.stdout.flush()
+    os._exit(0)
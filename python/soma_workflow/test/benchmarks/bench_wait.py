@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Latency of the engine waiting methods: workflows made of a single short job
+are submitted one after the other, each one being waited for (wait_job on
+its jobs, and wait_workflow when the engine provides it) before the next
+one is submitted. Also measures stop_workflow on a workflow of long jobs.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_wait [--nb-workflows 20]
+'''
+import sys
+import time
+import optparse
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.scheduler import LocalScheduler
+from soma_workflow.test.benchmarks import BenchEnvironment
+
+
+def single_job_workflow(command):
+    return Workflow(jobs=[Job(command=command, name="job")])
+
+
+def wait_with_wait_job(engine, wf_id):
+    job_ids = [job_info[0]
+               for job_info in engine.workflow_elements_status(wf_id)[0]]
+    engine.wait_job(job_ids)
+
+
+def wait_with_wait_workflow(engine, wf_id):
+    engine.wait_workflow(wf_id)
+
+
+def run(nb_workflows):
+    bench = BenchEnvironment()
+    try:
+        engine = bench.start_engine(LocalScheduler(proc_nb=1))
+
+        waits = [("wait_job", wait_with_wait_job)]
+        if hasattr(engine, "wait_workflow"):
+            waits.append(("wait_workflow", wait_with_wait_workflow))
+        results = []
+        for name, wait in waits:
+            start = time.time()
+            for i in range(nb_workflows):
+                wf_id = engine.submit_workflow(single_job_workflow(["true"]),
+                                               None, None, None)
+                wait(engine, wf_id)
+            results.append((name, (time.time() - start) / nb_workflows))
+
+        wf_id = engine.submit_workflow(single_job_workflow(["sleep", "60"]),
+                                       None, None, None)
+        time.sleep(1)
+        start = time.time()
+        engine.stop_workflow(wf_id)
+        results.append(("stop_workflow", time.time() - start))
+    finally:
+        bench.clean()
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-workflows", dest="nb_workflows", type="int",
+                      default=20)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    results = run(options.nb_workflows)
+    sys.stdout.write("%d workflows of a single short job\n"
+                     % options.nb_workflows)
+    for name, duration in results:
+        sys.stdout.write("%-14s %.3f s\n" % (name + ":", duration))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of the workflow storage on the database server: registration of a
+workflow (WorkflowDatabaseServer.add_workflow) and loading of the workflow
+to restart it (get_engine_workflow) once most of its jobs ended with
+success.
+The workflow is made of independant chains of jobs. The loading is done
+in a separate process so that its peak memory can be measured.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_workflow_storage \\
+    [--nb-jobs 20000] [--chain-length 10] [--done-ratio 0.9]
+'''
+import os
+import sys
+import time
+import getpass
+import resource
+import optparse
+import subprocess
+from datetime import datetime, timedelta
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.test.benchmarks import BenchEnvironment
+from soma_workflow.test.benchmarks.bench_database_status import ExitInfo
+import soma_workflow.constants as constants
+
+
+def chains_workflow(nb_jobs, chain_length):
+    jobs = []
+    dependencies = []
+    for i in range(nb_jobs):
+        job = Job(command=["echo", "job %d" % i], name="job %d" % i)
+        if i % chain_length:
+            dependencies.append((jobs[-1], job))
+        jobs.append(job)
+    return Workflow(jobs=jobs, dependencies=dependencies)
+
+
+def load(database_file, tmp_dir, wf_id, user_id):
+    '''
+    Loads the workflow as the engine does to restart it.
+
+    returns: (number of jobs loaded, loading time, peak memory in MB)
+    '''
+    database_server = WorkflowDatabaseServer(database_file, tmp_dir)
+    start = time.time()
+    try:
+        workflow = database_server.get_engine_workflow(wf_id, user_id,
+                                                       undone_jobs_only=True)
+    except TypeError:
+        # versions without partial loading
+        workflow = database_server.get_engine_workflow(wf_id, user_id)
+    load_time = time.time() - start
+    return (len(workflow.jobs), load_time, peak_memory())
+
+
+def peak_memory():
+    '''
+    Peak resident memory of the process in MB. (On Linux the ru_maxrss of a
+    process started by a big process includes the memory of its parent.)
+    '''
+    if os.path.exists("/proc/self/status"):
+        for line in open("/proc/self/status"):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run(nb_jobs, chain_length, done_ratio):
+    bench = BenchEnvironment()
+    try:
+        database_server = bench.start_database_server()
+        user_id = database_server.register_user(getpass.getuser())
+
+        workflow = chains_workflow(nb_jobs, chain_length)
+        engine_workflow = EngineWorkflow(workflow, None, None,
+                                         datetime.now() + timedelta(days=1),
+                                         "workflow storage")
+        start = time.time()
+        engine_workflow = database_server.add_workflow(user_id,
+                                                       engine_workflow)
+        add_time = time.time() - start
+        wf_id = engine_workflow.wf_id
+
+        # the first jobs of each chain ended with success
+        done_jobs = [engine_workflow.job_mapping[job].job_id
+                     for index, job in enumerate(workflow.jobs)
+                     if index % chain_length < done_ratio * chain_length]
+        database_server.set_jobs_status(dict((job_id, constants.DONE)
+                                             for job_id in done_jobs))
+        database_server.set_jobs_exit_info(dict((job_id, ExitInfo(0))
+                                                for job_id in done_jobs))
+        del workflow, engine_workflow
+
+        output = subprocess.check_output(
+                    [sys.executable, "-m",
+                     "soma_workflow.test.benchmarks.bench_workflow_storage",
+                     "--load", bench.database_file, bench.transfer_dir,
+                     str(wf_id), str(user_id)])
+        (nb_loaded,
+         load_time,
+         peak_memory) = output.strip().splitlines()[-1].split()
+    finally:
+        bench.clean()
+    return (add_time, int(nb_loaded), float(load_time), float(peak_memory))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-jobs", dest="nb_jobs", type="int", default=20000)
+    parser.add_option("--chain-length", dest="chain_length", type="int",
+                      default=10)
+    parser.add_option("--done-ratio", dest="done_ratio", type="float",
+                      default=0.9)
+    parser.add_option("--load", dest="load", action="store_true",
+                      default=False,
+                      help="internal: load the workflow of the database "
+                           "given as argument")
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    if options.load:
+        (database_file, tmp_dir, wf_id, user_id) = args
+        result = load(database_file, tmp_dir, int(wf_id), int(user_id))
+        sys.stdout.write("%d %f %f\n" % result)
+        sys.exit(0)
+
+    (add_time, nb_loaded, load_time, peak_memory) = run(options.nb_jobs,
+                                                        options.chain_length,
+                                                        options.done_ratio)
+    sys.stdout.write("workflow of %d jobs (chains of %d jobs, %d%% done)\n"
+                     % (options.nb_jobs, options.chain_length,
+                        options.done_ratio * 100))
+    sys.stdout.write("add_workflow:        %.2f s\n" % add_time)
+    sys.stdout.write("restart loading:     %.2f s, %d jobs loaded\n"
+                     % (load_time, nb_loaded))
+    sys.stdout.write("loading peak memory: %.0f MB\n" % peak_memory)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Cost of the refresh of the status of all the workflows of a user (as done
+by the GUI): one WorkflowEngine.workflow_status call per workflow, and a
+single WorkflowEngine.workflows_status call when the engine provides it.
+The calls are local: the cost of one remote call per workflow comes on top.
+
+Usage:
+  python -m soma_workflow.test.benchmarks.bench_workflows_status \\
+    [--nb-workflows 200] [--repeat 10]
+'''
+import sys
+import time
+import getpass
+import optparse
+from datetime import datetime, timedelta
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow.scheduler import LocalScheduler
+from soma_workflow.test.benchmarks import BenchEnvironment
+
+
+def run(nb_workflows, repeat):
+    bench = BenchEnvironment()
+    try:
+        database_server = bench.start_database_server()
+        user_id = database_server.register_user(getpass.getuser())
+        wf_ids = []
+        for i in range(nb_workflows):
+            workflow = Workflow(jobs=[Job(command=["true"], name="job")])
+            engine_workflow = EngineWorkflow(
+                                    workflow, None, None,
+                                    datetime.now() + timedelta(days=1),
+                                    "workflow %d" % i)
+            engine_workflow = database_server.add_workflow(user_id,
+                                                           engine_workflow)
+            wf_ids.append(engine_workflow.wf_id)
+        engine = bench.start_engine(LocalScheduler())
+
+        results = []
+        start = time.time()
+        for i in range(repeat):
+            for wf_id in wf_ids:
+                engine.workflow_status(wf_id)
+        results.append(("workflow_status", (time.time() - start) / repeat))
+        if hasattr(engine, "workflows_status"):
+            start = time.time()
+            for i in range(repeat):
+                engine.workflows_status(wf_ids)
+            results.append(("workflows_status",
+                            (time.time() - start) / repeat))
+    finally:
+        bench.clean()
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--nb-workflows", dest="nb_workflows", type="int",
+                      default=200)
+    parser.add_option("--repeat", dest="repeat", type="int", default=10)
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    results = run(options.nb_workflows, options.repeat)
+    sys.stdout.write("status of %d workflows\n" % options.nb_workflows)
+    for name, duration in results:
+        sys.stdout.write("%-17s %.4f s per refresh\n" % (name + ":", duration))
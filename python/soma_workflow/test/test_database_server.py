@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Tests of the database server: migration of the databases of the previous
+versions, workflow storage and status changes since a workflow version.
+'''
+import os
+import pickle
+import shutil
+import getpass
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from soma_workflow.client import Job, Workflow, Group
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.configuration import Configuration
+from soma_workflow.errors import DatabaseError
+from soma_workflow.info import DB_VERSION
+import soma_workflow.constants as constants
+
+
+class DatabaseServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="swf_test_")
+        self.database_file = os.path.join(self.tmp_dir, "soma_workflow.db")
+        self.database_server = WorkflowDatabaseServer(self.database_file,
+                                                      self.tmp_dir)
+        self.user_id = self.database_server.register_user(getpass.getuser())
+
+    def tearDown(self):
+        self.database_server.close_connections()
+        shutil.rmtree(self.tmp_dir)
+
+    def add_workflow(self):
+        '''
+        a -> b -> c, a -> d. The jobs b and c are in a group.
+        '''
+        jobs = [Job(["echo", name], name=name) for name in "abcd"]
+        (a, b, c, d) = jobs
+        group = Group([b, c], name="group")
+        workflow = Workflow(jobs, [(a, b), (b, c), (a, d)],
+                            root_group=[a, group, d])
+        engine_workflow = EngineWorkflow(workflow, None, None,
+                                         datetime.now() + timedelta(days=1),
+                                         "workflow")
+        engine_workflow = self.database_server.add_workflow(self.user_id,
+                                                            engine_workflow)
+        job_ids = [engine_workflow.job_mapping[job].job_id for job in jobs]
+        return (engine_workflow, job_ids)
+
+    def end_jobs(self, engine_workflow, job_ids, exit_value=0):
+        engine_jobs = dict((job.job_id, job)
+                           for job in engine_workflow.job_mapping.itervalues()
+                           if job.job_id in job_ids)
+        for job in engine_jobs.itervalues():
+            job.exit_status = constants.FINISHED_REGULARLY
+            job.exit_value = exit_value
+        if exit_value == 0:
+            status = constants.DONE
+        else:
+            status = constants.FAILED
+        self.database_server.set_jobs_status(dict((job_id, status)
+                                                  for job_id in job_ids))
+        self.database_server.set_jobs_exit_info(engine_jobs)
+
+    def dependencies(self, engine_workflow):
+        return set((job_a.name, job_b.name)
+                   for job_a, job_b in engine_workflow.dependencies)
+
+    def job_names(self, engine_workflow):
+        return set(job.name for job in engine_workflow.jobs)
+
+
+class MigrationTest(DatabaseServerTest):
+
+    def downgrade_to_1_1(self, engine_workflow):
+        '''
+        Brings the database back to the version 1.1: no index, no version
+        columns and the workflows pickled as a whole.
+        '''
+        self.database_server.close_connections()
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        for (object_type, name) in list(cursor.execute(
+                        '''SELECT type, name FROM sqlite_master
+                           WHERE type IN ('index', 'trigger')
+                           AND sql IS NOT NULL''')):
+            cursor.execute('DROP %s %s' % (object_type, name))
+        for table in ['dependencies', 'job_groups', 'group_elements']:
+            cursor.execute('DROP TABLE %s' % table)
+        for table in ['jobs', 'transfers', 'temporary_paths', 'workflows']:
+            cursor.execute('ALTER TABLE %s DROP COLUMN version' % table)
+        cursor.execute('ALTER TABLE workflows DROP COLUMN user_storage')
+        cursor.execute('UPDATE jobs SET pickled_engine_job=NULL')
+        cursor.execute('''UPDATE workflows SET pickled_engine_workflow=?
+                          WHERE id=?''',
+                       (pickle.dumps(engine_workflow), engine_workflow.wf_id))
+        cursor.execute("UPDATE db_version SET version='1.1'")
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+    def test_migration_from_1_1(self):
+        (engine_workflow, job_ids) = self.add_workflow()
+        self.end_jobs(engine_workflow, job_ids[:1])
+        self.downgrade_to_1_1(engine_workflow)
+
+        self.database_server = WorkflowDatabaseServer(self.database_file,
+                                                      self.tmp_dir)
+        connection = sqlite3.connect(self.database_file)
+        self.assertEqual(connection.execute(
+                            'SELECT version FROM db_version').fetchall(),
+                         [(DB_VERSION,)])
+        indexes = set(row[0] for row in connection.execute(
+                         "SELECT name FROM sqlite_master WHERE type='index'"))
+        self.assertTrue("jobs_workflow_id" in indexes)
+        self.assertTrue("dependencies_workflow_id" in indexes)
+        self.assertEqual(connection.execute(
+                            '''SELECT count(*) FROM workflows
+                               WHERE pickled_engine_workflow IS NOT NULL'''
+                         ).fetchall(),
+                         [(0,)])
+        connection.close()
+
+        workflow = self.database_server.get_engine_workflow(
+                                        engine_workflow.wf_id, self.user_id)
+        self.assertEqual(self.job_names(workflow), set("abcd"))
+        self.assertEqual(self.dependencies(workflow),
+                         set([("a", "b"), ("b", "c"), ("a", "d")]))
+        self.assertEqual([element.name for element in workflow.root_group],
+                         ["a", "group", "d"])
+        self.assertEqual(workflow.registered_jobs[job_ids[0]].status,
+                         constants.DONE)
+
+        (version, status) = self.database_server.get_workflow_status_changes(
+                                                        engine_workflow.wf_id)
+        self.assertEqual(set(job_info[0] for job_info in status[0]),
+                         set(job_ids))
+
+    def test_unknown_version(self):
+        self.database_server.close_connections()
+        connection = sqlite3.connect(self.database_file)
+        connection.execute("UPDATE db_version SET version='0.9'")
+        connection.commit()
+        connection.close()
+        self.assertRaises(DatabaseError, WorkflowDatabaseServer,
+                          self.database_file, self.tmp_dir)
+
+    def test_light_mode_database_file(self):
+        swf_dir = os.path.join(self.tmp_dir, "swf")
+        os.mkdir(swf_dir)
+        for version in ["1.1", "1.3", "1.10", "2.0"]:
+            f = open(os.path.join(swf_dir, "soma_workflow-%s.db" % version),
+                     "w")
+            f.write(version)
+            f.close()
+        database_file = Configuration.get_light_mode_database_file(swf_dir)
+        self.assertEqual(database_file,
+                         os.path.join(swf_dir,
+                                      "soma_workflow-%s.db" % DB_VERSION))
+        # the most recent previous version is copied
+        self.assertEqual(open(database_file).read(), "1.3")
+        f = open(database_file, "w")
+        f.write("current")
+        f.close()
+        database_file = Configuration.get_light_mode_database_file(swf_dir)
+        self.assertEqual(open(database_file).read(), "current")
+
+
+class WorkflowStorageTest(DatabaseServerTest):
+
+    def test_undone_jobs_only(self):
+        (engine_workflow, job_ids) = self.add_workflow()
+        (a, b, c, d) = job_ids
+        self.end_jobs(engine_workflow, [a, d])
+        self.end_jobs(engine_workflow, [b], exit_value=1)
+        workflow = self.database_server.get_engine_workflow(
+                                                  engine_workflow.wf_id,
+                                                  self.user_id,
+                                                  undone_jobs_only=True)
+        self.assertEqual(self.job_names(workflow), set("bc"))
+        self.assertEqual(self.dependencies(workflow), set([("b", "c")]))
+        self.assertEqual(workflow.registered_jobs[b].status,
+                         constants.FAILED)
+
+
+class StatusChangesTest(DatabaseServerTest):
+
+    def test_changes_since_version(self):
+        (engine_workflow, job_ids) = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        (version, status) = self.database_server.get_workflow_status_changes(
+                                                                        wf_id)
+        self.assertEqual(len(status[0]), 4)
+
+        self.database_server.set_jobs_status({job_ids[1]: constants.RUNNING})
+        (new_version,
+         status) = self.database_server.get_workflow_status_changes(wf_id,
+                                                                    version)
+        self.assertTrue(new_version > version)
+        self.assertEqual([(job_info[0], job_info[1])
+                          for job_info in status[0]],
+                         [(job_ids[1], constants.RUNNING)])
+
+        # the same status written again is not a change
+        self.database_server.set_jobs_status({job_ids[1]: constants.RUNNING})
+        (last_version,
+         status) = self.database_server.get_workflow_status_changes(
+                                                                wf_id,
+                                                                new_version)
+        self.assertEqual(last_version, new_version)
+        self.assertEqual(status[0], [])
+
+    def test_exit_info_change(self):
+        (engine_workflow, job_ids) = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        (version, status) = self.database_server.get_workflow_status_changes(
+                                                                        wf_id)
+        self.end_jobs(engine_workflow, job_ids[:2])
+        (version, status) = self.database_server.get_workflow_status_changes(
+                                                                wf_id,
+                                                                version)
+        self.assertEqual(set(job_info[0] for job_info in status[0]),
+                         set(job_ids[:2]))
+        self.assertEqual(set(job_info[3][0] for job_info in status[0]),
+                         set([constants.FINISHED_REGULARLY]))
+
+
+if __name__ == '__main__':
+    unittest.main()
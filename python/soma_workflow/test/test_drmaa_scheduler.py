@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Tests of the DRMAA scheduler (DrmaaCTypes) on top of a fake DRMAA session,
+so that they do not need a DRMS: a copy of the soma_workflow.scheduler module
+is loaded with a fake somadrmaa module.
+'''
+import os
+import sys
+import imp
+import types
+import shutil
+import tempfile
+import unittest
+
+import soma_workflow.utils
+import soma_workflow.scheduler
+from soma_workflow.client import Job, Workflow, Helper
+import soma_workflow.constants as constants
+
+
+class DrmaaException(Exception):
+    pass
+
+
+class ExitTimeoutException(DrmaaException):
+    pass
+
+
+class InvalidJobException(DrmaaException):
+    pass
+
+
+class JobControlAction(object):
+    TERMINATE = "terminate"
+
+
+class FakeJobTemplate(object):
+    PARAMETRIC_INDEX = "$drmaa_incr_ph$"
+
+
+class FakeSession(object):
+    '''
+    DRMAA session whose jobs are ended by the tests (end_job).
+    '''
+
+    JOB_IDS_SESSION_ANY = "DRMAA_JOB_IDS_SESSION_ANY"
+    TIMEOUT_NO_WAIT = 0
+
+    def __init__(self):
+        # job id -> status
+        self.jobs = {}
+        # ids of the jobs which ended and were not reaped yet
+        self.ended = []
+        # job id -> exit status
+        self.exit_status = {}
+        # job templates submitted: (template, job ids)
+        self.submissions = []
+        # job ids given to jobStatus
+        self.status_calls = []
+        self.killed = []
+        self._next_id = 1
+
+    def initialize(self):
+        pass
+
+    def exit(self):
+        pass
+
+    def createJobTemplate(self):
+        return FakeJobTemplate()
+
+    def deleteJobTemplate(self, job_template):
+        pass
+
+    def _new_job(self):
+        job_id = str(self._next_id)
+        self._next_id += 1
+        self.jobs[job_id] = constants.QUEUED_ACTIVE
+        return job_id
+
+    def runJob(self, job_template):
+        job_id = self._new_job()
+        self.submissions.append((job_template, [job_id]))
+        return job_id
+
+    def runBulkJobs(self, job_template, begin, end, step):
+        job_ids = [self._new_job() for i in range(begin, end + 1, step)]
+        self.submissions.append((job_template, job_ids))
+        return job_ids
+
+    def jobStatus(self, job_id):
+        self.status_calls.append(job_id)
+        if job_id not in self.jobs:
+            raise InvalidJobException(job_id)
+        return self.jobs[job_id]
+
+    def wait(self, job_id, timeout):
+        if job_id == self.JOB_IDS_SESSION_ANY:
+            if self.ended:
+                job_id = self.ended.pop(0)
+            elif self.jobs:
+                raise ExitTimeoutException()
+            else:
+                raise InvalidJobException()
+        elif job_id in self.ended:
+            self.ended.remove(job_id)
+        else:
+            raise ExitTimeoutException()
+        del self.jobs[job_id]
+        return (job_id, 1, 0, None, 0, 0, self.exit_status[job_id], {})
+
+    def control(self, job_id, action):
+        self.killed.append(job_id)
+
+    def end_job(self, job_id, exit_status=0):
+        self.jobs[job_id] = constants.DONE
+        self.exit_status[job_id] = exit_status
+        self.ended.append(job_id)
+
+
+def fake_somadrmaa_modules():
+    somadrmaa = types.ModuleType("somadrmaa")
+    somadrmaa.Session = FakeSession
+    somadrmaa.JobTemplate = FakeJobTemplate
+    errors = types.ModuleType("somadrmaa.errors")
+    errors.DrmaaException = DrmaaException
+    errors.ExitTimeoutException = ExitTimeoutException
+    errors.InvalidJobException = InvalidJobException
+    const = types.ModuleType("somadrmaa.const")
+    const.JobControlAction = JobControlAction
+    somadrmaa.errors = errors
+    somadrmaa.const = const
+    return {"somadrmaa": somadrmaa,
+            "somadrmaa.errors": errors,
+            "somadrmaa.const": const}
+
+
+class FakeSomadrmaa(object):
+    '''
+    Replaces the somadrmaa modules with the fake ones in sys.modules.
+    '''
+
+    def __init__(self):
+        self.modules = fake_somadrmaa_modules()
+        self.saved_modules = {}
+
+    def install(self):
+        for name, module in self.modules.iteritems():
+            self.saved_modules[name] = sys.modules.get(name)
+            sys.modules[name] = module
+
+    def uninstall(self):
+        for name, module in self.saved_modules.iteritems():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+
+def load_drmaa_scheduler_module():
+    fake_somadrmaa = FakeSomadrmaa()
+    fake_somadrmaa.install()
+    detect_find_lib = soma_workflow.utils.DetectFindLib
+    soma_workflow.utils.DetectFindLib = lambda env_name, lib_name: (True,
+                                                                    None)
+    try:
+        path = os.path.splitext(soma_workflow.scheduler.__file__)[0] + ".py"
+        return imp.load_source("soma_workflow_test_drmaa_scheduler", path)
+    finally:
+        soma_workflow.utils.DetectFindLib = detect_find_lib
+        fake_somadrmaa.uninstall()
+
+
+scheduler_module = load_drmaa_scheduler_module()
+
+
+class FakeJob(object):
+    '''
+    The attributes of an EngineJob used by the DRMAA scheduler.
+    '''
+
+    def __init__(self, job_id, command, stdout, working_directory=None,
+                 queue=None, parallel_job_info=None):
+        self.job_id = job_id
+        self.name = "job %d" % job_id
+        self.command = command
+        self.stdout = stdout
+        self.working_directory = working_directory
+        self.queue = queue
+        self.native_specification = None
+        self.parallel_job_info = parallel_job_info
+        self.join_stderrout = False
+        self.stdin = None
+        self.is_barrier = False
+
+    def plain_command(self):
+        return self.command
+
+    def plain_stdout(self):
+        return self.stdout
+
+    def plain_stderr(self):
+        return None
+
+    def plain_stdin(self):
+        return None
+
+    def plain_working_directory(self):
+        return self.working_directory
+
+
+class DrmaaSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_somadrmaa = FakeSomadrmaa()
+        self.fake_somadrmaa.install()
+        self.tmp_dir = tempfile.mkdtemp(prefix="swf_test_")
+        self.scheduler = scheduler_module.DrmaaCTypes("SGE", {},
+                                                      self.tmp_dir)
+        self.session = self.scheduler._drmaa
+
+    def tearDown(self):
+        self.fake_somadrmaa.uninstall()
+        shutil.rmtree(self.tmp_dir)
+
+    def new_jobs(self, nb_jobs):
+        return [self.session._new_job() for i in range(nb_jobs)]
+
+    def fake_job(self, job_id, command, **kwargs):
+        return FakeJob(job_id, command,
+                       os.path.join(self.tmp_dir, "stdout_%d" % job_id),
+                       **kwargs)
+
+
+class JobArrayTest(DrmaaSchedulerTest):
+
+    def test_job_array(self):
+        working_directory = os.path.join(self.tmp_dir, "working dir")
+        jobs = [self.fake_job(1, ["echo", u"caf\xe9", 3],
+                              working_directory=working_directory),
+                self.fake_job(2, ["echo", "it's"],
+                              working_directory=working_directory)]
+        (scheduler_job_ids,
+         errors) = self.scheduler.jobs_submission(jobs)
+        self.assertEqual(errors, {})
+        self.assertEqual(len(self.session.submissions), 1)
+        (job_template, drmaa_ids) = self.session.submissions[0]
+        self.assertEqual(sorted(scheduler_job_ids.values()), sorted(drmaa_ids))
+        self.assertEqual(job_template.remoteCommand, "/bin/sh")
+        self.assertEqual(job_template.args, ["job.sh"])
+        self.assertTrue(job_template.workingDirectory.endswith(
+                                            FakeJobTemplate.PARAMETRIC_INDEX))
+
+        array_dir = os.path.dirname(job_template.workingDirectory)
+        script = open(os.path.join(array_dir, "1", "job.sh")).read()
+        self.assertEqual(script,
+                         "cd '%s' || exit 1\nexec echo 'caf\xc3\xa9' 3\n"
+                         % working_directory)
+        script = open(os.path.join(array_dir, "2", "job.sh")).read()
+        self.assertEqual(script,
+                         "cd '%s' || exit 1\nexec echo 'it'\"'\"'s'\n"
+                         % working_directory)
+        self.assertEqual(os.readlink(os.path.join(array_dir, "2", "stdout")),
+                         jobs[1].plain_stdout())
+
+        # the directory of the job array is removed when all its tasks ended
+        for drmaa_id in drmaa_ids:
+            self.session.end_job(drmaa_id)
+            self.scheduler.get_jobs_status(drmaa_ids)
+            self.assertEqual(os.path.isdir(array_dir),
+                             drmaa_id != drmaa_ids[-1])
+
+    def test_jobs_without_working_directory(self):
+        # they run in the default working directory, as with runJob
+        jobs = [self.fake_job(job_id, ["true"]) for job_id in range(1, 4)]
+        (scheduler_job_ids,
+         errors) = self.scheduler.jobs_submission(jobs)
+        self.assertEqual(len(scheduler_job_ids), 3)
+        self.assertEqual([len(drmaa_ids)
+                          for job_template, drmaa_ids
+                          in self.session.submissions], [1, 1, 1])
+        for job_template, drmaa_ids in self.session.submissions:
+            self.assertEqual(job_template.remoteCommand, "true")
+            self.assertFalse(hasattr(job_template, "workingDirectory"))
+
+    def test_job_sets(self):
+        jobs = [self.fake_job(job_id, ["true"], working_directory="/tmp",
+                              queue=["short", "long"][job_id % 2])
+                for job_id in range(1, 6)]
+        (scheduler_job_ids,
+         errors) = self.scheduler.jobs_submission(jobs)
+        self.assertEqual(len(scheduler_job_ids), 5)
+        self.assertEqual(sorted(len(drmaa_ids)
+                                for job_template, drmaa_ids
+                                in self.session.submissions), [2, 3])
+
+    def test_parallel_jobs_loaded_from_json(self):
+        self.scheduler.parallel_job_submission_info = {
+                    "MPI": "mpi",
+                    "drmaa_native_specification": "-pe {config_name} {max_node}"}
+        client_jobs = [Job(["true"], name="parallel_%d" % i,
+                           parallel_job_info=("MPI", 2)) for i in range(2)]
+        client_jobs.append(Job(["true"], name="serial"))
+        workflow_file = os.path.join(self.tmp_dir, "workflow")
+        Helper.serialize(workflow_file, Workflow(client_jobs))
+        workflow = Helper.unserialize(workflow_file)
+        jobs = [self.fake_job(job_id, ["true"], working_directory="/tmp",
+                              parallel_job_info=client_job.parallel_job_info)
+                for job_id, client_job in enumerate(workflow.jobs)]
+        self.assertTrue(isinstance(jobs[0].parallel_job_info, list))
+        (scheduler_job_ids,
+         errors) = self.scheduler.jobs_submission(jobs)
+        self.assertEqual(errors, {})
+        self.assertEqual(len(scheduler_job_ids), 3)
+        self.assertEqual(sorted(
+                            (getattr(job_template,
+                                     "drmaa_native_specification", None),
+                             len(drmaa_ids))
+                            for job_template, drmaa_ids
+                            in self.session.submissions),
+                         [(None, 1), ("-pe mpi 2", 2)])
+
+
+class JobsStatusTest(DrmaaSchedulerTest):
+
+    def test_few_jobs_requested_each_time(self):
+        job_ids = self.new_jobs(5)
+        for i in range(3):
+            del self.session.status_calls[:]
+            (status, errors) = self.scheduler.get_jobs_status(job_ids)
+            self.assertEqual(sorted(self.session.status_calls),
+                             sorted(job_ids))
+        self.session.jobs[job_ids[0]] = constants.RUNNING
+        (status, errors) = self.scheduler.get_jobs_status(job_ids)
+        self.assertEqual(status[job_ids[0]], constants.RUNNING)
+        self.assertEqual(errors, {})
+
+    def test_bounded_requests(self):
+        self.scheduler.max_status_requests = 10
+        job_ids = self.new_jobs(25)
+        self.scheduler.get_jobs_status(job_ids)
+        self.assertEqual(len(self.session.status_calls), 25)
+        for job_id in job_ids:
+            self.session.jobs[job_id] = constants.RUNNING
+        del self.session.status_calls[:]
+        for i in range(3):
+            (status, errors) = self.scheduler.get_jobs_status(job_ids)
+            self.assertEqual(len(self.session.status_calls), 10 * (i + 1))
+            self.assertEqual(sorted(status.keys()), sorted(job_ids))
+        # the least recently requested jobs first: all the jobs were
+        # requested again
+        self.assertEqual(set(self.session.status_calls), set(job_ids))
+        self.assertEqual(set(status.values()), set([constants.RUNNING]))
+
+    def test_new_jobs_always_requested(self):
+        self.scheduler.max_status_requests = 0
+        job_ids = self.new_jobs(3)
+        self.scheduler.get_jobs_status(job_ids)
+        new_job_ids = self.new_jobs(2)
+        del self.session.status_calls[:]
+        (status, errors) = self.scheduler.get_jobs_status(job_ids +
+                                                          new_job_ids)
+        self.assertEqual(sorted(self.session.status_calls),
+                         sorted(new_job_ids))
+        self.assertEqual(len(status), 5)
+
+    def test_ended_jobs_reaped(self):
+        job_ids = self.new_jobs(3)
+        self.scheduler.get_jobs_status(job_ids)
+        self.session.end_job(job_ids[0], exit_status=3)
+        del self.session.status_calls[:]
+        (status, errors) = self.scheduler.get_jobs_status(job_ids)
+        self.assertEqual(status[job_ids[0]], constants.DONE)
+        self.assertTrue(job_ids[0] not in self.session.status_calls)
+        self.assertEqual(self.scheduler.get_job_exit_info(job_ids[0])[:2],
+                         (constants.FINISHED_REGULARLY, 3))
+        # jobs not followed any more are forgotten
+        self.scheduler.get_jobs_status(job_ids[1:])
+        self.assertEqual(sorted(self.scheduler._status_cache.keys()),
+                         sorted(job_ids[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
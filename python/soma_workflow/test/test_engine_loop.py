@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Tests of the engine loop on top of a fake scheduler: job submissions by the
+DRMS worker threads and wait for the end of the workflows.
+'''
+from __future__ import with_statement
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.scheduler import Scheduler
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.errors import UnknownObjectError
+import soma_workflow.engine as engine
+import soma_workflow.constants as constants
+
+
+class FakeScheduler(Scheduler):
+    '''
+    Scheduler whose jobs keep running until they are killed or until the
+    tests end them (end_jobs).
+    '''
+
+    def __init__(self):
+        super(FakeScheduler, self).__init__()
+        self.parallel_job_submission_info = {}
+        # exception raised by jobs_submission
+        self.submission_error = None
+        # set by jobs_submission, which then waits for submission_allowed
+        self.submitting = threading.Event()
+        self.submission_allowed = threading.Event()
+        self.submission_allowed.set()
+        # scheduler job id -> status
+        self.status = {}
+        self.killed = []
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def jobs_submission(self, jobs):
+        self.submitting.set()
+        self.submission_allowed.wait()
+        if self.submission_error:
+            raise self.submission_error
+        scheduler_job_ids = {}
+        with self._lock:
+            for job in jobs:
+                scheduler_job_id = str(self._next_id)
+                self._next_id += 1
+                self.status[scheduler_job_id] = constants.RUNNING
+                scheduler_job_ids[job.job_id] = scheduler_job_id
+        return (scheduler_job_ids, {})
+
+    def get_jobs_status(self, scheduler_job_ids):
+        with self._lock:
+            return (dict((scheduler_job_id, self.status[scheduler_job_id])
+                         for scheduler_job_id in scheduler_job_ids), {})
+
+    def get_job_exit_info(self, scheduler_job_id):
+        return (constants.FINISHED_REGULARLY, 0, None, None)
+
+    def kill_job(self, scheduler_job_id):
+        with self._lock:
+            self.killed.append(scheduler_job_id)
+            self.status[scheduler_job_id] = constants.FAILED
+
+    def end_jobs(self):
+        with self._lock:
+            for scheduler_job_id in self.status:
+                self.status[scheduler_job_id] = constants.DONE
+
+
+class EngineLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="swf_test_")
+        self.database_server = WorkflowDatabaseServer(
+                                    os.path.join(self.tmp_dir,
+                                                 "soma_workflow.db"),
+                                    self.tmp_dir)
+        self.scheduler = FakeScheduler()
+        self.refreshment_interval = engine.refreshment_interval
+        engine.refreshment_interval = 0.1
+        self.engine = engine.WorkflowEngine(self.database_server,
+                                            self.scheduler)
+
+    def tearDown(self):
+        self.scheduler.submission_allowed.set()
+        self.engine.engine_loop_thread.stop()
+        engine.refreshment_interval = self.refreshment_interval
+        self.database_server.close_connections()
+        shutil.rmtree(self.tmp_dir)
+
+    def submit_workflow(self, nb_jobs=1):
+        jobs = [Job(["true"], name=str(i)) for i in range(nb_jobs)]
+        workflow = Workflow(jobs, zip(jobs[:-1], jobs[1:]))
+        return self.engine.submit_workflow(workflow, None, "test", None)
+
+    def jobs_status(self, wf_id):
+        '''
+        list of (status, exit status) of the jobs of the workflow, in the
+        order of their ids
+        '''
+        return [(job_info[1], job_info[3][0])
+                for job_info in sorted(
+                    self.engine.workflow_elements_status(wf_id)[0])]
+
+
+class SubmissionTest(EngineLoopTest):
+
+    def test_submission_error(self):
+        self.scheduler.submission_error = Exception("DRMS down")
+        wf_id = self.submit_workflow(nb_jobs=2)
+        self.engine.wait_workflow(wf_id, timeout=10)
+        self.assertEqual(self.engine.workflow_status(wf_id),
+                         constants.WORKFLOW_DONE)
+        # the failure of the first job aborts the second one
+        self.assertEqual(self.jobs_status(wf_id),
+                         [(constants.FAILED, constants.EXIT_ABORTED)] * 2)
+
+    def test_job_killed_during_submission(self):
+        self.scheduler.submission_allowed.clear()
+        job_id = self.engine.submit_job(Job(["true"]), None)
+        self.scheduler.submitting.wait(10)
+        self.assertTrue(self.scheduler.submitting.isSet())
+        self.engine.kill_job(job_id)
+        self.assertEqual(self.engine.job_status(job_id), constants.FAILED)
+        self.scheduler.submission_allowed.set()
+        end = time.time() + 10
+        while not self.scheduler.killed and time.time() < end:
+            time.sleep(0.01)
+        self.assertEqual(self.scheduler.killed, ["1"])
+        self.assertEqual(self.engine.job_termination_status(job_id)[0],
+                         constants.USER_KILLED)
+
+    def test_stop_loop(self):
+        workers = self.engine.engine_loop._drms_workers
+        self.engine.engine_loop_thread.stop()
+        for worker in workers:
+            worker.join(10)
+            self.assertFalse(worker.isAlive())
+        self.assertFalse(self.engine.engine_loop_thread.isAlive())
+
+
+class WaitWorkflowTest(EngineLoopTest):
+
+    def test_wait_until_done(self):
+        # loop iteration which wrote the WORKFLOW_DONE status
+        done_iterations = []
+        set_workflow_status = self.database_server.set_workflow_status
+
+        def recording_set_workflow_status(wf_id, status, *args, **kwargs):
+            if status == constants.WORKFLOW_DONE:
+                done_iterations.append(
+                                self.engine.engine_loop.iteration_count())
+            return set_workflow_status(wf_id, status, *args, **kwargs)
+
+        self.database_server.set_workflow_status = \
+                                              recording_set_workflow_status
+        wf_id = self.submit_workflow()
+        threading.Timer(0.3, self.scheduler.end_jobs).start()
+        self.engine.wait_workflow(wf_id)
+        self.assertEqual(self.engine.workflow_status(wf_id),
+                         constants.WORKFLOW_DONE)
+        self.assertEqual(len(done_iterations), 1)
+        # the iteration which wrote the status ended, and at most one more
+        self.assertTrue(self.engine.engine_loop.iteration_count() <=
+                        done_iterations[0] + 2)
+
+    def test_timeout(self):
+        wf_id = self.submit_workflow()
+        start = time.time()
+        self.engine.wait_workflow(wf_id, timeout=0.5)
+        duration = time.time() - start
+        self.assertTrue(0.5 <= duration < 2, duration)
+        self.assertEqual(self.engine.workflow_status(wf_id),
+                         constants.WORKFLOW_IN_PROGRESS)
+
+    def test_unknown_workflow(self):
+        self.assertRaises(UnknownObjectError,
+                          self.engine.wait_workflow, 12345, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Tests of the workflow inspection of the engine: dependency index, failure
+propagation and barrier jobs.
+'''
+import unittest
+
+from soma_workflow.client import Job, BarrierJob, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+import soma_workflow.constants as constants
+
+
+class EngineWorkflowTest(unittest.TestCase):
+
+    def engine_workflow(self, jobs, dependencies):
+        workflow = EngineWorkflow(Workflow(jobs, dependencies),
+                                  path_translation=None,
+                                  queue=None,
+                                  expiration_date=None,
+                                  name="test")
+        # ids given by the database server on registration
+        for job_id, job in enumerate(jobs):
+            engine_job = workflow.job_mapping[job]
+            engine_job.job_id = job_id + 1
+            workflow.registered_jobs[engine_job.job_id] = engine_job
+        return workflow
+
+    def engine_jobs(self, workflow, jobs):
+        return [workflow.job_mapping[job] for job in jobs]
+
+    def end(self, job, success=True):
+        if success:
+            job.status = constants.DONE
+            job.exit_status = constants.FINISHED_REGULARLY
+            job.exit_value = 0
+        else:
+            job.status = constants.FAILED
+            job.exit_status = constants.FINISHED_REGULARLY
+            job.exit_value = 1
+
+    def submit(self, jobs):
+        for job in jobs:
+            job.status = constants.QUEUED_ACTIVE
+
+
+class DependencyIndexTest(EngineWorkflowTest):
+
+    def test_diamond(self):
+        jobs = [Job(["true"], name=name) for name in "abcd"]
+        (a, b, c, d) = jobs
+        workflow = self.engine_workflow(jobs,
+                                        [(a, b), (a, c), (b, d), (c, d)])
+        (ea, eb, ec, ed) = self.engine_jobs(workflow, jobs)
+        self.assertEqual(set(workflow._successors[ea]), set([eb, ec]))
+        self.assertEqual(set(workflow._predecessors[ed]), set([eb, ec]))
+        self.assertEqual(workflow._nb_remaining_deps[ed], 2)
+
+        (to_run, status) = workflow.find_out_independant_jobs()
+        self.assertEqual(to_run, [ea])
+        self.assertEqual(status, constants.WORKFLOW_IN_PROGRESS)
+        self.submit(to_run)
+
+        self.end(ea)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [ea])
+        self.assertEqual(set(to_run), set([eb, ec]))
+        self.assertEqual(aborted_jobs, {})
+        self.submit(to_run)
+
+        self.end(eb)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [eb])
+        self.assertEqual(to_run, [])
+        self.assertEqual(workflow._nb_remaining_deps[ed], 1)
+        self.assertEqual(status, constants.WORKFLOW_IN_PROGRESS)
+
+        self.end(ec)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [ec])
+        self.assertEqual(to_run, [ed])
+        self.submit(to_run)
+
+        self.end(ed)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [ed])
+        self.assertEqual(to_run, [])
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+
+    def test_ended_job_counted_once(self):
+        jobs = [Job(["true"], name=name) for name in "abc"]
+        (a, b, c) = jobs
+        workflow = self.engine_workflow(jobs, [(a, c), (b, c)])
+        (ea, eb, ec) = self.engine_jobs(workflow, jobs)
+        self.submit(workflow.find_out_independant_jobs()[0])
+        self.end(ea)
+        workflow.find_out_jobs_to_process([ea])
+        # the same end reported again must not satisfy another dependency
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [ea])
+        self.assertEqual(to_run, [])
+        self.assertEqual(workflow._nb_remaining_deps[ec], 1)
+
+    def test_index_built_from_job_states(self):
+        jobs = [Job(["true"], name=name) for name in "abc"]
+        (a, b, c) = jobs
+        workflow = self.engine_workflow(jobs, [(a, c), (b, c)])
+        (ea, eb, ec) = self.engine_jobs(workflow, jobs)
+        self.end(ea)
+        self.submit([eb])
+        workflow._build_dependency_index()
+        self.assertEqual(workflow._nb_remaining_deps[ec], 1)
+        self.assertEqual(workflow._ended_jobs, set([ea]))
+        self.assertEqual(workflow._active_jobs, set([eb]))
+
+
+class FailureTest(EngineWorkflowTest):
+
+    def test_failure_aborts_the_branch(self):
+        # a -> b -> c -> e, a -> d, f -> c
+        jobs = [Job(["true"], name=name) for name in "abcdef"]
+        (a, b, c, d, e, f) = jobs
+        workflow = self.engine_workflow(jobs, [(a, b), (b, c), (c, e),
+                                               (a, d), (f, c)])
+        (ea, eb, ec, ed, ee, ef) = self.engine_jobs(workflow, jobs)
+        (to_run, status) = workflow.find_out_independant_jobs()
+        self.assertEqual(set(to_run), set([ea, ef]))
+        self.submit(to_run)
+
+        self.end(ea)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [ea])
+        self.assertEqual(set(to_run), set([eb, ed]))
+        self.submit(to_run)
+
+        self.end(eb, success=False)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [eb])
+        self.assertEqual(to_run, [])
+        self.assertEqual(set(aborted_jobs.itervalues()), set([ec, ee]))
+        for job in [ec, ee]:
+            self.assertEqual(job.status, constants.FAILED)
+            self.assertEqual(job.exit_status, constants.EXIT_ABORTED)
+        self.assertEqual(status, constants.WORKFLOW_IN_PROGRESS)
+
+        # the other branches go on
+        self.end(ef)
+        self.end(ed)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                    [ef, ed])
+        self.assertEqual(to_run, [])
+        self.assertEqual(aborted_jobs, {})
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+
+    def test_deep_chain(self):
+        # the traversal must not be recursive
+        jobs = [Job(["true"], name=str(i)) for i in range(5000)]
+        workflow = self.engine_workflow(jobs, zip(jobs[:-1], jobs[1:]))
+        engine_jobs = self.engine_jobs(workflow, jobs)
+        self.submit(workflow.find_out_independant_jobs()[0])
+        self.end(engine_jobs[0], success=False)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                            engine_jobs[:1])
+        self.assertEqual(len(aborted_jobs), len(jobs) - 1)
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+
+
+class BarrierTest(EngineWorkflowTest):
+
+    def test_barrier_cascade(self):
+        # a -> barrier1 -> barrier2 -> (b, c)
+        a = Job(["true"], name="a")
+        barrier1 = BarrierJob(name="barrier1")
+        barrier2 = BarrierJob(name="barrier2")
+        b = Job(["true"], name="b")
+        c = Job(["true"], name="c")
+        jobs = [a, barrier1, barrier2, b, c]
+        workflow = self.engine_workflow(jobs, [(a, barrier1),
+                                               (barrier1, barrier2),
+                                               (barrier2, b),
+                                               (barrier2, c)])
+        (ea, eb1, eb2, eb, ec) = self.engine_jobs(workflow, jobs)
+        self.submit(workflow.find_out_independant_jobs()[0])
+
+        self.end(ea)
+        (to_run, ended_jobs, status) = workflow.find_out_jobs_to_process([ea])
+        # the barriers are not submitted: both end at once
+        self.assertEqual(set(to_run), set([eb, ec]))
+        self.assertEqual(ended_jobs, {eb1.job_id: eb1, eb2.job_id: eb2})
+        for barrier in [eb1, eb2]:
+            self.assertEqual(barrier.status, constants.DONE)
+            self.assertEqual(barrier.exit_status,
+                             constants.FINISHED_REGULARLY)
+            self.assertEqual(barrier.exit_value, 0)
+        self.assertEqual(workflow.pop_ended_barriers(), {})
+
+    def test_independant_barrier(self):
+        barrier = BarrierJob(name="barrier")
+        a = Job(["true"], name="a")
+        workflow = self.engine_workflow([barrier, a], [(barrier, a)])
+        (eb, ea) = self.engine_jobs(workflow, [barrier, a])
+        (to_run, status) = workflow.find_out_independant_jobs()
+        self.assertEqual(to_run, [ea])
+        self.assertEqual(workflow.pop_ended_barriers(), {eb.job_id: eb})
+
+    def test_failure_aborts_the_barriers(self):
+        a = Job(["true"], name="a")
+        barrier = BarrierJob(name="barrier")
+        b = Job(["true"], name="b")
+        jobs = [a, barrier, b]
+        workflow = self.engine_workflow(jobs, [(a, barrier), (barrier, b)])
+        (ea, eba, eb) = self.engine_jobs(workflow, jobs)
+        self.submit(workflow.find_out_independant_jobs()[0])
+        self.end(ea, success=False)
+        (to_run, aborted_jobs, status) = workflow.find_out_jobs_to_process(
+                                                                        [ea])
+        self.assertEqual(to_run, [])
+        self.assertEqual(set(aborted_jobs.itervalues()), set([eba, eb]))
+        self.assertEqual(eba.exit_status, constants.EXIT_ABORTED)
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Tests of the LocalScheduler: the jobs are run on the local machine.
+'''
+import os
+import time
+import errno
+import shutil
+import tempfile
+import unittest
+
+from soma_workflow.scheduler import LocalScheduler
+import soma_workflow.constants as constants
+
+
+class FakeJob(object):
+    '''
+    The attributes of an EngineJob used by the LocalScheduler.
+    '''
+
+    def __init__(self, job_id, command, stdout, priority=0,
+                 parallel_job_info=None, is_barrier=False, memory=None):
+        self.job_id = job_id
+        self.command = command
+        self.stdout = stdout
+        self.priority = priority
+        self.parallel_job_info = parallel_job_info
+        self.is_barrier = is_barrier
+        self.memory = memory
+
+    def plain_command(self):
+        return self.command
+
+    def plain_stdout(self):
+        return self.stdout
+
+    def plain_stderr(self):
+        return None
+
+    def plain_stdin(self):
+        return None
+
+    def plain_working_directory(self):
+        return None
+
+
+class LocalSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="swf_test_")
+        self.scheduler = None
+        self.job_ids = []
+
+    def tearDown(self):
+        if self.scheduler != None:
+            for job_id in self.job_ids:
+                self.scheduler.kill_job(job_id)
+            self.scheduler.end_scheduler_thread()
+        shutil.rmtree(self.tmp_dir)
+
+    def start_scheduler(self, proc_nb=1, max_memory=None, job_memory=None):
+        self.scheduler = LocalScheduler(proc_nb=proc_nb,
+                                        interval=0.1,
+                                        max_memory=max_memory,
+                                        job_memory=job_memory)
+        return self.scheduler
+
+    def submit(self, command, **kwargs):
+        job_id = len(self.job_ids) + 1
+        job = FakeJob(job_id, command,
+                      os.path.join(self.tmp_dir, "stdout_%d" % job_id),
+                      **kwargs)
+        self.job_ids.append(job_id)
+        return self.scheduler.job_submission(job)
+
+    def wait_status(self, job_id, status, timeout=10):
+        end = time.time() + timeout
+        while self.scheduler.get_job_status(job_id) != status:
+            if time.time() > end:
+                self.fail("job %d: %s instead of %s"
+                          % (job_id, self.scheduler.get_job_status(job_id),
+                             status))
+            time.sleep(0.01)
+
+    def status(self):
+        return [self.scheduler.get_job_status(job_id)
+                for job_id in self.job_ids]
+
+
+class QueueTest(LocalSchedulerTest):
+
+    def test_proc_nb(self):
+        self.start_scheduler(proc_nb=2)
+        for i in range(3):
+            self.submit(["sleep", "30"])
+        self.wait_status(2, constants.RUNNING)
+        time.sleep(0.3)
+        self.assertEqual(self.status(), [constants.RUNNING,
+                                         constants.RUNNING,
+                                         constants.QUEUED_ACTIVE])
+        self.scheduler.kill_job(1)
+        self.wait_status(3, constants.RUNNING)
+
+    def test_priority(self):
+        self.start_scheduler(proc_nb=1)
+        self.submit(["sleep", "30"])
+        self.wait_status(1, constants.RUNNING)
+        self.submit(["sleep", "30"])
+        self.submit(["sleep", "30"], priority=10)
+        self.scheduler.kill_job(1)
+        self.wait_status(3, constants.RUNNING)
+        self.assertEqual(self.scheduler.get_job_status(2),
+                         constants.QUEUED_ACTIVE)
+
+
+class SlotsTest(LocalSchedulerTest):
+
+    def test_parallel_job_slots(self):
+        self.start_scheduler(proc_nb=3)
+        self.submit(["sleep", "30"])
+        self.submit(["sleep", "30"], parallel_job_info=("native", 2))
+        self.submit(["sleep", "30"], parallel_job_info=("native", 2))
+        self.wait_status(2, constants.RUNNING)
+        time.sleep(0.3)
+        self.assertEqual(self.scheduler.get_job_status(3),
+                         constants.QUEUED_ACTIVE)
+        self.scheduler.kill_job(2)
+        self.wait_status(3, constants.RUNNING)
+
+    def test_too_many_cpu_runs_alone(self):
+        self.start_scheduler(proc_nb=2)
+        self.submit(["sleep", "30"], parallel_job_info=("native", 8))
+        self.submit(["sleep", "30"])
+        self.wait_status(1, constants.RUNNING)
+        time.sleep(0.3)
+        self.assertEqual(self.scheduler.get_job_status(2),
+                         constants.QUEUED_ACTIVE)
+
+    def test_barrier_takes_no_slot(self):
+        self.start_scheduler(proc_nb=1)
+        self.submit(["sleep", "30"])
+        self.wait_status(1, constants.RUNNING)
+        self.submit([], is_barrier=True)
+        self.wait_status(2, constants.DONE)
+
+
+class BackfillTest(LocalSchedulerTest):
+
+    def test_backfill(self):
+        self.start_scheduler(proc_nb=2)
+        self.submit(["sleep", "30"])
+        self.wait_status(1, constants.RUNNING)
+        # does not fit in the free slot: the next job starts first
+        self.submit(["sleep", "30"], parallel_job_info=("native", 2))
+        self.submit(["sleep", "30"])
+        self.wait_status(3, constants.RUNNING)
+        self.assertEqual(self.scheduler.get_job_status(2),
+                         constants.QUEUED_ACTIVE)
+
+    def test_no_starvation(self):
+        self.start_scheduler(proc_nb=2)
+        self.submit(["sleep", "30"])
+        self.wait_status(1, constants.RUNNING)
+        big_job_id = self.submit(["sleep", "30"],
+                                 parallel_job_info=("native", 2))
+        # the big job can be overtaken proc_nb times
+        for i in range(2):
+            job_id = self.submit(["sleep", "30"])
+            self.wait_status(job_id, constants.RUNNING)
+            self.scheduler.kill_job(job_id)
+        job_id = self.submit(["sleep", "30"])
+        time.sleep(0.3)
+        self.assertEqual(self.scheduler.get_job_status(job_id),
+                         constants.QUEUED_ACTIVE)
+        self.scheduler.kill_job(1)
+        self.wait_status(big_job_id, constants.RUNNING)
+        time.sleep(0.3)
+        self.assertEqual(self.scheduler.get_job_status(job_id),
+                         constants.QUEUED_ACTIVE)
+
+
+class ResourceUsageTest(LocalSchedulerTest):
+
+    def test_resource_usage(self):
+        self.start_scheduler()
+        job_id = self.submit(["sleep", "0.2"])
+        self.wait_status(job_id, constants.DONE)
+        (exit_status,
+         exit_value,
+         terminating_signal,
+         resource_usage) = self.scheduler.get_job_exit_info(job_id)
+        self.assertEqual((exit_status, exit_value, terminating_signal),
+                         (constants.FINISHED_REGULARLY, 0, None))
+        if not hasattr(os, "wait4"):
+            self.assertEqual(resource_usage, None)
+            return
+        usage = dict(item.split("=") for item in resource_usage.split())
+        self.assertEqual(set(usage),
+                         set(["ru_wallclock", "ru_utime", "ru_stime",
+                              "ru_maxrss"]))
+        self.assertTrue(float(usage["ru_wallclock"]) >= 0.2)
+        self.assertTrue(int(usage["ru_maxrss"]) > 0)
+
+    def test_exit_value(self):
+        self.start_scheduler()
+        job_id = self.submit(["sh", "-c", "exit 3"])
+        self.wait_status(job_id, constants.DONE)
+        self.assertEqual(self.scheduler.get_job_exit_info(job_id)[:2],
+                         (constants.FINISHED_REGULARLY, 3))
+
+    def test_lost_exit_status(self):
+        if not hasattr(os, "wait4"):
+            return
+        wait4 = os.wait4
+
+        def reaped_by_someone_else(pid, options):
+            os.waitpid(pid, options)
+            raise OSError(errno.ECHILD, os.strerror(errno.ECHILD))
+
+        os.wait4 = reaped_by_someone_else
+        try:
+            self.start_scheduler()
+            job_id = self.submit(["true"])
+            self.wait_status(job_id, constants.FAILED)
+        finally:
+            os.wait4 = wait4
+        self.assertEqual(self.scheduler.get_job_exit_info(job_id)[:2],
+                         (constants.FINISHED_UNCLEAR_CONDITIONS, None))
+
+
+class MemoryTest(LocalSchedulerTest):
+
+    def test_job_memory(self):
+        self.start_scheduler(proc_nb=4, max_memory=1000, job_memory=400)
+        big_job_id = self.submit(["sleep", "30"], memory=800)
+        self.wait_status(big_job_id, constants.RUNNING)
+        # JOB_MEMORY: 400 MB
+        job_id = self.submit(["sleep", "30"])
+        small_job_id = self.submit(["sleep", "30"], memory=100)
+        self.wait_status(small_job_id, constants.RUNNING)
+        self.assertEqual(self.scheduler.get_job_status(job_id),
+                         constants.QUEUED_ACTIVE)
+        self.scheduler.kill_job(big_job_id)
+        self.wait_status(job_id, constants.RUNNING)
+
+    def test_too_big_job_runs_alone(self):
+        self.start_scheduler(proc_nb=4, max_memory=1000, job_memory=400)
+        job_id = self.submit(["sleep", "30"])
+        self.wait_status(job_id, constants.RUNNING)
+        big_job_id = self.submit(["sleep", "30"], memory=5000)
+        time.sleep(0.3)
+        self.assertEqual(self.scheduler.get_job_status(big_job_id),
+                         constants.QUEUED_ACTIVE)
+        self.scheduler.kill_job(job_id)
+        self.wait_status(big_job_id, constants.RUNNING)
+
+
+class KillTest(LocalSchedulerTest):
+
+    def test_kill_running_job(self):
+        self.start_scheduler()
+        job_id = self.submit(["sleep", "30"])
+        self.wait_status(job_id, constants.RUNNING)
+        process = self.scheduler._processes[job_id]
+        self.scheduler.kill_job(job_id)
+        self.assertEqual(self.scheduler.get_job_status(job_id),
+                         constants.FAILED)
+        self.assertEqual(self.scheduler.get_job_exit_info(job_id)[0],
+                         constants.USER_KILLED)
+        # reaped by the reaper thread
+        end = time.time() + 10
+        while process.returncode is None and time.time() < end:
+            time.sleep(0.01)
+        self.assertTrue(process.returncode < 0)
+
+    def test_kill_queued_job(self):
+        self.start_scheduler(proc_nb=1)
+        running_job_id = self.submit(["sleep", "30"])
+        self.wait_status(running_job_id, constants.RUNNING)
+        job_id = self.submit(["true"])
+        self.scheduler.kill_job(job_id)
+        self.assertEqual(self.scheduler.get_job_status(job_id),
+                         constants.FAILED)
+        self.assertEqual(self.scheduler.get_job_exit_info(job_id)[0],
+                         constants.EXIT_ABORTED)
+
+    def test_kill_reaped_job(self):
+        # the process ends and is reaped while the job is killed: its pid
+        # must not be signaled and the end of the job is recorded
+        self.start_scheduler()
+        job_id = self.submit(["sleep", "0.5"])
+        self.wait_status(job_id, constants.RUNNING)
+        process = self.scheduler._processes[job_id]
+        with self.scheduler._lock:
+            end = time.time() + 10
+            while process.returncode is None and time.time() < end:
+                time.sleep(0.01)
+            self.assertEqual(process.returncode, 0)
+            self.scheduler.kill_job(job_id)
+        self.wait_status(job_id, constants.DONE)
+        self.assertEqual(self.scheduler.get_job_exit_info(job_id)[:2],
+                         (constants.FINISHED_REGULARLY, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+'''
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+
+Tests of the portable transfer: md5 hashes computed over the chunks, resumed
+transfers, transfer sessions and bundles of small files. The remote file
+controller runs in the test process.
+'''
+import os
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+import cStringIO
+
+from soma_workflow.transfer import RemoteFileController, \
+                                   PortableRemoteTransfer
+from soma_workflow.errors import UnknownObjectError
+
+
+class RecordingFileController(RemoteFileController):
+    '''
+    Remote file controller recording the calls transfering data.
+    '''
+
+    def __init__(self):
+        super(RecordingFileController, self).__init__()
+        self.calls = []
+
+    def write_chunk(self, handle, location, data):
+        self.calls.append(("write_chunk", location, len(data)))
+        return super(RecordingFileController, self).write_chunk(handle,
+                                                                location,
+                                                                data)
+
+    def read_chunk(self, handle, location, buffer_size):
+        self.calls.append(("read_chunk", location, buffer_size))
+        return super(RecordingFileController, self).read_chunk(handle,
+                                                               location,
+                                                               buffer_size)
+
+    def write_archive(self, path, data):
+        self.calls.append(("write_archive", path, len(data)))
+        return super(RecordingFileController, self).write_archive(path, data)
+
+
+class TransferTest(unittest.TestCase):
+
+    buffer_size = 1024
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="swf_test_")
+        self.controller = RecordingFileController()
+        self.transfer = PortableRemoteTransfer(self.controller,
+                                               window_size=4,
+                                               bundle_threshold=512)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.tmp_dir, *names)
+
+    def write_file(self, path, data):
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+
+    def read_file(self, path):
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def data(self, size, seed=0):
+        return "".join(chr((i * 7 + seed) % 256) for i in xrange(size))
+
+    def calls(self, method_name):
+        return [call for call in self.controller.calls
+                if call[0] == method_name]
+
+
+class Md5HashTest(TransferTest):
+
+    def test_md5_hash_of_written_data(self):
+        data = self.data(5000)
+        path = self.path("file")
+        self.controller.create_file(path)
+        for location in range(0, len(data), self.buffer_size):
+            self.controller.write(path,
+                                  data[location:location + self.buffer_size])
+        self.assertEqual(self.controller.get_md5_hash(path),
+                         hashlib.md5(data).hexdigest())
+        # the running hash is only used once
+        self.assertFalse(path in self.controller._md5_hashes)
+
+    def test_md5_hash_of_read_data(self):
+        data = self.data(3000)
+        path = self.path("file")
+        self.write_file(path, data)
+        chunks = [self.controller.read(path, location, self.buffer_size)
+                  for location in range(0, len(data), self.buffer_size)]
+        self.assertEqual("".join(chunks), data)
+        self.assertEqual(self.controller.get_md5_hash(path),
+                         hashlib.md5(data).hexdigest())
+
+    def test_file_changed(self):
+        path = self.path("file")
+        self.controller.create_file(path)
+        self.controller.write(path, "data")
+        # written without the file controller: the file is read again
+        f = open(path, "ab")
+        f.write("more data")
+        f.close()
+        self.assertEqual(self.controller.get_md5_hash(path),
+                         hashlib.md5("datamore data").hexdigest())
+
+
+class ResumeTest(TransferTest):
+
+    def test_transfer_to_remote(self):
+        data = self.data(10 * self.buffer_size + 100)
+        path = self.path("file")
+        remote_path = self.path("remote")
+        self.write_file(path, data)
+        # interrupted transfer: 4 chunks identical, then wrong data
+        self.write_file(remote_path,
+                        data[:4 * self.buffer_size] +
+                        self.data(self.buffer_size + 10, seed=1))
+        self.transfer.transfer_to_remote(path, remote_path,
+                                         buffer_size=self.buffer_size)
+        self.assertEqual(self.read_file(remote_path), data)
+        self.assertEqual(
+            sorted(call[1] for call in self.calls("write_chunk")),
+            range(4 * self.buffer_size, len(data), self.buffer_size))
+
+    def test_transfer_from_remote(self):
+        data = self.data(10 * self.buffer_size + 100)
+        path = self.path("file")
+        remote_path = self.path("remote")
+        self.write_file(remote_path, data)
+        self.write_file(path, data[:6 * self.buffer_size + 10])
+        self.transfer.transfer_from_remote(remote_path, path,
+                                           buffer_size=self.buffer_size)
+        self.assertEqual(self.read_file(path), data)
+        self.assertEqual(
+            [call[1] for call in self.calls("read_chunk")],
+            range(6 * self.buffer_size, len(data), self.buffer_size))
+
+    def test_longer_remote_file(self):
+        data = self.data(3 * self.buffer_size)
+        path = self.path("file")
+        remote_path = self.path("remote")
+        self.write_file(path, data)
+        self.write_file(remote_path, data + self.data(5000, seed=2))
+        self.transfer.transfer_to_remote(path, remote_path,
+                                         buffer_size=self.buffer_size)
+        self.assertEqual(self.read_file(remote_path), data)
+
+    def test_progression(self):
+        data = self.data(5 * self.buffer_size)
+        path = self.path("file")
+        remote_path = self.path("remote")
+        self.write_file(path, data)
+        self.write_file(remote_path, data[:2 * self.buffer_size])
+        sizes = []
+        self.transfer.transfer_to_remote(path, remote_path,
+                                         buffer_size=self.buffer_size,
+                                         callback=sizes.append)
+        self.assertEqual(sum(sizes), len(data))
+
+
+class SessionTest(TransferTest):
+
+    def test_md5_hash_of_chunks(self):
+        data = self.data(5000)
+        path = self.path("file")
+        handle = self.controller.open_file(path, 'w')
+        for location in range(0, len(data), self.buffer_size):
+            self.controller.write_chunk(
+                        handle, location,
+                        data[location:location + self.buffer_size])
+        self.assertEqual(self.controller.close_file(handle),
+                         hashlib.md5(data).hexdigest())
+        self.assertEqual(self.read_file(path), data)
+
+    def test_chunks_out_of_order(self):
+        data = self.data(5000)
+        path = self.path("file")
+        handle = self.controller.open_file(path, 'w')
+        locations = range(0, len(data), self.buffer_size)
+        for location in reversed(locations):
+            self.controller.write_chunk(
+                        handle, location,
+                        data[location:location + self.buffer_size])
+        self.assertEqual(self.controller.close_file(handle),
+                         hashlib.md5(data).hexdigest())
+        self.assertEqual(self.read_file(path), data)
+
+    def test_read_session(self):
+        data = self.data(3000)
+        path = self.path("file")
+        self.write_file(path, data)
+        handle = self.controller.open_file(path, 'r')
+        chunks = [self.controller.read_chunk(handle, location,
+                                             self.buffer_size)
+                  for location in range(0, len(data), self.buffer_size)]
+        self.assertEqual("".join(chunks), data)
+        self.assertEqual(self.controller.close_file(handle),
+                         hashlib.md5(data).hexdigest())
+
+    def test_closed_session(self):
+        handle = self.controller.open_file(self.path("file"), 'w')
+        self.controller.close_file(handle)
+        self.assertRaises(UnknownObjectError,
+                          self.controller.write_chunk, handle, 0, "data")
+        self.assertRaises(UnknownObjectError,
+                          self.controller.close_file, handle)
+        self.assertRaises(ValueError,
+                          self.controller.open_file, self.path("file"), 'a')
+
+    def test_idle_data_dropped(self):
+        path = self.path("file")
+        handle = self.controller.open_file(path, 'w')
+        self.controller.write_chunk(handle, 0, "data")
+        self.controller.get_chunks_md5_hashes(self.path("other"),
+                                              self.buffer_size, 1)
+        active_handle = self.controller.open_file(self.path("active"), 'w')
+        self.controller._open_files[handle].last_access -= \
+                                        self.controller.idle_timeout + 1
+        for path_key in self.controller._md5_dates:
+            self.controller._md5_dates[path_key] -= \
+                                        self.controller.idle_timeout + 1
+        self.controller._drop_idle_data(force=True)
+        self.assertRaises(UnknownObjectError,
+                          self.controller.write_chunk, handle, 4, "data")
+        # the data written is flushed
+        self.assertEqual(self.read_file(path), "data")
+        self.assertEqual(self.controller._md5_hashes, {})
+        self.assertEqual(self.controller._md5_checkpoints, {})
+        self.controller.write_chunk(active_handle, 0, "data")
+        self.controller.close_file(active_handle)
+
+
+class CopyTest(TransferTest):
+
+    def test_copy_shares_file_controller(self):
+        transfer = self.transfer.copy()
+        self.assertTrue(transfer.remote_file_controller is self.controller)
+
+
+class BundleTest(TransferTest):
+
+    def make_directory(self):
+        path = self.path("dir")
+        os.makedirs(os.path.join(path, "sub", "subsub"))
+        files = {os.path.join("small_1"): self.data(10),
+                 os.path.join("sub", "small_2"): self.data(100, seed=1),
+                 os.path.join("sub", "subsub", "small_3"): "",
+                 os.path.join("sub", "big"): self.data(5000, seed=2)}
+        for relative_path, data in files.iteritems():
+            self.write_file(os.path.join(path, relative_path), data)
+        return (path, files)
+
+    def test_directory_transfer(self):
+        (path, files) = self.make_directory()
+        remote_path = self.path("remote")
+        self.transfer.transfer_to_remote(path, remote_path,
+                                         buffer_size=4 * self.buffer_size)
+        for relative_path, data in files.iteritems():
+            self.assertEqual(
+                self.read_file(os.path.join(remote_path, relative_path)),
+                data)
+        # the small files are sent in one archive, the big file by chunks
+        self.assertEqual(len(self.calls("write_archive")), 1)
+        self.assertEqual(len(self.calls("write_chunk")), 2)
+
+    def test_split_transfer(self):
+        (path, files) = self.make_directory()
+        remote_path = self.path("remote")
+        self.transfer.max_bundle_size = 50
+        transfers = self.transfer.split_transfer_to_remote(path, remote_path)
+        bundles = [transfer[2] for transfer in transfers
+                   if len(transfer) == 3]
+        self.assertEqual(sorted(sum(bundles, [])),
+                         sorted(relative_path for relative_path in files
+                                if len(files[relative_path]) < 512))
+        self.assertEqual(len(bundles), 2)
+        self.assertEqual([transfer[:2] for transfer in transfers
+                          if len(transfer) == 2],
+                         [(os.path.join(path, "sub", "big"),
+                           os.path.join(remote_path, "sub", "big"))])
+
+    def test_unsafe_archive(self):
+        buffer = cStringIO.StringIO()
+        archive = tarfile.open(fileobj=buffer, mode='w')
+        info = tarfile.TarInfo(os.path.join(os.pardir, "outside"))
+        info.size = 4
+        archive.addfile(info, cStringIO.StringIO("data"))
+        archive.close()
+        remote_path = self.path("remote")
+        os.mkdir(remote_path)
+        self.assertRaises(ValueError, self.controller.write_archive,
+                          remote_path, buffer.getvalue())
+        self.assertFalse(os.path.exists(self.path("outside")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@
 
 @license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
 '''
+from __future__ import with_statement
 
 import os
 import hashlib
@@ -14,18 +15,299 @@ import stat
 import operator
 import shutil
 import time
+import copy
+import itertools
+import threading
+import collections
+import atexit
+import Queue
+import tarfile
+import cStringIO
+
+from soma_workflow.errors import UnknownObjectError
+
+
+class OpenFile(object):
+  '''
+  File opened by RemoteFileController.open_file for a transfer session.
+  The chunks can be written or read in any order: the running md5 hash is
+  updated in the file order, the chunks which come too early being kept
+  until the chunks before them are hashed.
+  '''
+
+  # maximum number of chunks kept for the running md5 hash
+  max_pending_chunks = 32
+
+  path = None
+
+  mode = None
+
+  # python file object
+  file = None
+
+  # tuple (size, md5 hash object) or None if the hash had to be dropped
+  md5_hash = None
+
+  # dictionary: location -> data not hashed yet
+  pending_chunks = None
+
+  lock = None
+
+  # time of the last read or write
+  last_access = None
+
+  def __init__(self, path, mode, md5_hash):
+    self.path = path
+    self.mode = mode
+    if mode == 'w':
+      if os.path.isfile(path):
+        self.file = open(path, 'r+b')
+      else:
+        self.file = open(path, 'wb')
+    else:
+      self.file = open(path, 'rb')
+    self.md5_hash = md5_hash
+    self.pending_chunks = {}
+    self.lock = threading.Lock()
+    self.last_access = time.time()
+
+  def write(self, location, data):
+    with self.lock:
+      self.last_access = time.time()
+      self.file.seek(location)
+      self.file.write(data)
+      self._update_md5_hash(location, data)
+      return location + len(data)
+
+  def read(self, location, buffer_size):
+    with self.lock:
+      self.last_access = time.time()
+      self.file.seek(location)
+      data = self.file.read(buffer_size)
+      self._update_md5_hash(location, data)
+      return data
+
+  def close(self, md5_hash=True):
+    '''
+    Closes the file, making sure the data written is on the disk.
+
+    returns the md5 hash of the file, or None if md5_hash is False
+    '''
+    with self.lock:
+      if self.mode == 'w':
+        self.file.flush()
+        os.fsync(self.file.fileno())
+      self.file.close()
+      if not md5_hash:
+        return None
+      if self.md5_hash != None and \
+         self.md5_hash[0] == os.path.getsize(self.path):
+        return self.md5_hash[1].hexdigest()
+    return Transfer.get_md5_hash(self.path)
+
+  def _update_md5_hash(self, location, data):
+    if self.md5_hash == None or not data:
+      return
+    (size, md5_hash) = self.md5_hash
+    if location < size or \
+       len(self.pending_chunks) >= self.max_pending_chunks:
+      # the hashed part was overwritten or the chunks are not sent in order
+      self.md5_hash = None
+      self.pending_chunks = {}
+      return
+    self.pending_chunks[location] = data
+    while size in self.pending_chunks:
+      data = self.pending_chunks.pop(size)
+      md5_hash.update(data)
+      size = size + len(data)
+    self.md5_hash = (size, md5_hash)
+
 
 class RemoteFileController(object):
 
+  # seconds after which the transfer sessions and the md5 hashes which were 
+  # not used are dropped: the client may have been disconnected
+  idle_timeout = 3600
+
+  # minimum number of seconds between two searches of idle data
+  idle_check_interval = 60
+
+  # dictionary: path -> (size, md5 hash object)
+  # running md5 hashes of the files being written or read sequentially,
+  # so that get_md5_hash does not need to read the file again.
+  _md5_hashes = None
+
+  # dictionary: path -> sequence of (size, md5 hash object)
+  # md5 hashes of the last chunks compared by get_chunks_md5_hashes, so that
+  # the running md5 hash is kept if the file is then truncated to one of them.
+  _md5_checkpoints = None
+
+  # dictionary: handle -> OpenFile
+  _open_files = None
+
+  _handles = None
+
+  # dictionary: path -> time of the last update of its md5 hash or checkpoints
+  _md5_dates = None
+
+  # time of the last search of idle data
+  _idle_check_date = None
+
+  def __init__(self):
+    self._md5_hashes = {}
+    self._md5_checkpoints = {}
+    self._md5_dates = {}
+    self._open_files = {}
+    self._handles = itertools.count(1)
+    self._idle_check_date = time.time()
+
+  def open_file(self, path, mode):
+    '''
+    Opens a file for a transfer session. The chunks of the file are then
+    written with write_chunk or read with read_chunk, possibly by several
+    concurrent calls, and the session ends with close_file.
+
+    * path *string*
+
+    * mode *'r' or 'w'*
+        'w' opens the file for writing. The file is created if it does not
+        exist and is not truncated (see truncate_file).
+
+    * returns: *int*
+        handle of the open file
+    '''
+    if mode not in ['r', 'w']:
+      raise ValueError("Unknown file mode: %s" % repr(mode))
+    self._drop_idle_data()
+    md5_hash = self._md5_hashes.pop(path, None)
+    self._md5_checkpoints.pop(path, None)
+    if md5_hash == None and (mode == 'r' or self.get_file_size(path) == 0):
+      md5_hash = (0, hashlib.md5())
+    handle = self._handles.next()
+    self._open_files[handle] = OpenFile(path, mode, md5_hash)
+    return handle
+
+  def write_chunk(self, handle, location, data):
+    '''
+    Writes data at location in a file opened with open_file.
+
+    * returns: *int*
+        location of the end of the chunk
+    '''
+    return self._open_file(handle).write(location, data)
+
+  def read_chunk(self, handle, location, buffer_size):
+    '''
+    Reads at most buffer_size bytes at location in a file opened with
+    open_file.
+    '''
+    return self._open_file(handle).read(location, buffer_size)
+
+  def close_file(self, handle):
+    '''
+    Ends a transfer session: closes the file and makes sure the data
+    written is on the disk.
+
+    * returns: *string*
+        md5 hash of the file
+    '''
+    open_file = self._open_file(handle)
+    del self._open_files[handle]
+    return open_file.close()
+
+  def _open_file(self, handle):
+    open_file = self._open_files.get(handle)
+    if open_file == None:
+      raise UnknownObjectError("The file handle " + repr(handle) + " is not "
+                               "valid or the file was closed.")
+    return open_file
+
+  def _drop_idle_data(self, force=False):
+    '''
+    Closes the transfer sessions and drops the md5 hashes which were not used 
+    for idle_timeout seconds. The search is done at most every 
+    idle_check_interval seconds unless force is True.
+    '''
+    now = time.time()
+    if not force and now - self._idle_check_date < self.idle_check_interval:
+      return
+    self._idle_check_date = now
+    limit = now - self.idle_timeout
+    for handle, open_file in self._open_files.items():
+      if open_file.last_access < limit and \
+         self._open_files.pop(handle, None) != None:
+        try:
+          open_file.close(md5_hash=False)
+        except (IOError, OSError):
+          pass
+    for path, date in self._md5_dates.items():
+      if date < limit:
+        self._md5_dates.pop(path, None)
+        self._md5_hashes.pop(path, None)
+        self._md5_checkpoints.pop(path, None)
+
+  def _set_md5_hash(self, path, md5_hash, checkpoints=None):
+    self._md5_hashes[path] = md5_hash
+    if checkpoints != None:
+      self._md5_checkpoints[path] = checkpoints
+    self._md5_dates[path] = time.time()
+    self._drop_idle_data()
+
   def create_file(self, path):
     f = open(path, 'wb')
     f.close()
+    self._set_md5_hash(path, (0, hashlib.md5()))
+
+  def truncate_file(self, path, size):
+    '''
+    Truncates the file to size bytes, creating it if it does not exist.
+    '''
+    f = open(path, 'ab')
+    f.truncate(size)
+    f.close()
+    md5_hashes = list(self._md5_checkpoints.pop(path, []))
+    if path in self._md5_hashes:
+      md5_hashes.append(self._md5_hashes.pop(path))
+    md5_hashes.append((0, hashlib.md5()))
+    for md5_hash in md5_hashes:
+      if md5_hash[0] == size:
+        self._set_md5_hash(path, md5_hash)
+        break
+
+  def get_chunks_md5_hashes(self, path, buffer_size, nb_chunks):
+    '''
+    Returns the md5 hashes of the nb_chunks first complete chunks of
+    buffer_size bytes of the file (less if the file is too small), so that an
+    interrupted transfer can be resumed after the last chunk which is
+    identical on both sides.
+    The running md5 hash of the file is then the hash of these chunks.
+    '''
+    chunks_md5_hashes = []
+    md5_hash = hashlib.md5()
+    checkpoints = collections.deque(maxlen=OpenFile.max_pending_chunks)
+    if os.path.isfile(path):
+      f = open(path, 'rb')
+      while len(chunks_md5_hashes) < nb_chunks:
+        data = f.read(buffer_size)
+        if len(data) < buffer_size:
+          break
+        checkpoints.append((len(chunks_md5_hashes) * buffer_size,
+                            md5_hash.copy()))
+        md5_hash.update(data)
+        chunks_md5_hashes.append(hashlib.md5(data).hexdigest())
+      f.close()
+    self._set_md5_hash(path, 
+                       (len(chunks_md5_hashes) * buffer_size, md5_hash),
+                       checkpoints)
+    return chunks_md5_hashes
 
   def write(self, path, data):
     f = open(path, 'ab')
+    location = f.tell()
     f.write(data)
     fs = f.tell()
     f.close()
+    self._update_md5_hash(path, location, data)
     return fs
 
   def read(self, path, location, buffer_size):
@@ -33,8 +315,51 @@ class RemoteFileController(object):
     f.seek(location)
     data = f.read(buffer_size)
     f.close()
+    if location == 0:
+      self._set_md5_hash(path, (0, hashlib.md5()))
+    self._update_md5_hash(path, location, data)
     return data
+
+  def _update_md5_hash(self, path, location, data):
+    '''
+    Updates the running md5 hash of path with data, if data directly follows
+    the hashed part of the file. Otherwise the hash is dropped and
+    get_md5_hash will read the file.
+    '''
+    (size, md5_hash) = self._md5_hashes.get(path, (None, None))
+    if md5_hash == None:
+      return
+    if location != size:
+      self._md5_hashes.pop(path, None)
+      return
+    md5_hash.update(data)
+    self._set_md5_hash(path, (size + len(data), md5_hash))
     
+  def write_archive(self, path, data):
+    '''
+    Extracts the files of a tar archive in the directory path: a bundle of
+    small files transfered at once. The directories of the files must exist
+    (see create_dir_structure).
+
+    * data *string*
+        content of the tar archive
+
+    * returns: *int*
+        size of the files extracted
+    '''
+    archive = tarfile.open(fileobj=cStringIO.StringIO(data), mode='r')
+    try:
+      members = archive.getmembers()
+      for member in members:
+        if not member.isfile() or os.path.isabs(member.name) or \
+           os.path.normpath(member.name).split(os.sep)[0] == os.pardir:
+          raise ValueError("Unexpected file in the archive: %s" %
+                           repr(member.name))
+      archive.extractall(path, members)
+    finally:
+      archive.close()
+    return sum(member.size for member in members)
+
   def get_file_size(self, path):
     if os.path.isfile(path):
       size = os.path.getsize(path)
@@ -52,8 +377,10 @@ class RemoteFileController(object):
     return Transfer.get_dir_size(path)
 
   def get_md5_hash(self, path):
-    md5_hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
-    return md5_hash
+    (size, md5_hash) = self._md5_hashes.pop(path, (None, None))
+    if md5_hash != None and size == self.get_file_size(path):
+      return md5_hash.hexdigest()
+    return Transfer.get_md5_hash(path)
 
   def top_down_dir_list(self, path):
     return Transfer.top_down_dir_list(path)
@@ -62,8 +389,7 @@ class RemoteFileController(object):
     return Transfer.create_dir_structure(path, top_down_relalive_path)
 
   def create_dirs(self, path):
-    if not os.path.isdir(os.path.dirname(path)):
-      os.makedirs(os.path.dirname(path))
+    return Transfer.create_dirs(path)
 
 
 
@@ -130,7 +456,19 @@ class Transfer(object):
   def __init__(self, remote_file_controller):
     self.remote_file_controller = remote_file_controller
 
-  def transfer_to_remote(self, path, remote_path):
+  def copy(self):
+    '''
+    Returns a transfer of the same kind which can be used by another thread:
+    it has its own connection if the remote file controller is a Pyro proxy. 
+    A RemoteFileController object (such as the engine embedded in the light 
+    mode) is shared.
+    '''
+    transfer = copy.copy(self)
+    if not isinstance(self.remote_file_controller, RemoteFileController):
+      transfer.remote_file_controller = copy.copy(self.remote_file_controller)
+    return transfer
+
+  def transfer_to_remote(self, path, remote_path, callback=None):
     '''
     Transfer a file or a directory to a remote location.
 
@@ -139,10 +477,14 @@ class Transfer(object):
 
     * remote_path *string*
       Path on the remote file system.
+
+    * callback *function(int)*
+      Optional function called with the size of the data transfered, as the
+      transfer goes on.
     '''
     pass
 
-  def transfer_from_remote(self, remote_path, path):
+  def transfer_from_remote(self, remote_path, path, callback=None):
     '''
     Transfer a file or a directory from a remote location.
 
@@ -152,10 +494,43 @@ class Transfer(object):
     * remote_path *string*
       Path on the remote file system.
 
+    * callback *function(int)*
+      Optional function called with the size of the data transfered, as the
+      transfer goes on.
     '''
 
     pass
 
+  def split_transfer_to_remote(self, path, remote_path):
+    '''
+    Splits the transfer of a file or a directory to a remote location in
+    transfers which can be done in parallel, creating the directories they
+    need.
+
+    returns a list of tuples (path, remote_path), or
+    (path, remote_path, relative_paths) for a bundle of files of the
+    directory path (see PortableRemoteTransfer.transfer_to_remote)
+    '''
+    return [(path, remote_path)]
+
+  def split_transfer_from_remote(self, remote_path, path):
+    '''
+    Splits the transfer of a file or a directory from a remote location in
+    transfers which can be done in parallel, creating the directories they
+    need.
+
+    returns a list of tuples (remote_path, path)
+    '''
+    return [(remote_path, path)]
+
+  def _report_progress(self, callback, path):
+    if callback == None:
+      return
+    if os.path.isfile(path):
+      callback(os.path.getsize(path))
+    elif os.path.isdir(path):
+      callback(self.get_dir_size(path))
+
 
   @staticmethod
   def get_dir_size(path):
@@ -170,6 +545,17 @@ class Transfer(object):
         #print "size: %0.1f MB cumul: %0.1f MB" %(file_size/(1024*1024.0), size/(1024*1024.0))
     return size
 
+  @staticmethod
+  def get_md5_hash(path, buffer_size=512**2):
+    md5_hash = hashlib.md5()
+    f = open(path, 'rb')
+    data = f.read(buffer_size)
+    while data:
+      md5_hash.update(data)
+      data = f.read(buffer_size)
+    f.close()
+    return md5_hash.hexdigest()
+
   @staticmethod
   def top_down_dir_list(path):
     abs_path = os.path.abspath(path)
@@ -179,12 +565,26 @@ class Transfer(object):
       r_root = root[len(abs_path)+1:]
       if r_root:
         dir_list.append(r_root)
-        file_list = []
-        for name in files:
-          file_list.append(name)
-        file_path_dict[r_root] = file_list
+      file_list = []
+      for name in files:
+        file_list.append(name)
+      file_path_dict[r_root] = file_list
     return (dir_list, file_path_dict)
 
+  @staticmethod
+  def create_dirs(path):
+    '''
+    Creates the parent directories of path, if needed. Several threads can
+    create them at once.
+    '''
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+      try:
+        os.makedirs(dir_path)
+      except OSError:
+        if not os.path.isdir(dir_path):
+          raise
+
   @staticmethod
   def create_dir_structure(path, top_down_relalive_path):
     if not os.path.isdir(path):
@@ -207,7 +607,7 @@ class TransferSCP(Transfer):
     self.hostname = hostname    
     #print "SCP transfer"
 
-  def transfer_to_remote(self, path, remote_path):
+  def transfer_to_remote(self, path, remote_path, callback=None):
     if os.path.isfile(path):
       self.remote_file_controller.create_dirs(remote_path)
       if self.username != None and self.hostname != None:
@@ -240,9 +640,10 @@ class TransferSCP(Transfer):
           scp_cmd = 'scp -Cqpr %s %s' %(path, remote_path)
       print scp_cmd
       os.system(scp_cmd)
+    self._report_progress(callback, path)
       
 
-  def transfer_from_remote(self, remote_path, path):
+  def transfer_from_remote(self, remote_path, path, callback=None):
     if self.remote_file_controller.is_file(remote_path):
       if not os.path.isdir(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
@@ -278,6 +679,7 @@ class TransferSCP(Transfer):
 
       print scp_cmd
       os.system(scp_cmd)
+    self._report_progress(callback, path)
       
 
 class TransferRsync(Transfer):
@@ -293,7 +695,7 @@ class TransferRsync(Transfer):
     #print "Rsync transfer"
 
 
-  def transfer_to_remote(self, path, remote_path):
+  def transfer_to_remote(self, path, remote_path, callback=None):
     if os.path.isfile(path):
       self.remote_file_controller.create_dirs(remote_path)
       if self.username != None and self.hostname != None:
@@ -318,9 +720,10 @@ class TransferRsync(Transfer):
                                          remote_path)
       print rsync_cmd
       os.system(rsync_cmd)
+    self._report_progress(callback, path)
       
 
-  def transfer_from_remote(self, remote_path, path):
+  def transfer_from_remote(self, remote_path, path, callback=None):
     if self.remote_file_controller.is_file(remote_path):
       if not os.path.isdir(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
@@ -347,6 +750,7 @@ class TransferRsync(Transfer):
                                           path)
       print rsync_cmd
       os.system(rsync_cmd)
+    self._report_progress(callback, path)
 
   
 class TransferLocal(Transfer):
@@ -355,171 +759,451 @@ class TransferLocal(Transfer):
     super(TransferLocal, self).__init__(remote_file_controller)
     #print "Local transfer"
 
-  def transfer_to_remote(self, path, remote_path):
+  def transfer_to_remote(self, path, remote_path, callback=None):
     #print "copy " + repr(path) + " to " + repr(remote_path)
     #time.sleep(4)
     if os.path.isfile(path):
-      if not os.path.isdir(os.path.dirname(remote_path)):
-        os.makedirs(os.path.dirname(remote_path))
+      self.create_dirs(remote_path)
       shutil.copy(path, remote_path)
+      self._report_progress(callback, path)
 
     if os.path.isdir(path):
-      if not os.path.isdir(os.path.dirname(remote_path)):
-        os.makedirs(os.path.dirname(remote_path))
+      self.create_dirs(remote_path)
       if os.path.isdir(remote_path):
         for p in os.listdir(path):
           self.transfer_to_remote(os.path.join(path, p), 
-                                  os.path.join(remote_path, p))
+                                  os.path.join(remote_path, p),
+                                  callback)
       else:
         shutil.copytree(path, remote_path)
+        self._report_progress(callback, path)
     #time.sleep(4)
       
 
-  def transfer_from_remote(self, remote_path, path):
+  def transfer_from_remote(self, remote_path, path, callback=None):
     #print "copy " + repr(remote_path) + " to " + repr(path)
     #time.sleep(4)
     if os.path.isfile(remote_path):
-      if not os.path.isdir(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
+      self.create_dirs(path)
       shutil.copy(remote_path, path)
+      self._report_progress(callback, path)
       
     if os.path.isdir(remote_path):
-      if not os.path.isdir(os.path.dirname(path)):
-        #print "makedirs " + repr(os.path.dirname(path))
-        os.makedirs(os.path.dirname(path))
+      self.create_dirs(path)
       if os.path.isdir(path):
         for p in os.listdir(remote_path):
           self.transfer_from_remote(os.path.join(remote_path, p),
-                                    os.path.join(path, p))
+                                    os.path.join(path, p),
+                                    callback)
       else:
         shutil.copytree(remote_path, path)
+        self._report_progress(callback, path)
     #time.sleep(4)
 
 
+class RemoteCall(object):
+  '''
+  Call to a method of a remote file controller, run by another thread.
+  '''
+
+  method_name = None
+
+  args = None
+
+  result = None
+
+  exception = None
+
+  # threading.Event set when the call is done
+  done = None
+
+  def __init__(self, method_name, args):
+    self.method_name = method_name
+    self.args = args
+    self.done = threading.Event()
+
+  def run(self, remote_file_controller):
+    try:
+      self.result = getattr(remote_file_controller,
+                            self.method_name)(*self.args)
+    except Exception, e:
+      self.exception = e
+    self.done.set()
+
+  def get_result(self):
+    self.done.wait()
+    if self.exception != None:
+      raise self.exception
+    return self.result
+
+
+class RemoteCallPool(object):
+  '''
+  Threads running RemoteCall, each one with its own connection in the case
+  of a Pyro proxy (see Transfer.copy). The threads are started at the first 
+  call.
+  '''
+
+  remote_file_controller = None
+
+  nb_threads = None
+
+  # Queue.Queue of the RemoteCall to run
+  _calls = None
+
+  _threads = None
+
+  _lock = None
+
+  def __init__(self, remote_file_controller, nb_threads):
+    self.remote_file_controller = remote_file_controller
+    self.nb_threads = nb_threads
+    self._lock = threading.Lock()
+
+  def __del__(self):
+    if self._calls != None:
+      RemoteCallPool._stop(self._calls, self._threads)
+
+  def call(self, method_name, args):
+    '''
+    returns the RemoteCall, in progress
+    '''
+    self._start()
+    call = RemoteCall(method_name, args)
+    self._calls.put(call)
+    return call
+
+  def _start(self):
+    with self._lock:
+      if self._calls != None:
+        return
+      self._calls = Queue.Queue()
+      self._threads = []
+      for i in range(self.nb_threads):
+        thread = threading.Thread(target=RemoteCallPool._run,
+                                  args=(self.remote_file_controller,
+                                        self._calls))
+        thread.setDaemon(True)
+        thread.start()
+        self._threads.append(thread)
+      atexit.register(RemoteCallPool._stop, self._calls, self._threads)
+
+  @staticmethod
+  def _stop(calls, threads):
+    for thread in threads:
+      calls.put(None)
+    for thread in threads:
+      thread.join()
+
+  @staticmethod
+  def _run(remote_file_controller, calls):
+    if not isinstance(remote_file_controller, RemoteFileController):
+      remote_file_controller = copy.copy(remote_file_controller)
+    call = calls.get()
+    while call != None:
+      call.run(remote_file_controller)
+      call = calls.get()
+
+
 class PortableRemoteTransfer(Transfer):
 
-  def __init__(self, remote_file_controller):
+  # maximum number of calls to the remote file controller in progress at once
+  # for the transfer of a file
+  window_size = None
+
+  # the files of a directory smaller than bundle_threshold bytes are
+  # transfered to the remote side in bundles (0: no bundles)
+  bundle_threshold = None
+
+  # maximum size of the files of a bundle, so that the bundles of a
+  # directory can be transfered in parallel
+  max_bundle_size = 16 * 1024 ** 2
+
+  # RemoteCallPool of window_size threads, shared by the copies of the
+  # transfer
+  _call_pool = None
+
+  def __init__(self, 
+               remote_file_controller, 
+               window_size=4, 
+               bundle_threshold=256 * 1024):
     super(PortableRemoteTransfer, self).__init__(remote_file_controller)
     #print "Portable transfer"
+    self.window_size = window_size
+    self.bundle_threshold = bundle_threshold
+    self._call_pool = RemoteCallPool(remote_file_controller, window_size)
 
   def transfer_to_remote(self, 
                          path, 
                          remote_path,
-                         buffer_size=512**2):
+                         buffer_size=512**2,
+                         callback=None,
+                         relative_paths=None):
     '''
+    * relative_paths *sequence of string*
+        Only transfers these files of the directory path (paths relative to
+        path), as a bundle: the files are packed in tar archives of about
+        buffer_size bytes, extracted on the remote side. The directories of
+        the files must exist on the remote side.
+
     return Transfered_with_success
     '''
     print "copy " + repr(path) + " to " + repr(remote_path)
-    if os.path.isfile(path):
+    if relative_paths != None:
+      for size in self._pipelined_calls(
+                  'write_archive',
+                  ((remote_path, data)
+                   for data in self._archive_chunks(path,
+                                                    relative_paths,
+                                                    buffer_size))):
+        if callback != None:
+          callback(size)
+
+    elif os.path.isfile(path):
       self.remote_file_controller.create_dirs(remote_path)
-      # TBI in case the file were already transfered
-      transmitted = 0
-
+      # resume the transfer after the chunks already transfered
+      (transmitted,
+       md5_hash) = self._verified_chunks(path, remote_path, buffer_size)
+      self.remote_file_controller.truncate_file(remote_path, transmitted)
+      if callback != None and transmitted:
+        callback(transmitted)
+
+      handle = self.remote_file_controller.open_file(remote_path, 'w')
       f = open(path, 'rb')
-      self.remote_file_controller.create_file(remote_path)
+      f.seek(transmitted)
       file_size = os.path.getsize(path)
-      if transmitted:
-        f.seek(transmitted)
       r_file_size = transmitted
-      while r_file_size < file_size:
-        r_file_size = self.remote_file_controller.write(remote_path,   
-                                                        f.read(buffer_size))
+      for end in self._pipelined_calls(
+                  'write_chunk',
+                  ((handle, location, data)
+                   for location, data in self._read_chunks(f,
+                                                           buffer_size,
+                                                           md5_hash))):
+        if callback != None:
+          callback(end - r_file_size)
+        r_file_size = end
       f.close()
+      r_md5_hash = self.remote_file_controller.close_file(handle)
       
       if r_file_size != file_size:
         pass
         #TBI error
 
-      md5_hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
-      if md5_hash != self.remote_file_controller.get_md5_hash(remote_path):
+      if md5_hash.hexdigest() != r_md5_hash:
         #TBI error
         pass
 
 
     elif os.path.isdir(path):
-      self.remote_file_controller.create_dirs(remote_path)
-
-      (dir_list, file_path_dict) = self.top_down_dir_list(path)
-      self.remote_file_controller.create_dir_structure(remote_path,
-                                                       dir_list)
-      for relative_dir_path, file_list in file_path_dict.iteritems():
-        dir_path = os.path.join(path, relative_dir_path)
-        r_dir_path = os.path.join(remote_path, relative_dir_path)
-        for file_name in file_list: 
-          remote_file_path = os.path.join(r_dir_path, file_name)
-          file_path = os.path.join(dir_path, file_name)
-          self.transfer_to_remote(file_path, 
-                                  remote_file_path,
-                                  buffer_size=buffer_size)
+      for split_transfer in self.split_transfer_to_remote(path, remote_path):
+        if len(split_transfer) == 3:
+          (file_path, remote_file_path, bundle) = split_transfer
+        else:
+          (file_path, remote_file_path) = split_transfer
+          bundle = None
+        self.transfer_to_remote(file_path, 
+                                remote_file_path,
+                                buffer_size=buffer_size,
+                                callback=callback,
+                                relative_paths=bundle)
  
     
 
   def transfer_from_remote(self, 
                            remote_path, 
                            path,
-                           buffer_size = 512**2):
+                           buffer_size = 512**2,
+                           callback=None):
 
    print "copy " + repr(remote_path) + " to " + repr(path)
    if self.remote_file_controller.is_file(remote_path):
-      if not os.path.isdir(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-      # TBI in case the file were already transfered
-      transmitted = 0
-
-      if transmitted:
-        f = open(path, 'ab')
+      self.create_dirs(path)
+      # resume the transfer after the chunks already transfered
+      if os.path.isfile(path):
+        (transmitted,
+         md5_hash) = self._verified_chunks(path, remote_path, buffer_size)
+        f = open(path, 'r+b')
+        f.truncate(transmitted)
+        f.seek(transmitted)
       else:
+        transmitted = 0
+        md5_hash = hashlib.md5()
         f = open(path, 'wb')
+      if callback != None and transmitted:
+        callback(transmitted)
 
       remote_file_size = self.remote_file_controller.get_file_size(remote_path)
 
-      transmitted = os.path.getsize(path)
-      data = self.remote_file_controller.read(remote_path,
-                                              transmitted,
-                                              buffer_size)
-      f.write(data)
-      file_size = f.tell()
-      while data and file_size < remote_file_size:
-        data = self.remote_file_controller.read(remote_path,
-                                                file_size,
-                                                buffer_size)
+      handle = self.remote_file_controller.open_file(remote_path, 'r')
+      for data in self._pipelined_calls(
+                      'read_chunk',
+                      ((handle, location, buffer_size)
+                       for location in xrange(transmitted,
+                                              remote_file_size,
+                                              buffer_size))):
         f.write(data)
-        file_size = f.tell()
-      
+        md5_hash.update(data)
+        if callback != None:
+          callback(len(data))
+      file_size = f.tell()
       f.close()
-      
+      r_md5_hash = self.remote_file_controller.close_file(handle)
 
       if file_size != remote_file_size:
         pass
         #TBI error
 
-      md5_hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
-      if md5_hash != self.remote_file_controller.get_md5_hash(remote_path):
+      if md5_hash.hexdigest() != r_md5_hash:
         #TBI error
         pass
 
 
    elif self.remote_file_controller.is_dir(remote_path):
-      if not os.path.isdir(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-
-      (dir_list, file_path_dict) = self.remote_file_controller.top_down_dir_list(remote_path)
-      self.create_dir_structure(path,
-                                dir_list)
-      for relative_dir_path, file_list in file_path_dict.iteritems():
-        dir_path = os.path.join(path, relative_dir_path)
-        r_dir_path = os.path.join(remote_path, relative_dir_path)
-        for file_name in file_list: 
-          file_path = os.path.join(dir_path, file_name)
-          r_file_path = os.path.join(r_dir_path, file_name)
-          self.transfer_from_remote(r_file_path,
-                                    file_path,
-                                    buffer_size=buffer_size)
+      for r_file_path, file_path in self.split_transfer_from_remote(
+                                                                remote_path,
+                                                                path):
+        self.transfer_from_remote(r_file_path,
+                                  file_path,
+                                  buffer_size=buffer_size,
+                                  callback=callback)
     
 
+  def split_transfer_to_remote(self, path, remote_path):
+    if not os.path.isdir(path):
+      return [(path, remote_path)]
+
+    self.remote_file_controller.create_dirs(remote_path)
+    (dir_list, file_path_dict) = self.top_down_dir_list(path)
+    self.remote_file_controller.create_dir_structure(remote_path,
+                                                     dir_list)
+    transfers = []
+    # small files bundled together, and the size of these files
+    bundle = []
+    bundle_size = 0
+    for relative_dir_path, file_list in file_path_dict.iteritems():
+      dir_path = os.path.join(path, relative_dir_path)
+      r_dir_path = os.path.join(remote_path, relative_dir_path)
+      for file_name in file_list: 
+        file_path = os.path.join(dir_path, file_name)
+        file_size = os.path.getsize(file_path)
+        if file_size >= self.bundle_threshold:
+          transfers.append((file_path,
+                            os.path.join(r_dir_path, file_name)))
+          continue
+        bundle.append(os.path.join(relative_dir_path, file_name))
+        bundle_size = bundle_size + file_size
+        if bundle_size >= self.max_bundle_size:
+          transfers.append((path, remote_path, bundle))
+          bundle = []
+          bundle_size = 0
+    if bundle:
+      transfers.append((path, remote_path, bundle))
+    return transfers
+
+  def split_transfer_from_remote(self, remote_path, path):
+    if not self.remote_file_controller.is_dir(remote_path):
+      return [(remote_path, path)]
+
+    self.create_dirs(path)
+    (dir_list, 
+     file_path_dict) = self.remote_file_controller.top_down_dir_list(
+                                                                  remote_path)
+    self.create_dir_structure(path,
+                              dir_list)
+    transfers = []
+    for relative_dir_path, file_list in file_path_dict.iteritems():
+      dir_path = os.path.join(path, relative_dir_path)
+      r_dir_path = os.path.join(remote_path, relative_dir_path)
+      for file_name in file_list: 
+        transfers.append((os.path.join(r_dir_path, file_name),
+                          os.path.join(dir_path, file_name)))
+    return transfers
+
+  def _read_chunks(self, f, buffer_size, md5_hash):
+    '''
+    Reads the file f by chunks of buffer_size bytes from its current
+    location, and updates md5_hash with the data.
+
+    returns an iterator on the tuples (location, data)
+    '''
+    location = f.tell()
+    data = f.read(buffer_size)
+    while data:
+      md5_hash.update(data)
+      yield (location, data)
+      location = location + len(data)
+      data = f.read(buffer_size)
+
+  def _archive_chunks(self, path, relative_paths, buffer_size):
+    '''
+    Packs the files relative_paths of the directory path in tar archives of
+    about buffer_size bytes, or of a single file if it is bigger.
+
+    returns an iterator on the content of the archives
+    '''
+    buffer = None
+    for relative_path in relative_paths:
+      if buffer == None:
+        buffer = cStringIO.StringIO()
+        archive = tarfile.open(fileobj=buffer, mode='w', dereference=True)
+      archive.add(os.path.join(path, relative_path), arcname=relative_path)
+      if buffer.tell() >= buffer_size:
+        archive.close()
+        yield buffer.getvalue()
+        buffer = None
+    if buffer != None:
+      archive.close()
+      yield buffer.getvalue()
+
+  def _pipelined_calls(self, method_name, calls_args):
+    '''
+    Calls a method of the remote file controller with each tuple of
+    arguments of calls_args. Up to window_size calls are in progress at once,
+    so that the transfer does not wait for the round trip of each call.
+
+    returns an iterator on the results, in the order of calls_args
+    '''
+    if self.window_size <= 1:
+      method = getattr(self.remote_file_controller, method_name)
+      for args in calls_args:
+        yield method(*args)
+      return
+
+    calls = collections.deque()
+    for args in calls_args:
+      calls.append(self._call_pool.call(method_name, args))
+      if len(calls) >= self.window_size:
+        yield calls.popleft().get_result()
+    while calls:
+      yield calls.popleft().get_result()
+
+  def _verified_chunks(self, path, remote_path, buffer_size):
+    '''
+    Compares the chunks of the local file with the chunks of the remote file
+    already transfered, in order, until they differ.
+
+    returns a tuple (number of bytes identical on both sides,
+                     md5 hash object of these bytes)
+    '''
+    nb_chunks = os.path.getsize(path) / buffer_size
+    r_chunks_md5_hashes = self.remote_file_controller.get_chunks_md5_hashes(
+                                                                  remote_path,
+                                                                  buffer_size,
+                                                                  nb_chunks)
+    verified = 0
+    md5_hash = hashlib.md5()
+    f = open(path, 'rb')
+    for r_chunk_md5_hash in r_chunks_md5_hashes:
+      data = f.read(buffer_size)
+      if hashlib.md5(data).hexdigest() != r_chunk_md5_hash:
+        break
+      md5_hash.update(data)
+      verified = verified + len(data)
+    f.close()
+    return (verified, md5_hash)
+
   def top_down_dir_list(self, path):
     return Transfer.top_down_dir_list(path)
 
   def create_dir_structure(self, path, top_down_relalive_path):
     return Transfer.create_dir_structure(path, top_down_relalive_path)
-
@@ -42,6 +42,7 @@ setup(
               'soma_workflow.gui',
               'soma_workflow.test',
               'soma_workflow.check_requirement',
+              'soma_workflow.test.benchmarks',
               'soma_workflow.test.job_tests',
               'soma_workflow.test.workflow_tests',
               'soma_workflow.test.workflow_tests.workflow_examples',],